@@ -0,0 +1,225 @@
+"""
+Benchmark the build pipeline, from BuildHandler through the BuildQueue to the
+executor's build process.
+
+JupyterBookPubApp runs in this process, with the upstream resolver and fetcher
+replaced by local stubs, and a GenericBuilder command that sleeps and then writes
+a site. Bursts of concurrent build requests are fired at /build, with several
+requests for each distinct spec, and each client polls the status API until its
+build is done (when a browser would be redirected).
+
+Reported per burst: the time from request to redirect, the time that builds
+spent queued, how well duplicate requests were coalesced into shared builds, and
+the lag of the event loop.
+
+    python benchmarks/bench_builds.py --bursts 3 --distinct 20 --duplicates 5
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import tempfile
+import time
+import urllib.parse
+from pathlib import Path
+
+from repoproviders.resolvers.base import Exists
+from repoproviders.resolvers.git import ImmutableGit
+from tornado.httpclient import AsyncHTTPClient
+from traitlets.config import Config
+
+import jupyterbook_pub.app
+import jupyterbook_pub.jobs
+from jupyterbook_pub.app import JupyterBookPubApp
+from jupyterbook_pub.utils import random_port
+
+STATUS_URL_PATTERN = re.compile(r'"statusUrl": "([^"]+)"')
+
+
+def get_spec_repo(spec: str) -> ImmutableGit:
+    return ImmutableGit(f"https://github.com/bench/{spec}", "0" * 40)
+
+
+def install_stubs(resolve_latency: float, fetch_latency: float):
+    """
+    Replace the upstream resolver and fetcher with local stand-ins.
+    """
+
+    async def resolve(question: str, recursive: bool):
+        await asyncio.sleep(resolve_latency)
+        return [Exists(get_spec_repo(question))]
+
+    async def fetch(repo, path: Path):
+        await asyncio.sleep(fetch_latency)
+        path.mkdir(parents=True)
+        (path / "README.md").write_text(f"# {repo}")
+
+    jupyterbook_pub.app.resolve = resolve
+    jupyterbook_pub.jobs.fetch = fetch
+
+
+def get_config(args) -> Config:
+    # Sleep, and then write a site of --files pages
+    script = (
+        f"sleep {args.build_seconds}; "
+        f'for i in $(seq {args.files}); do echo "<html>$i</html>" > "$1/$i.html"; done; '
+        'cp "$1/1.html" "$1/index.html"'
+    )
+    config = Config()
+    config.JupyterBookPubApp.log_level = "WARN"
+    config.JupyterBookPubApp.max_concurrent_builds = args.concurrent_builds
+    config.JupyterBookPubApp.resolver_cache_persist = False
+    config.BuildQueue.max_queued_builds = 0
+    config.BuildQueue.max_queued_builds_per_client = 0
+    config.LocalProcessExecutor.builder_class = "jupyterbook_pub.builder.GenericBuilder"
+    config.GenericBuilder.command = ["sh", "-c", script, "sh", "{build}"]
+    return config
+
+
+async def measure_loop_lag(lags: list[float], interval: float = 0.01):
+    """
+    Record how late the event loop wakes up from sleeps, until cancelled.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def request_build(
+    client: AsyncHTTPClient, port: int, spec: str, poll_interval: float
+) -> tuple[float, dict]:
+    """
+    Request a build as a browser would, and poll until it is done.
+    Return the time to redirect, and the final status of the job.
+    """
+    query = urllib.parse.urlencode({"spec": spec, "next": f"/repo/{spec}/"})
+    start = time.perf_counter()
+    response = await client.fetch(
+        f"http://127.0.0.1:{port}/build?{query}", follow_redirects=False
+    )
+    status_url = STATUS_URL_PATTERN.search(response.body.decode())[1]
+
+    while True:
+        response = await client.fetch(f"http://127.0.0.1:{port}{status_url}")
+        job = json.loads(response.body)
+        if job["state"] in ("done", "failed"):
+            return time.perf_counter() - start, job
+        await asyncio.sleep(poll_interval)
+
+
+def format_ms(values: list[float]) -> str:
+    """
+    Format the median, 99th percentile and maximum of durations in milliseconds.
+    """
+    if not values:
+        return "-"
+    if len(values) == 1:
+        p50 = p99 = values[0]
+    else:
+        percentiles = statistics.quantiles(values, n=100)
+        p50, p99 = percentiles[49], percentiles[98]
+    return f"{p50 * 1000:.0f}/{p99 * 1000:.0f}/{max(values) * 1000:.0f}"
+
+
+async def run(args):
+    install_stubs(args.resolve_latency, args.fetch_latency)
+
+    port = random_port()
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        app = JupyterBookPubApp(config=get_config(args))
+        app.initialize([f"--storage={tmpdir}", f"--port={port}"])
+        app_task = asyncio.create_task(app.launch())
+        await asyncio.sleep(0.5)
+
+        # AsyncHTTPClient is otherwise shared, and ignores max_clients once created
+        client = AsyncHTTPClient(
+            force_instance=True, max_clients=args.distinct * args.duplicates
+        )
+        print(
+            f"{'burst':<6} {'requests':>8} {'builds':>7} {'failed':>7} "
+            f"{'redirect (ms)':>20} {'queued (ms)':>20} {'loop lag (ms)':>20}"
+        )
+        print("(durations are p50/p99/max)")
+        for burst in range(args.bursts):
+            specs = [f"burst{burst}-book{i}" for i in range(args.distinct)]
+            requests = [spec for spec in specs for _ in range(args.duplicates)]
+
+            lags = []
+            lag_task = asyncio.create_task(measure_loop_lag(lags))
+            results = await asyncio.gather(
+                *(
+                    request_build(client, port, spec, args.poll_interval)
+                    for spec in requests
+                )
+            )
+            lag_task.cancel()
+
+            redirect_times = [t for t, _ in results]
+            jobs = {job["id"]: job for _, job in results}
+            queued_times = [
+                job["timings"]["fetching"] - job["timings"]["queued"]
+                for job in jobs.values()
+                if "fetching" in job["timings"]
+            ]
+            n_failed = sum(job["state"] == "failed" for job in jobs.values())
+            print(
+                f"{burst:<6} {len(requests):>8} {len(jobs):>7} {n_failed:>7} "
+                f"{format_ms(redirect_times):>20} {format_ms(queued_times):>20} "
+                f"{format_ms(lags):>20}"
+            )
+
+        client.close()
+        app_task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dir", type=Path, default=None, help="Directory in which to run benchmarks"
+    )
+    parser.add_argument("--bursts", type=int, default=3, help="Number of bursts")
+    parser.add_argument(
+        "--distinct", type=int, default=20, help="Number of distinct specs per burst"
+    )
+    parser.add_argument(
+        "--duplicates",
+        type=int,
+        default=5,
+        help="Number of concurrent requests for each spec",
+    )
+    parser.add_argument(
+        "--concurrent-builds", type=int, default=4, help="Number of build workers"
+    )
+    parser.add_argument(
+        "--build-seconds", type=float, default=1, help="Duration of each build"
+    )
+    parser.add_argument(
+        "--files", type=int, default=100, help="Number of files written by each build"
+    )
+    parser.add_argument(
+        "--resolve-latency",
+        type=float,
+        default=0.2,
+        help="Time (in seconds) taken by the stub resolver",
+    )
+    parser.add_argument(
+        "--fetch-latency",
+        type=float,
+        default=0.5,
+        help="Time (in seconds) taken by the stub fetcher",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1,
+        help="Time (in seconds) between status polls, as in the build page",
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
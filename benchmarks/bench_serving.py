@@ -0,0 +1,366 @@
+"""
+Benchmark static serving of built sites through BuiltRepoHandler.
+
+A synthetic built site (pages, theme bundles and images) is generated under
+--dir, and served by JupyterBookPubApp in a separate process, with the upstream
+resolver replaced by a stub that answers after --resolve-latency seconds. Each
+--specs spec resolves to a different repository, whose built site is a hardlinked
+copy of the synthetic site.
+
+Concurrent load is driven at /repo/<spec>/... for each combination of cold and
+warm resolver cache and page cache, reporting requests per second, latency
+percentiles, and the CPU time and RSS of the app process. Page cache state is
+controlled with posix_fadvise, and CPU and RSS are read from /proc, so this
+requires Linux.
+
+    python benchmarks/bench_serving.py --dir /path/on/target/filesystem
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from repoproviders.resolvers.base import Exists
+from repoproviders.resolvers.git import ImmutableGit
+from tornado.httpclient import AsyncHTTPClient
+
+from jupyterbook_pub.app import BUILT_SITES_NAME, JupyterBookPubApp
+from jupyterbook_pub.cache import make_rendered_cache_key
+from jupyterbook_pub.compression import precompress_site
+from jupyterbook_pub.manifest import write_manifest
+from jupyterbook_pub.staging import stage_tree
+from jupyterbook_pub.utils import random_port
+
+# Name of the synthetic site under the storage root
+SITE_NAME = "bench_site"
+
+# (resolver cache, page cache) states to benchmark
+SCENARIOS = [
+    ("cold", "cold"),
+    ("cold", "warm"),
+    ("warm", "cold"),
+    ("warm", "warm"),
+]
+
+WORDS = (
+    "notebook kernel figure equation citation section theorem proof dataset "
+    "analysis the of and to in is that for with as on by"
+).split()
+
+
+def get_spec_repo(spec: str) -> ImmutableGit:
+    return ImmutableGit(f"https://github.com/bench/{spec}", "0" * 40)
+
+
+def make_site(path: Path, n_pages: int, n_images: int, rng: random.Random):
+    """
+    Generate a synthetic built site, returning the URL paths of its pages, theme
+    bundles and images.
+
+    :param path: path at which to create the site.
+    :param n_pages: number of HTML pages.
+    :param n_images: number of large images.
+    :param rng: source of randomness.
+    """
+    build_path = path / "build"
+    build_path.mkdir(parents=True)
+
+    def text(n_words: int) -> str:
+        return " ".join(rng.choices(WORDS, k=n_words))
+
+    bundles = []
+    for name, size in [
+        ("entry.client-3f9a1c2b.js", 800 * 1024),
+        ("theme-5d8e7f10.css", 200 * 1024),
+        *((f"chunk-{i:02}-a1b2c3d4.js", 50 * 1024) for i in range(20)),
+    ]:
+        (build_path / name).write_text(text(size // 7)[:size])
+        bundles.append(f"build/{name}")
+
+    images = []
+    for i in range(n_images):
+        name = f"figure-{i}-9c8b7a6d.png"
+        (build_path / name).write_bytes(rng.randbytes(1024 * 1024))
+        images.append(f"build/{name}")
+
+    def page(prefix: str, n_words: int) -> str:
+        head = "".join(
+            f'<link rel="modulepreload" href="{prefix}{bundle}">' for bundle in bundles
+        )
+        return f"<html><head>{head}</head><body><p>{text(n_words)}</p></body></html>"
+
+    (path / "index.html").write_text(page("", 500))
+    pages = [""]
+    for i in range(n_pages):
+        page_path = path / f"section-{i % 50}" / f"page-{i}" / "index.html"
+        page_path.parent.mkdir(parents=True, exist_ok=True)
+        page_path.write_text(page("../../", 2000))
+        pages.append(f"section-{i % 50}/page-{i}/")
+    return pages, bundles, images
+
+
+def prepare_storage(storage_path: Path, args) -> tuple[list[str], list[str]]:
+    """
+    Create the storage root with the synthetic site, built for every spec.
+    Return the specs, and URL paths of the site weighted by the request mix.
+    """
+    rng = random.Random(args.seed)
+    built_sites_path = storage_path / BUILT_SITES_NAME
+    site_path = storage_path / SITE_NAME
+
+    print(f"Generating site with {args.pages} pages...", file=sys.stderr)
+    pages, bundles, images = make_site(site_path, args.pages, args.images, rng)
+    precompress_site(site_path)
+    write_manifest(site_path)
+
+    specs = [f"book-{i}" for i in range(args.specs)]
+    for spec in specs:
+        key = make_rendered_cache_key(get_spec_repo(spec), "/")
+        stage_tree(site_path, built_sites_path / key, "hardlink")
+
+    # Navigations are most common, then the bundles that they load
+    mix = pages * 7 + bundles * (2 * len(pages) // len(bundles))
+    if images:
+        mix += images * (len(pages) // len(images))
+    return specs, mix
+
+
+def evict_page_cache(path: Path):
+    for root, _, names in os.walk(path):
+        for name in names:
+            fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def warm_page_cache(path: Path):
+    for root, _, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(root, name), "rb") as f:
+                while f.read(1024 * 1024):
+                    pass
+
+
+def read_process_stats(pid: int) -> tuple[float, int, int]:
+    """
+    Return the CPU time (in seconds), RSS and peak RSS (in bytes) of a process.
+
+    :param pid: ID of process.
+    """
+    with open(f"/proc/{pid}/stat") as f:
+        # The command name may contain spaces, so split after it
+        fields = f.read().rpartition(")")[2].split()
+    cpu_s = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    memory = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                memory[key] = int(value.split()[0]) * 1024
+    return cpu_s, memory["VmRSS"], memory["VmHWM"]
+
+
+async def wait_for_server(port: int, timeout: float = 30):
+    client = AsyncHTTPClient()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            # Any response (e.g. 403 from /metrics without a token) means it is up
+            await client.fetch(f"http://127.0.0.1:{port}/metrics", raise_error=False)
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run_load(
+    port: int,
+    specs: list[str],
+    mix: list[str],
+    n_requests: int,
+    concurrency: int,
+    rng: random.Random,
+) -> tuple[list[float], int, float]:
+    """
+    Issue requests for random paths of random specs, from concurrent clients.
+    Return the latencies (in seconds), the number of errors, and the duration.
+    """
+    # AsyncHTTPClient is otherwise shared, and ignores max_clients once created
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = []
+    n_errors = 0
+    remaining = n_requests
+
+    async def worker():
+        nonlocal remaining, n_errors
+        while remaining > 0:
+            remaining -= 1
+            url = f"http://127.0.0.1:{port}/repo/{rng.choice(specs)}/{rng.choice(mix)}"
+            start = time.perf_counter()
+            response = await client.fetch(
+                url,
+                headers={"Accept-Encoding": "br, gzip"},
+                decompress_response=False,
+                raise_error=False,
+                request_timeout=60,
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.code != 200:
+                n_errors += 1
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        client.close()
+    return latencies, n_errors, time.perf_counter() - start
+
+
+async def run_scenario(
+    storage_path: Path, specs: list[str], mix: list[str], resolver: str, page: str, args
+):
+    port = random_port()
+    with open(storage_path / "server.log", "a") as log:
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                __file__,
+                "--serve",
+                f"--resolve-latency={args.resolve_latency}",
+                "--",
+                f"--storage={storage_path}",
+                f"--port={port}",
+                "--JupyterBookPubApp.resolver_cache_persist=False",
+            ],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    try:
+        await wait_for_server(port)
+        rng = random.Random(args.seed)
+
+        if resolver == "warm":
+            client = AsyncHTTPClient()
+            await asyncio.gather(
+                *(
+                    client.fetch(f"http://127.0.0.1:{port}/repo/{spec}/")
+                    for spec in specs
+                )
+            )
+
+        site_path = storage_path / SITE_NAME
+        if page == "warm":
+            warm_page_cache(site_path)
+        else:
+            evict_page_cache(site_path)
+
+        cpu_before, _, _ = read_process_stats(server.pid)
+        latencies, n_errors, duration = await run_load(
+            port, specs, mix, args.requests, args.concurrency, rng
+        )
+        cpu_after, rss, peak_rss = read_process_stats(server.pid)
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{resolver:<9} {page:<9} {len(latencies) / duration:>8.0f} "
+        f"{percentiles[49] * 1000:>8.1f} {percentiles[98] * 1000:>8.1f} "
+        f"{cpu_after - cpu_before:>8.2f} {rss / 2**20:>8.0f} {peak_rss / 2**20:>8.0f} "
+        f"{n_errors:>7}"
+    )
+
+
+def serve(resolve_latency: float, argv: list[str]):
+    """
+    Run the app, with a stub upstream resolver.
+    """
+    import jupyterbook_pub.app
+
+    async def resolve(question: str, recursive: bool):
+        await asyncio.sleep(resolve_latency)
+        return [Exists(get_spec_repo(question))]
+
+    jupyterbook_pub.app.resolve = resolve
+
+    app = JupyterBookPubApp()
+    app.initialize(argv)
+    try:
+        app.start()
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dir", type=Path, default=None, help="Directory in which to run benchmarks"
+    )
+    parser.add_argument("--pages", type=int, default=2000, help="Number of pages")
+    parser.add_argument("--images", type=int, default=20, help="Number of 1MiB images")
+    parser.add_argument(
+        "--specs", type=int, default=100, help="Number of distinct specs to request"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=20000, help="Number of requests per scenario"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=64, help="Number of concurrent clients"
+    )
+    parser.add_argument(
+        "--resolve-latency",
+        type=float,
+        default=0.2,
+        help="Time (in seconds) taken by the stub upstream resolver",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=[f"{resolver}-{page}" for resolver, page in SCENARIOS],
+        help="Scenario (resolver cache-page cache) to benchmark (default: all)",
+    )
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("app_args", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.resolve_latency, args.app_args)
+        return
+
+    scenarios = [
+        (resolver, page)
+        for resolver, page in SCENARIOS
+        if not args.scenario or f"{resolver}-{page}" in args.scenario
+    ]
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        storage_path = Path(tmpdir)
+        specs, mix = prepare_storage(storage_path, args)
+
+        print(
+            f"{'resolver':<9} {'page':<9} {'req/s':>8} {'p50 (ms)':>8} "
+            f"{'p99 (ms)':>8} {'cpu (s)':>8} {'rss (MiB)':>8} {'peak':>8} "
+            f"{'errors':>7}"
+        )
+        for resolver, page in scenarios:
+            asyncio.run(run_scenario(storage_path, specs, mix, resolver, page, args))
+
+
+if __name__ == "__main__":
+    main()
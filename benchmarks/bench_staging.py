@@ -0,0 +1,91 @@
+"""
+Benchmark the strategies for staging a source tree before a build.
+
+Synthetic repositories of several shapes are generated under --dir, and each
+staging strategy is timed against them. For the reflink strategy to take effect,
+--dir must be on a filesystem that supports reflinks (e.g. btrfs, XFS).
+
+    python benchmarks/bench_staging.py --dir /path/on/target/filesystem
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from jupyterbook_pub.staging import STAGING_STRATEGIES, stage_tree
+
+# Name → (number of files, size of each file in bytes)
+REPO_SHAPES = {
+    "small": (100, 4 * 1024),
+    "many-files": (5000, 16 * 1024),
+    "data-heavy": (20, 50 * 1024 * 1024),
+}
+
+
+def make_repo(path: Path, n_files: int, file_size: int):
+    """
+    Generate a repository of n_files files of file_size bytes, spread over
+    nested directories.
+
+    :param path: path at which to create the repository.
+    :param n_files: number of files.
+    :param file_size: size of each file in bytes.
+    """
+    for i in range(n_files):
+        file_path = path / f"dir{i % 10}" / f"sub{i % 7}" / f"file{i}.ipynb"
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_bytes(os.urandom(file_size))
+
+
+def time_strategy(repo_path: Path, work_path: Path, strategy: str, repeat: int):
+    timings = []
+    for i in range(repeat):
+        dest_path = work_path / f"{strategy}-{i}"
+        start = time.perf_counter()
+        counts = stage_tree(repo_path, dest_path, strategy)
+        timings.append(time.perf_counter() - start)
+        shutil.rmtree(dest_path)
+    return timings, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dir", type=Path, default=None, help="Directory in which to run benchmarks"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of times to stage each repo"
+    )
+    parser.add_argument(
+        "--shape",
+        action="append",
+        choices=list(REPO_SHAPES),
+        help="Repository shape to benchmark (default: all)",
+    )
+    args = parser.parse_args()
+
+    print(f"{'repo':<12} {'strategy':<10} {'median (s)':>10} {'min (s)':>10}  methods")
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        work_path = Path(tmpdir)
+        for shape in args.shape or REPO_SHAPES:
+            n_files, file_size = REPO_SHAPES[shape]
+            repo_path = work_path / shape
+            make_repo(repo_path, n_files, file_size)
+
+            for strategy in STAGING_STRATEGIES:
+                timings, counts = time_strategy(
+                    repo_path, work_path, strategy, args.repeat
+                )
+                print(
+                    f"{shape:<12} {strategy:<10} {statistics.median(timings):>10.3f} "
+                    f"{min(timings):>10.3f}  {counts}"
+                )
+            shutil.rmtree(repo_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,30 @@
 from __future__ import annotations
 
 import asyncio
+import collections
+import hmac
+import json
 import logging
+import mimetypes
+import re
 import secrets
 import os
+import time
 from pathlib import Path
 from typing import override
 import urllib.parse
 
 import tornado
-from cachetools import TTLCache
+from cachetools import LRUCache, TLRUCache, TTLCache
 from jinja2 import Environment, FileSystemLoader
+from opentelemetry import trace
+from prometheus_client import CONTENT_TYPE_LATEST
 from jupyterhub.services.auth import HubOAuthenticated, HubOAuthCallbackHandler
 from jupyterhub.utils import url_path_join
+from tornado.process import fork_processes, task_id
 from repoproviders import resolve
-from repoproviders.fetchers.fetcher import fetch
 from repoproviders.resolvers import to_json
-from repoproviders.resolvers.base import Exists, MaybeExists
+from repoproviders.resolvers.base import DoesNotExist, Exists, MaybeExists
 from tornado.web import (
     HTTPError,
     RequestHandler,
@@ -29,6 +37,7 @@ from traitlets import (
     validate,
     observe,
     Bool,
+    Bytes,
     Dict,
     Instance,
     Int,
@@ -39,13 +48,40 @@ from traitlets import (
 )
 from traitlets.config import Application
 
-from .cache import make_checkout_cache_key, make_rendered_cache_key
+from .blobs import BLOBS_NAME, get_blob_path
+from .cache import (
+    get_repo_version,
+    make_checkout_cache_key,
+    make_rendered_cache_key,
+    make_repo_cache_key,
+)
+from .compression import ENCODING_SUFFIXES, acceptable_encodings
 from .executor import BuildExecutor, LocalProcessExecutor
+from .jobs import BuildJob, BuildPriority, BuildQueue, BuildState, QueueFullError
+from .latest_builds import LatestBuildIndex
+from .locks import LOCKS_NAME
+from .manifest import MANIFEST_NAME, Manifest, read_manifest
+from .metrics import (
+    MULTIPROC_DIR_ENV,
+    RESOLVE_DURATION,
+    RESOLVER_LOOKUPS,
+    SERVE_REQUEST_DURATION,
+    WEBHOOK_DELIVERIES,
+    collect_metrics,
+    is_multiprocess_metrics,
+)
+from .resolver_cache import PersistentResolverCache, ResolverCacheEntry
 from .storage import StorageManager
+from .tracing import TRACE_OUTPUT_ENV, setup_tracing, tracer
+from .webhooks import get_push_question, parse_push, verify_signature
 
 # Constants for name of unique storage paths
 BUILT_SITES_NAME = "built_sites"
 REPOS_NAME = "repos"
+BUILD_CACHES_NAME = "build_caches"
+LATEST_BUILDS_NAME = "latest_builds"
+BUILD_STATUSES_NAME = "build_statuses"
+RESOLVER_CACHE_NAME = "resolver_cache.sqlite"
 
 USE_AUTHENTICATION = (
     "JUPYTERHUB_SERVICE_PREFIX" in os.environ
@@ -72,6 +108,15 @@ class AppMixin:
     def log(self):
         return self.app.log
 
+    def get_client_id(self) -> str:
+        """
+        Identify the client, for fair scheduling of builds.
+        """
+        user = self.current_user
+        if isinstance(user, dict) and "name" in user:
+            return f"user:{user['name']}"
+        return f"ip:{self.request.remote_ip}"
+
 
 class NoXSRFMixin:
     def check_xsrf_cookie(self):
@@ -87,6 +132,16 @@ class StaticFileHandler(NoXSRFMixin, MaybeAuthenticatedMixin, StaticHandler):
 
 
 class BuiltRepoHandler(AppMixin, NoXSRFMixin, MaybeAuthenticatedMixin, StaticHandler):
+    # Content-Encoding of the file being served, if it is a compressed sidecar
+    content_encoding = None
+    # Manifest of the built site, and the entry of the file being served
+    manifest = None
+    file_entry = None
+    # Version of the repository being served, and whether it is a previous build
+    # served while the requested version is built
+    served_version = None
+    stale = False
+
     def get_raw_arg(self, prefix):
         """
         Re-extract spec from request.path.
@@ -98,6 +153,7 @@ class BuiltRepoHandler(AppMixin, NoXSRFMixin, MaybeAuthenticatedMixin, StaticHan
         return spec
 
     @maybe_authenticated
+    @tracer.start_as_current_span("serve built site")
     async def get(self, arg: str):
         root_build_path = Path(self.app.storage_root) / BUILT_SITES_NAME
         root_build_path.mkdir(exist_ok=True)
@@ -119,7 +175,17 @@ class BuiltRepoHandler(AppMixin, NoXSRFMixin, MaybeAuthenticatedMixin, StaticHan
                 build_path = root_build_path / build_cache_key
 
                 # Can we serve pre-built content?
-                if build_path.exists():
+                self.manifest = self.app.get_manifest(build_path)
+                self.served_version = get_repo_version(repo)
+                if self.manifest is None and not build_path.exists():
+                    # Serve the latest build of the repo meanwhile, if allowed
+                    build_cache_key = None
+                    if self.app.latest_builds is not None:
+                        build_cache_key = await self.revalidate(repo, repo_spec, tail)
+
+                if build_cache_key is not None:
+                    self.build_cache_key = build_cache_key
+                    self.app.built_sites_storage_manager.record_access(build_cache_key)
                     # Rewrite URL against build cache key
                     # Do not include path to the handler
                     content_url = url_path_join(build_cache_key, tail)
@@ -141,20 +207,292 @@ class BuiltRepoHandler(AppMixin, NoXSRFMixin, MaybeAuthenticatedMixin, StaticHan
                     )
                     return self.redirect(build_url)
 
+    def is_navigation(self, tail: str) -> bool:
+        """
+        Return True if the request is for a page, rather than an asset of a page.
+
+        :param tail: requested path, relative to the built site.
+        """
+        mode = self.request.headers.get("Sec-Fetch-Mode")
+        if mode is not None:
+            return mode == "navigate"
+
+        # Pages are served as directories, or from extensionless or HTML paths
+        name = tail.rsplit("/", 1)[-1]
+        return "." not in name or name.endswith(".html")
+
+    async def revalidate(self, repo, repo_spec: str, tail: str) -> str | None:
+        """
+        Start building the requested version of a repository in the background, and
+        return the cache key of its latest successful build to serve meanwhile, or
+        None if there is none.
+
+        Only requests for pages start a build, as each page requests many assets,
+        and a build that failed is not retried until
+        `revalidation_failure_backoff_seconds` has passed.
+
+        :param repo: requested version of repository.
+        :param repo_spec: spec that the repository was resolved from.
+        :param tail: requested path, relative to the built site.
+        """
+        latest = self.app.latest_builds.get(repo)
+        if latest is None:
+            return None
+
+        build_path = Path(self.root) / latest.build_cache_key
+        self.manifest = self.app.get_manifest(build_path)
+        if self.manifest is None and not build_path.exists():
+            return None
+
+        requested_key = make_rendered_cache_key(repo, self.app.base_url)
+        job = self.app.revalidations.get(requested_key)
+        if job is None or job.is_finished:
+            backing_off = (
+                job is not None
+                and job.state == BuildState.failed
+                and time.time() - job.timings[BuildState.failed]
+                < self.app.revalidation_failure_backoff_seconds
+            )
+            if self.is_navigation(tail) and not backing_off:
+                try:
+                    self.app.revalidations[requested_key] = await self.app.submit_build(
+                        repo,
+                        repo_spec,
+                        client=self.get_client_id(),
+                        priority=BuildPriority.warmup,
+                    )
+                except QueueFullError:
+                    self.log.warning(f"Could not queue a background build of {repo}")
+
+        self.log.debug(f"Serving {latest.version} of {repo} while it is built")
+        self.served_version = latest.version
+        self.stale = True
+        return latest.build_cache_key
+
+    def on_finish(self):
+        SERVE_REQUEST_DURATION.labels(code=self.get_status()).observe(
+            self.request.request_time()
+        )
+
+    def validate_absolute_path(self, root: str, absolute_path: str):
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        if absolute_path is None:
+            return None
+
+        # Keep hold of the uncompressed path, so that we know the content type
+        self.identity_path = absolute_path
+        accept_encoding = self.request.headers.get("Accept-Encoding")
+
+        if self.manifest is not None:
+            return self.validate_manifest_path(absolute_path, accept_encoding)
+
+        # Serve a pre-compressed sidecar, if the client accepts it and it exists
+        for encoding in acceptable_encodings(accept_encoding):
+            sidecar_path = absolute_path + ENCODING_SUFFIXES[encoding]
+            try:
+                stat_result = os.stat(sidecar_path)
+            except OSError:
+                continue
+
+            self.content_encoding = encoding
+            self._stat_result = stat_result
+            return sidecar_path
+        return absolute_path
+
+    def validate_manifest_path(self, absolute_path: str, accept_encoding: str):
+        """
+        Choose the file to serve using the manifest of the built site, rather than
+        by inspecting the filesystem.
+
+        :param absolute_path: validated path to the uncompressed file.
+        :param accept_encoding: value of the Accept-Encoding header.
+        """
+        site_path = os.path.join(self.root, self.build_cache_key)
+        self.rel_path = Path(os.path.relpath(absolute_path, site_path)).as_posix()
+        if self.rel_path == MANIFEST_NAME:
+            raise HTTPError(404)
+
+        entry = self.manifest.get(self.rel_path)
+        if entry is None:
+            # Not in the manifest. Fall back on the filesystem
+            return absolute_path
+
+        self.identity_entry = self.file_entry = entry
+        for encoding in acceptable_encodings(accept_encoding):
+            if encoding not in entry.encodings:
+                continue
+
+            suffix = ENCODING_SUFFIXES[encoding]
+            self.content_encoding = encoding
+            self.file_entry = self.manifest.get(self.rel_path + suffix)
+            return absolute_path + suffix
+        return absolute_path
+
+    def compute_etag(self):
+        if self.file_entry is None:
+            return super().compute_etag()
+        return f'"{self.file_entry.hash}"'
+
+    def get_content_size(self) -> int:
+        if self.file_entry is None:
+            return super().get_content_size()
+        return self.file_entry.size
+
+    def get_content_type(self) -> str:
+        if self.file_entry is not None:
+            return self.identity_entry.mime_type
+
+        if self.content_encoding is None:
+            return super().get_content_type()
+
+        mime_type, _ = mimetypes.guess_type(self.identity_path)
+        return mime_type or "application/octet-stream"
+
+    def is_immutable(self) -> bool:
+        """
+        Return True if the file being served will never change at this URL.
+
+        The URL of a built site contains the (unresolved) spec, which may move
+        between builds, so only files whose names carry a content hash qualify.
+        """
+        return self.file_entry is not None and bool(
+            self.app.immutable_path_pattern.search(self.rel_path)
+        )
+
+    def get_cache_time(self, path, modified, mime_type) -> int:
+        if self.is_immutable():
+            return self.CACHE_MAX_AGE
+        return super().get_cache_time(path, modified, mime_type)
+
+    def set_extra_headers(self, path: str):
+        self.set_header("Vary", "Accept-Encoding")
+        if self.content_encoding is not None:
+            self.set_header("Content-Encoding", self.content_encoding)
+
+        if self.is_immutable():
+            self.set_header(
+                "Cache-Control", f"public, max-age={self.CACHE_MAX_AGE}, immutable"
+            )
+        elif self.file_entry is not None or self.stale:
+            # Revalidation is cheap (the ETag comes from the manifest), and a stale
+            # site will be replaced once the requested version is built
+            self.set_header("Cache-Control", "no-cache")
+
+        if self.served_version is not None:
+            self.set_header("X-JupyterBook-Pub-Version", self.served_version)
+        if self.stale:
+            self.set_header("X-JupyterBook-Pub-Stale", "1")
+
+
+class MetricsHandler(AppMixin, RequestHandler):
+    """
+    Serve metrics for Prometheus.
+
+    Scrapes are authenticated by the metrics token, rather than by JupyterHub, so
+    that Prometheus needn't log in.
+    """
+
+    def get(self):
+        if self.app.authenticate_metrics:
+            expected = f"Bearer {self.app.metrics_token}"
+            authorization = self.request.headers.get("Authorization", "")
+            if not self.app.metrics_token or not hmac.compare_digest(
+                authorization.encode(), expected.encode()
+            ):
+                raise HTTPError(403, "A valid metrics token is required")
+
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.write(collect_metrics())
+
+
+class SharedAssetHandler(AppMixin, NoXSRFMixin, MaybeAuthenticatedMixin, StaticHandler):
+    """
+    Serve a blob by content hash, under the name of the asset that it stores.
+
+    The URL changes whenever the content does, so responses are cached forever.
+    """
+
+    content_encoding = None
+
+    @maybe_authenticated
+    async def get(self, content_hash: str, name: str, include_body: bool = True):
+        self.content_hash = content_hash
+        self.asset_name = name
+        blob_path = get_blob_path(Path(), content_hash).as_posix()
+        return await super().get(blob_path, include_body=include_body)
+
+    def head(self, content_hash: str, name: str):
+        return self.get(content_hash, name, include_body=False)
+
+    def validate_absolute_path(self, root: str, absolute_path: str):
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        if absolute_path is None:
+            return None
+
+        # Serve a compressed variant, if the client accepts it and it exists
+        accept_encoding = self.request.headers.get("Accept-Encoding")
+        for encoding in acceptable_encodings(accept_encoding):
+            variant_path = absolute_path + ENCODING_SUFFIXES[encoding]
+            try:
+                stat_result = os.stat(variant_path)
+            except OSError:
+                continue
+
+            self.content_encoding = encoding
+            self._stat_result = stat_result
+            return variant_path
+        return absolute_path
+
+    def compute_etag(self):
+        if self.content_encoding is None:
+            return f'"{self.content_hash}"'
+        return f'"{self.content_hash}-{self.content_encoding}"'
+
+    def get_content_type(self) -> str:
+        mime_type, _ = mimetypes.guess_type(self.asset_name)
+        return mime_type or "application/octet-stream"
+
+    def get_cache_time(self, path, modified, mime_type) -> int:
+        return self.CACHE_MAX_AGE
+
+    def set_extra_headers(self, path: str):
+        self.set_header("Vary", "Accept-Encoding")
+        if self.content_encoding is not None:
+            self.set_header("Content-Encoding", self.content_encoding)
+        self.set_header(
+            "Cache-Control", f"public, max-age={self.CACHE_MAX_AGE}, immutable"
+        )
+
 
 class BuildHandler(AppMixin, MaybeAuthenticatedMixin, RequestHandler):
+    def get_next_url(self) -> str:
+        """
+        Return the `?next` URL to redirect to once the build is done.
+
+        It is used in a script as well as in redirects, so it must be a path
+        under the base URL of this app, rather than any URL.
+        """
+        next_url = self.get_argument("next")
+        parsed = urllib.parse.urlsplit(next_url)
+        if (
+            parsed.scheme
+            or parsed.netloc
+            or next_url.startswith("//")
+            or not next_url.startswith(self.app.base_url)
+            # Browsers treat backslashes as slashes, and strip whitespace
+            or any(c == "\\" or c.isspace() or ord(c) < 0x20 for c in next_url)
+        ):
+            raise HTTPError(400, "next must be a path under the base URL")
+        return next_url
+
     @maybe_authenticated
+    @tracer.start_as_current_span("build request")
     async def get(self):
-        storage_path = Path(self.app.storage_root)
-
-        root_build_path = storage_path / BUILT_SITES_NAME
+        root_build_path = Path(self.app.storage_root) / BUILT_SITES_NAME
         root_build_path.mkdir(exist_ok=True)
 
-        repos_root_path = storage_path / REPOS_NAME
-
         spec = self.get_argument("spec")
-        next_url = self.get_argument("next")
-        raw_spec = urllib.parse.quote(spec, safe="")
+        next_url = self.get_next_url()
 
         last_answer = await self.app.resolve(spec)
         if last_answer is None:
@@ -166,32 +504,83 @@ class BuildHandler(AppMixin, MaybeAuthenticatedMixin, RequestHandler):
 
                 # If directly invoked, build path may exist
                 if build_path.exists():
-                    self.redirect(next_url)
-
-                # Find the source content
-                repo_path = repos_root_path / make_checkout_cache_key(repo)
-                if not repo_path.exists():
-                    # First, fetch the repo
-                    self.log.info(f"Fetching {repo}...\n")
-                    await fetch(repo, repo_path)
-                    self.log.info(f"Fetched {repo}")
-
-                # Define BASE_URL for the resolved path
-                base_url = url_path_join(self.app.base_url, "repo", raw_spec)
-                async with (
-                    # Limit build duration
-                    asyncio.timeout(self.app.build_timeout_seconds),
-                    # Limit concurrent builds
-                    self.app._build_semaphore,
-                ):
-                    await self.app.executor.execute(repo_path, build_path, base_url)
-
-                # Sweep the storage
-                self.app.built_sites_storage_manager.notify_of_build()
-                self.app.repos_storage_manager.notify_of_build()
-
-                # Redirect to `?next`
-                return self.redirect(next_url)
+                    return self.redirect(next_url)
+
+                try:
+                    job = await self.app.submit_build(
+                        repo, spec, client=self.get_client_id()
+                    )
+                except QueueFullError as err:
+                    # Set headers directly, as send_error would clear Retry-After
+                    self.set_status(503)
+                    self.set_header(
+                        "Retry-After", self.app.build_queue.retry_after_seconds
+                    )
+                    self.finish(f"{err}. Please try again later.")
+                    return
+
+                # Let the client poll for the job, and redirect to `?next` when done
+                config = {
+                    "title": self.app.site_title,
+                    "spec": spec,
+                    "next": next_url,
+                    "statusUrl": self.reverse_url("build-status-api", job.id),
+                }
+                self.write(
+                    self.app.templates_loader.get_template("build.html").render(
+                        config=config
+                    )
+                )
+
+
+class PushWebhookHandler(AppMixin, NoXSRFMixin, RequestHandler):
+    """
+    Receive push webhooks from git forges, and prebuild the pushed refs.
+
+    Deliveries are authenticated by the webhook secret, rather than by JupyterHub.
+    """
+
+    async def post(self):
+        if not self.app.webhook_secret:
+            raise HTTPError(404)
+
+        if not verify_signature(
+            self.request.headers, self.request.body, self.app.webhook_secret
+        ):
+            WEBHOOK_DELIVERIES.labels(result="unauthorized").inc()
+            raise HTTPError(403, "Invalid webhook signature")
+
+        try:
+            payload = json.loads(self.request.body)
+        except ValueError:
+            WEBHOOK_DELIVERIES.labels(result="invalid").inc()
+            raise HTTPError(400, "Webhook payload must be JSON")
+
+        event = parse_push(payload)
+        if event is None:
+            WEBHOOK_DELIVERIES.labels(result="ignored").inc()
+            self.write({"status": "ignored"})
+            return
+
+        question = get_push_question(event)
+        debounced = self.app.schedule_prebuild(question)
+        WEBHOOK_DELIVERIES.labels(
+            result="debounced" if debounced else "scheduled"
+        ).inc()
+        self.set_status(202)
+        self.write({"status": "scheduled", "spec": question})
+
+
+class BuildStatusHandler(AppMixin, MaybeAuthenticatedMixin, RequestHandler):
+    @maybe_authenticated
+    async def get(self, job_id: str):
+        status = await self.app.build_queue.get_job_status(job_id)
+        if status is None:
+            raise HTTPError(404, f"No such build {job_id}")
+
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", "no-store")
+        self.write(status)
 
 
 class ResolveHandler(AppMixin, MaybeAuthenticatedMixin, RequestHandler):
@@ -227,8 +616,51 @@ class JupyterBookPubApp(Application):
     debug = Bool(help="Turn on debug mode", config=True)
 
     port = Int(9200, help="Port to listen on", config=True)
+
+    num_processes = Integer(
+        1,
+        help="""
+        Number of processes to serve with (0 for one per CPU). Each process listens
+        on the port with SO_REUSEPORT, so that the kernel spreads connections
+        between them, and builds are coordinated between processes with lock
+        files under the storage root.
+
+        Each process has its own in-memory caches and metrics, so enabling
+        `resolver_cache_persist` is recommended, as is setting the
+        PROMETHEUS_MULTIPROC_DIR environment variable to an empty directory, so
+        that /metrics reports the metrics of all processes.
+        """,
+        config=True,
+    )
+
     base_url = Unicode("/", help="The base URL of the entire application", config=True)
 
+    trust_proxy_headers = Bool(
+        False,
+        help="""
+        Take the address of clients from the X-Real-Ip or X-Forwarded-For headers
+        set by a reverse proxy (e.g. JupyterHub's proxy), so that anonymous clients
+        are told apart when scheduling builds. Only enable this if the app can't
+        be reached except through the proxy, as clients can set these headers.
+        """,
+        config=True,
+    )
+
+    trace_output = Unicode(
+        help=f"""
+        File to append trace spans to as JSON lines, or "-" for stdout. Empty to
+        disable tracing. Builders run as local processes inherit this setting if
+        it is a file.
+
+        Defaults to the value of the {TRACE_OUTPUT_ENV} environment variable.
+        """,
+        config=True,
+    )
+
+    @default("trace_output")
+    def _default_trace_output(self):
+        return os.environ.get(TRACE_OUTPUT_ENV, "")
+
     @validate("base_url")
     def _valid_base_url(self, proposal):
         if not proposal.value.startswith("/"):
@@ -246,6 +678,82 @@ class JupyterBookPubApp(Application):
     def _default_hub_token(self):
         return os.environ.get("JUPYTERHUB_API_TOKEN", "")
 
+    cookie_secret = Bytes(
+        help="""
+        Secret used to sign cookies (e.g. the JupyterHub login). Random if empty,
+        in which case logins do not survive a restart.
+
+        Defaults to the hex-encoded value of the JUPYTERBOOK_PUB_COOKIE_SECRET
+        environment variable.
+        """,
+        config=True,
+    )
+
+    @default("cookie_secret")
+    def _default_cookie_secret(self):
+        secret = os.environ.get("JUPYTERBOOK_PUB_COOKIE_SECRET")
+        if secret:
+            return bytes.fromhex(secret)
+        return secrets.token_bytes(32)
+
+    webhook_secret = Unicode(
+        help="""
+        Secret shared with git forges for push webhooks, which prebuild the pushed
+        refs at /api/v1/webhooks/push. Webhooks are disabled if empty.
+
+        Defaults to the value of the JUPYTERBOOK_PUB_WEBHOOK_SECRET environment
+        variable.
+        """,
+        config=True,
+    )
+
+    @default("webhook_secret")
+    def _default_webhook_secret(self):
+        return os.environ.get("JUPYTERBOOK_PUB_WEBHOOK_SECRET", "")
+
+    authenticate_metrics = Bool(
+        True,
+        help="""
+        Require the metrics token (see `metrics_token`) to read /metrics. Disable
+        only if /metrics cannot be reached by the public.
+        """,
+        config=True,
+    )
+
+    metrics_token = Unicode(
+        help="""
+        Token that Prometheus sends (as `Authorization: Bearer <token>`) to read
+        /metrics. Metrics cannot be read if empty, unless `authenticate_metrics`
+        is disabled.
+
+        Defaults to the value of the JUPYTERBOOK_PUB_METRICS_TOKEN environment
+        variable.
+        """,
+        config=True,
+    )
+
+    @default("metrics_token")
+    def _default_metrics_token(self):
+        return os.environ.get("JUPYTERBOOK_PUB_METRICS_TOKEN", "")
+
+    webhook_debounce_seconds = Integer(
+        10,
+        help="""
+        How long to wait after a push before prebuilding it (in seconds). Further
+        pushes of the same ref restart the wait, so that a burst of pushes builds
+        only the last commit.
+        """,
+        config=True,
+    )
+
+    # Prebuilds waiting out their debounce period, by question
+    _prebuilds = Dict(
+        key_trait=Unicode(),
+        value_trait=Instance(asyncio.TimerHandle),
+    )
+    # Prebuilds that are resolving and submitting their build
+    _prebuild_tasks = Instance(klass=set, args=())
+
     storage_root = Unicode(
         "persistent",
         help="Path to use for artifact (sites, repos) storage",
@@ -262,7 +770,123 @@ class JupyterBookPubApp(Application):
         128, help="Max number of successful resolver results to cache", config=True
     )
 
-    resolver_cache = Instance(klass=TTLCache)
+    resolver_cache = Instance(klass=TLRUCache)
+
+    resolver_cache_persist = Bool(
+        False,
+        help="""
+        Persist successful resolver results in an SQLite database under the storage
+        root, so that they survive restarts and are shared between processes.
+        """,
+        config=True,
+    )
+
+    persistent_resolver_cache = Instance(klass=PersistentResolverCache, allow_none=True)
+
+    resolver_negative_cache_ttl_seconds = Integer(
+        30,
+        help="How long to cache questions that could not be resolved (in seconds)",
+        config=True,
+    )
+
+    resolver_negative_cache_max_size = Integer(
+        1024,
+        help="Max number of unresolvable questions to cache",
+        config=True,
+    )
+
+    resolver_negative_cache = Instance(klass=TTLCache)
+
+    resolver_refresh_ahead_seconds = Integer(
+        60,
+        help="""
+        How long before expiry to re-resolve popular resolver results in the
+        background (in seconds). Set to 0 to disable refresh-ahead.
+        """,
+        config=True,
+    )
+
+    resolver_refresh_min_hits = Integer(
+        10,
+        help="""
+        Number of cache hits (since it was last resolved) after which a resolver
+        result is considered popular enough to refresh ahead of expiry
+        """,
+        config=True,
+    )
+
+    # Counts of resolver cache outcomes (hit, miss, negative_hit, persistent_hit,
+    # coalesced, refresh, refresh_failed)
+    resolver_stats = Instance(klass=collections.Counter, args=())
+
+    # In-flight resolutions, shared by concurrent requests for the same question
+    _resolutions = Dict(
+        key_trait=Unicode(),
+        value_trait=Instance(asyncio.Future),
+    )
+
+    stale_while_revalidate = Bool(
+        False,
+        help="""
+        When the requested version of a repository (e.g. a new commit on a branch)
+        has not been built, serve the latest successful build of the repository
+        while the requested version is built in the background, rather than
+        making the reader wait for the build.
+        """,
+        config=True,
+    )
+
+    latest_builds = Instance(klass=LatestBuildIndex, allow_none=True)
+
+    revalidation_failure_backoff_seconds = Integer(
+        5 * 60,
+        help="""
+        How long to wait after a background build (see `stale_while_revalidate`)
+        fails before trying it again (in seconds)
+        """,
+        config=True,
+    )
+
+    # Latest background build of each requested version, by rendered cache key
+    revalidations = Instance(klass=LRUCache)
+
+    manifest_cache_max_size = Integer(
+        256, help="Max number of built site manifests to keep in memory", config=True
+    )
+
+    manifest_cache = Instance(klass=LRUCache)
+
+    immutable_path_regex = Unicode(
+        r"^build/.+[-.][A-Za-z0-9_]{8,}\.\w+$",
+        help="""
+        Regular expression matching paths (relative to the built site) whose names
+        contain a content hash. These are served with immutable caching headers.
+        """,
+        config=True,
+    )
+
+    immutable_path_pattern = Instance(klass=re.Pattern)
+
+    @default("immutable_path_pattern")
+    def _default_immutable_path_pattern(self):
+        return re.compile(self.immutable_path_regex)
+
+    @observe("immutable_path_regex")
+    def _observe_immutable_path_regex(self, change):
+        self.immutable_path_pattern = re.compile(change["new"])
+
+    shared_assets = Bool(
+        False,
+        help="""
+        Rewrite references to common assets (stylesheets, fonts, images) in built
+        sites to shared, content-addressed URLs, so that browsers fetch them once
+        for all sites. Only applies to sites built after this is enabled.
+
+        Requires the executor to deduplicate built files, e.g.
+        `c.LocalProcessExecutor.deduplicate = True`.
+        """,
+        config=True,
+    )
 
     site_title = Unicode("JupyterBook.pub", help="Title of the website", config=True)
 
@@ -279,9 +903,25 @@ class JupyterBookPubApp(Application):
     built_sites_max_age_hours = Integer(
         24, config=True, help="Max age of built site in hours before it is removed"
     )
+    built_sites_max_bytes = Integer(
+        0,
+        config=True,
+        help="""
+        Maximum total size of built sites in bytes (0 for no limit).
+
+        When set, the least recently served sites are removed first once the limit
+        is exceeded, and `built_sites_max_age_hours` applies to the time since a
+        site was last served rather than since it was built.
+        """,
+    )
     repos_max_age_hours = Integer(
         12, config=True, help="Max age of downloaded repo in hours before it is removed"
     )
+    build_caches_max_age_hours = Integer(
+        7 * 24,
+        config=True,
+        help="Max age of an unused repository build cache in hours before it is removed",
+    )
     build_timeout_seconds = Integer(
         5 * 60, config=True, help="Max age of build in seconds before it is cancelled"
     )
@@ -302,7 +942,7 @@ class JupyterBookPubApp(Application):
     max_concurrent_builds = Integer(
         4, config=True, help="Maximum number of concurrent builds"
     )
-    _build_semaphore = Instance(asyncio.Semaphore)
+    build_queue = Instance(klass=BuildQueue)
 
     storage_manager_class = Type(
         StorageManager,
@@ -312,6 +952,7 @@ class JupyterBookPubApp(Application):
     )
     built_sites_storage_manager = Instance(klass=StorageManager)
     repos_storage_manager = Instance(klass=StorageManager)
+    build_caches_storage_manager = Instance(klass=StorageManager)
 
     config_file = Unicode(
         "jupyterbook_pub_config.py", help="The config file to load", config=True
@@ -319,6 +960,7 @@ class JupyterBookPubApp(Application):
     aliases = Dict(
         {
             "port": "JupyterBookPubApp.port",
+            "processes": "JupyterBookPubApp.num_processes",
             "config": "JupyterBookPubApp.config_file",
             "executor": "JupyterBookPubApp.executor_class",
             "storage": "JupyterBookPubApp.storage_root",
@@ -340,9 +982,13 @@ class JupyterBookPubApp(Application):
 
     @validate(
         "built_sites_max_age_hours",
+        "built_sites_max_bytes",
         "repos_max_age_hours",
+        "build_caches_max_age_hours",
         "storage_sweep_interval",
         "build_timeout_seconds",
+        "webhook_debounce_seconds",
+        "num_processes",
         "max_concurrent_builds",
     )
     def _validate_ages(self, proposal):
@@ -359,19 +1005,353 @@ class JupyterBookPubApp(Application):
         if debug:
             self.log_level = logging.DEBUG
 
+    def count_resolution(self, result: str):
+        self.resolver_stats[result] += 1
+        RESOLVER_LOOKUPS.labels(result=result).inc()
+
+        # Background refreshes outlive the span that started them
+        span = trace.get_current_span()
+        if span.is_recording():
+            span.set_attribute("jupyterbook_pub.resolution", result)
+
+    @tracer.start_as_current_span("resolve")
     async def resolve(self, question: str):
+        trace.get_current_span().set_attribute("jupyterbook_pub.question", question)
         if question in self.resolver_cache:
-            last_answer = self.resolver_cache[question]
+            self.count_resolution("hit")
             self.log.debug(f"Found {question} in cache")
+
+            entry = self.resolver_cache[question]
+            entry.hits += 1
+            if self.should_refresh(question, entry):
+                self.refresh(question)
+            return entry.answer
+
+        if question in self.resolver_negative_cache:
+            self.count_resolution("negative_hit")
+            self.log.debug(f"Found {question} in negative cache")
+            return self.resolver_negative_cache[question]
+
+        # Share a single resolution between concurrent requests
+        try:
+            resolution = self._resolutions[question]
+        except KeyError:
+            self.count_resolution("miss")
+            resolution = self._start_resolution(
+                question, self.resolve_uncached(question)
+            )
         else:
+            self.count_resolution("coalesced")
+            self.log.debug(f"Waiting for in-flight resolution of {question}")
+
+        # Don't let one cancelled request cancel the resolution for everyone else
+        return await asyncio.shield(resolution)
+
+    async def resolve_uncached(self, question: str):
+        """
+        Resolve a question against upstream providers, and cache the answer.
+
+        Unresolvable questions are cached separately, with a shorter TTL.
+
+        :param question: question to resolve.
+        """
+        # Another process may have already resolved this question
+        if self.persistent_resolver_cache is not None:
+            entry = await asyncio.to_thread(
+                self.persistent_resolver_cache.get, question
+            )
+            if entry is not None:
+                self.count_resolution("persistent_hit")
+                self.log.debug(f"Found {question} in persistent cache")
+                self.resolver_cache[question] = entry
+                return entry.answer
+
+        return await self.resolve_upstream(question)
+
+    async def resolve_upstream(self, question: str, *, cache: bool = True):
+        """
+        Resolve a question against upstream providers, and cache the answer.
+
+        :param question: question to resolve.
+        :param cache: whether to cache the answer.
+        """
+        with RESOLVE_DURATION.time():
             answers = await resolve(question, True)
-            if not answers:
-                return None
-            last_answer = answers[-1]
-            self.resolver_cache[question] = last_answer
-            self.log.info(f"Resolved {question} to {last_answer}")
+        last_answer = answers[-1] if answers else None
+
+        if cache:
+            await self.cache_answer(question, last_answer)
         return last_answer
 
+    async def cache_answer(self, question: str, answer):
+        """
+        Cache the answer to a question, resolved against upstream providers.
+
+        :param question: resolved question.
+        :param answer: last answer from upstream providers, or None if there was none.
+        """
+        match answer:
+            case Exists() | MaybeExists():
+                entry = ResolverCacheEntry(answer=answer, resolved_at=time.time())
+                self.resolver_cache[question] = entry
+                self.log.info(f"Resolved {question} to {answer}")
+
+                if self.persistent_resolver_cache is not None:
+                    await asyncio.to_thread(
+                        self.persistent_resolver_cache.set, question, entry
+                    )
+            case None | DoesNotExist():
+                self.resolver_negative_cache[question] = answer
+                self.log.info(f"Could not resolve {question}")
+
+    def should_refresh(self, question: str, entry: ResolverCacheEntry) -> bool:
+        """
+        Return True if a cached answer is popular enough, and close enough to
+        expiry, that it should be re-resolved in the background.
+
+        :param question: cached question.
+        :param entry: cached answer.
+        """
+        if self.resolver_refresh_ahead_seconds <= 0:
+            return False
+
+        refresh_at = (
+            entry.resolved_at
+            + self.resolver_cache_ttl_seconds
+            - self.resolver_refresh_ahead_seconds
+        )
+        return (
+            entry.hits >= self.resolver_refresh_min_hits
+            and time.time() >= refresh_at
+            and question not in self._resolutions
+        )
+
+    def refresh(self, question: str):
+        """
+        Re-resolve a cached question in the background, replacing the cached answer.
+
+        :param question: question to re-resolve.
+        """
+        previous_entry = self.resolver_cache.get(question)
+
+        async def refresh_entry():
+            try:
+                answer = await self.resolve_upstream(question)
+            except Exception:
+                self.count_resolution("refresh_failed")
+                self.log.exception(f"Failed to refresh {question}")
+                raise
+
+            self.count_resolution("refresh")
+            entry = self.resolver_cache.get(question)
+            if previous_entry is not None and entry is not None:
+                entry.refreshes = previous_entry.refreshes + 1
+            return answer
+
+        self.log.debug(f"Refreshing {question} ahead of expiry")
+        self._start_resolution(question, refresh_entry())
+
+    def _start_resolution(self, question: str, coro) -> asyncio.Future:
+        resolution = self._resolutions[question] = asyncio.ensure_future(coro)
+        resolution.add_done_callback(lambda f: self._on_resolution_done(question, f))
+        return resolution
+
+    def _on_resolution_done(self, question: str, resolution: asyncio.Future):
+        self._resolutions.pop(question, None)
+
+        # Mark any exception as retrieved, in case every waiter was cancelled
+        if not resolution.cancelled():
+            resolution.exception()
+
+    async def invalidate_resolutions(self, repo) -> list[str]:
+        """
+        Remove cached answers that resolve to other versions of a repository, as
+        they may be outdated. Return the questions whose answers were removed.
+
+        :param repo: repository at its current version.
+        """
+        repo_key = make_repo_cache_key(repo)
+
+        def is_outdated(entry: ResolverCacheEntry) -> bool:
+            return (
+                entry.answer.repo != repo
+                and make_repo_cache_key(entry.answer.repo) == repo_key
+            )
+
+        questions = {
+            question
+            for question, entry in list(self.resolver_cache.items())
+            if is_outdated(entry)
+        }
+        for question in questions:
+            self.resolver_cache.pop(question, None)
+
+        # Other processes may have cached answers that we have not seen
+        if self.persistent_resolver_cache is not None:
+            entries = await asyncio.to_thread(self.persistent_resolver_cache.load)
+            persisted = [
+                question for question, entry in entries.items() if is_outdated(entry)
+            ]
+            if persisted:
+                await asyncio.to_thread(
+                    self.persistent_resolver_cache.delete, persisted
+                )
+            questions.update(persisted)
+        return sorted(questions)
+
+    def schedule_prebuild(self, question: str) -> bool:
+        """
+        Prebuild the answer to a question once `webhook_debounce_seconds` have
+        passed without it being scheduled again.
+
+        Return True if this replaced a prebuild that was already scheduled.
+
+        :param question: question to resolve and build.
+        """
+        previous = self._prebuilds.pop(question, None)
+        if previous is not None:
+            previous.cancel()
+
+        self._prebuilds[question] = asyncio.get_running_loop().call_later(
+            self.webhook_debounce_seconds, self._start_prebuild, question
+        )
+        return previous is not None
+
+    def _start_prebuild(self, question: str):
+        del self._prebuilds[question]
+        task = asyncio.ensure_future(self.prebuild(question))
+        self._prebuild_tasks.add(task)
+        task.add_done_callback(self._prebuild_tasks.discard)
+
+    async def prebuild(self, question: str):
+        """
+        Resolve a question against upstream providers, bypassing the cache, and
+        build the answer at low priority. Once it is built, cache the answer, and
+        invalidate cached answers that resolve to other versions of the repository.
+
+        :param question: question to resolve and build.
+        """
+        try:
+            # Readers asking the same question would otherwise be sent to wait for
+            # the build (or to a build that fails)
+            answer = await self.resolve_upstream(question, cache=False)
+        except Exception:
+            self.log.exception(f"Failed to resolve {question} for prebuild")
+            return
+
+        match answer:
+            case Exists(repo) | MaybeExists(repo):
+                try:
+                    job = await self.submit_build(
+                        repo,
+                        question,
+                        client="webhook",
+                        priority=BuildPriority.prebuild,
+                    )
+                except QueueFullError:
+                    self.log.warning(f"Could not queue prebuild of {repo}")
+                    return
+                self.log.info(f"Prebuilding {repo} in job {job.id}")
+
+                await job.finished.wait()
+                if job.state != BuildState.done:
+                    self.log.warning(f"Prebuild of {repo} failed: {job.error}")
+                    return
+
+                # Readers will otherwise be served the previous version until their
+                # cached answers expire. Only now that it is built, so that they are
+                # not sent to wait for the build
+                await self.cache_answer(question, answer)
+                invalidated = await self.invalidate_resolutions(repo)
+                self.log.debug(f"Invalidated cached answers for {invalidated}")
+            case _:
+                self.log.warning(f"Could not resolve {question} for prebuild")
+
+    def get_manifest(self, site_path: Path) -> Manifest | None:
+        """
+        Return the manifest of a built site, or None if it does not have one.
+
+        :param site_path: path to built site.
+        """
+        try:
+            mtime = (site_path / MANIFEST_NAME).stat().st_mtime_ns
+        except OSError:
+            return None
+
+        # Guard against a site being removed and rebuilt under the same key
+        match self.manifest_cache.get(site_path):
+            case (cached_mtime, manifest) if cached_mtime == mtime:
+                return manifest
+
+        manifest = read_manifest(site_path)
+        if manifest is not None:
+            self.manifest_cache[site_path] = (mtime, manifest)
+        return manifest
+
+    async def submit_build(
+        self,
+        repo,
+        spec: str,
+        *,
+        client: str,
+        priority: BuildPriority = BuildPriority.interactive,
+    ) -> BuildJob:
+        """
+        Submit a build of a repository, returning the job that will perform it.
+
+        Raise QueueFullError if the build cannot be queued.
+
+        :param repo: repository to build.
+        :param spec: spec that the repository was resolved from.
+        :param client: identity of the submitting client.
+        :param priority: priority of the build.
+        """
+        storage_path = Path(self.storage_root)
+        build_path = (
+            storage_path
+            / BUILT_SITES_NAME
+            / make_rendered_cache_key(repo, self.base_url)
+        )
+
+        # Find the source content
+        repo_path = storage_path / REPOS_NAME / make_checkout_cache_key(repo)
+
+        # Builds of other versions of the same repo share a cache directory
+        cache_path = (
+            storage_path
+            / BUILD_CACHES_NAME
+            / make_repo_cache_key(repo)
+            / make_checkout_cache_key(repo)
+        )
+
+        # Define BASE_URL for the resolved path
+        raw_spec = urllib.parse.quote(spec, safe="")
+        base_url = url_path_join(self.base_url, "repo", raw_spec)
+        return await self.build_queue.submit(
+            repo,
+            repo_path,
+            build_path,
+            base_url,
+            cache_path=cache_path,
+            client=client,
+            priority=priority,
+        )
+
+    @property
+    def is_multiprocess(self) -> bool:
+        return self.num_processes != 1
+
+    def get_lock_path(self, name: str) -> str | None:
+        """
+        Return the path to a lock shared between processes, or None if this is the
+        only process.
+
+        :param name: name of lock.
+        """
+        if not self.is_multiprocess:
+            return None
+        return str(Path(self.storage_root) / LOCKS_NAME / name)
+
     def ensure_storage(self):
         # Ensure storage
         storage_path = Path(self.storage_root)
@@ -383,16 +1363,33 @@ class JupyterBookPubApp(Application):
         repos_path = storage_path / REPOS_NAME
         repos_path.mkdir(exist_ok=True)
 
+        build_caches_path = storage_path / BUILD_CACHES_NAME
+        build_caches_path.mkdir(exist_ok=True)
+
+        blobs_path = storage_path / BLOBS_NAME
+        blobs_path.mkdir(exist_ok=True)
+
         self.built_sites_storage_manager = self.storage_manager_class(
             parent=self,
             max_age_hours=self.built_sites_max_age_hours,
+            max_bytes=self.built_sites_max_bytes,
             storage_root=str(built_sites_path),
+            lock_path=self.get_lock_path(f"sweep-{BUILT_SITES_NAME}.lock"),
+            blobs_path=str(blobs_path),
             build_interval=self.storage_sweep_interval,
         )
         self.repos_storage_manager = self.storage_manager_class(
             parent=self,
             max_age_hours=self.repos_max_age_hours,
             storage_root=str(repos_path),
+            lock_path=self.get_lock_path(f"sweep-{REPOS_NAME}.lock"),
+            build_interval=self.storage_sweep_interval,
+        )
+        self.build_caches_storage_manager = self.storage_manager_class(
+            parent=self,
+            max_age_hours=self.build_caches_max_age_hours,
+            storage_root=str(build_caches_path),
+            lock_path=self.get_lock_path(f"sweep-{BUILD_CACHES_NAME}.lock"),
             build_interval=self.storage_sweep_interval,
         )
 
@@ -409,30 +1406,130 @@ class JupyterBookPubApp(Application):
         tornado.log.enable_pretty_logging()
         self.log = tornado.log.app_log
 
+        if self.is_multiprocess:
+            # Every process must sign cookies with the same secret, so choose it
+            # before forking
+            self.cookie_secret
+
+            if not is_multiprocess_metrics():
+                self.log.warning(
+                    f"{MULTIPROC_DIR_ENV} is not set, so /metrics will only report "
+                    "the metrics of the process that serves it"
+                )
+
+            # Fork before opening databases or starting threads, which can't be
+            # shared with forked processes. The parent supervises its children, and
+            # never returns
+            fork_processes(self.num_processes)
+            self.log.info(f"Started worker process {task_id()}")
+
+        if self.trace_output:
+            trace_output = self.trace_output
+            if trace_output != "-":
+                trace_output = os.path.abspath(trace_output)
+            setup_tracing(trace_output, self.name)
+            # Local builder processes inherit our environment. Their stdout is
+            # captured as the build log, so they only inherit file outputs
+            if trace_output == "-":
+                os.environ.pop(TRACE_OUTPUT_ENV, None)
+            else:
+                os.environ[TRACE_OUTPUT_ENV] = trace_output
+
         self.templates_loader = Environment(
             loader=FileSystemLoader(Path(__file__).parent / "templates")
         )
 
         self.ensure_storage()
 
-        self.resolver_cache = TTLCache(
-            maxsize=self.resolver_cache_max_size, ttl=10 * 60
+        # Entries expire relative to when they were resolved upstream, which may
+        # predate this process if they were loaded from the persistent cache
+        self.resolver_cache = TLRUCache(
+            maxsize=self.resolver_cache_max_size,
+            ttu=lambda _, entry, __: (
+                entry.resolved_at + self.resolver_cache_ttl_seconds
+            ),
+            timer=time.time,
+        )
+        if self.resolver_cache_persist:
+            self.persistent_resolver_cache = PersistentResolverCache(
+                parent=self,
+                path=str(Path(self.storage_root) / RESOLVER_CACHE_NAME),
+                ttl_seconds=self.resolver_cache_ttl_seconds,
+                max_size=self.resolver_cache_max_size,
+            )
+            # Warm the in-memory cache
+            self.resolver_cache.update(self.persistent_resolver_cache.load())
+            self.log.info(
+                f"Loaded {len(self.resolver_cache)} resolver results from persistent cache"
+            )
+        self.resolver_negative_cache = TTLCache(
+            maxsize=self.resolver_negative_cache_max_size,
+            ttl=self.resolver_negative_cache_ttl_seconds,
         )
 
+        self.manifest_cache = LRUCache(maxsize=self.manifest_cache_max_size)
+        self.revalidations = LRUCache(maxsize=1024)
+
         self.executor = self.executor_class(
             parent=self,
             storage_root=self.storage_root,
         )
-
-        self._build_semaphore = asyncio.Semaphore(self.max_concurrent_builds)
+        if self.shared_assets and self.executor.has_trait("shared_assets_url"):
+            self.executor.shared_assets_url = url_path_join(self.base_url, "assets/")
+            if not self.executor.deduplicate:
+                self.log.warning(
+                    "shared_assets is enabled, but the executor does not deduplicate"
+                    " built files, so assets will not be shared"
+                )
+
+        if self.stale_while_revalidate:
+            self.latest_builds = LatestBuildIndex(
+                parent=self, path=str(Path(self.storage_root) / LATEST_BUILDS_NAME)
+            )
+
+        # Jobs may be polled for at any process
+        status_path = None
+        if self.is_multiprocess:
+            status_path = str(Path(self.storage_root) / BUILD_STATUSES_NAME)
+            os.makedirs(status_path, exist_ok=True)
+
+        self.build_queue = BuildQueue(
+            parent=self,
+            executor=self.executor,
+            storage_managers=[
+                self.built_sites_storage_manager,
+                self.repos_storage_manager,
+                self.build_caches_storage_manager,
+            ],
+            latest_builds=self.latest_builds,
+            lock_path=self.get_lock_path("builds"),
+            status_path=status_path,
+            max_concurrent_builds=self.max_concurrent_builds,
+            build_timeout_seconds=self.build_timeout_seconds,
+        )
 
     async def launch(self) -> None:
+        self.executor.start()
+        self.build_queue.start()
+        for storage_manager in (
+            self.built_sites_storage_manager,
+            self.repos_storage_manager,
+            self.build_caches_storage_manager,
+        ):
+            storage_manager.start()
+
         self.web_app = tornado.web.Application(
             [
                 url(
                     url_path_join(self.base_url, "oauth_callback"),
                     HubOAuthCallbackHandler,
                 ),
+                url(
+                    url_path_join(self.base_url, r"metrics"),
+                    MetricsHandler,
+                    {"app": self},
+                    name="metrics",
+                ),
                 url(
                     url_path_join(self.base_url, r"api/v1/resolve"),
                     ResolveHandler,
@@ -444,17 +1541,40 @@ class JupyterBookPubApp(Application):
                     BuiltRepoHandler,
                     {
                         "app": self,
-                        "path": str(Path(self.storage_root) / BUILT_SITES_NAME),
+                        "path": os.path.realpath(
+                            Path(self.storage_root) / BUILT_SITES_NAME
+                        ),
                         "default_filename": "index.html",
                     },
                     name="render-repo",
                 ),
+                url(
+                    url_path_join(self.base_url, r"assets/([0-9a-f]{64})/([^/]+)"),
+                    SharedAssetHandler,
+                    {
+                        "app": self,
+                        "path": os.path.realpath(Path(self.storage_root) / BLOBS_NAME),
+                    },
+                    name="shared-asset",
+                ),
                 url(
                     url_path_join(self.base_url, r"build"),
                     BuildHandler,
                     {"app": self},
                     name="build-repo",
                 ),
+                url(
+                    url_path_join(self.base_url, r"api/v1/webhooks/push"),
+                    PushWebhookHandler,
+                    {"app": self},
+                    name="push-webhook-api",
+                ),
+                url(
+                    url_path_join(self.base_url, r"api/v1/builds/([0-9a-f]+)"),
+                    BuildStatusHandler,
+                    {"app": self},
+                    name="build-status-api",
+                ),
                 url(
                     self.base_url,
                     IndexHandler,
@@ -471,10 +1591,17 @@ class JupyterBookPubApp(Application):
                 ),
             ],
             debug=self.debug,
-            cookie_secret=secrets.token_bytes(32),
+            cookie_secret=self.cookie_secret,
+        )
+        self.web_app.listen(
+            self.port,
+            xheaders=self.trust_proxy_headers,
+            reuse_port=self.is_multiprocess,
         )
-        self.web_app.listen(self.port)
-        await asyncio.Event().wait()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.executor.stop()
 
     def start(self):
         asyncio.run(self.launch())
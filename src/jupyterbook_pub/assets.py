@@ -0,0 +1,255 @@
+"""
+Shared URLs for assets that are common to many built sites.
+
+Every site serves its theme stylesheets, fonts and images under its own URL, so
+browsers and caches fetch them again for every site. When enabled, references to
+such assets in a built site are rewritten to a shared, content-addressed URL
+(`<assets_url><hash>/<name>`), which is served from the blob store and can be
+cached forever.
+
+Only assets that make no relative references of their own can be moved to a
+shared URL. JavaScript is not shared by default, because modules are
+instantiated once per URL, and chunks are imported relative to one another.
+"""
+
+import os
+import posixpath
+import re
+import secrets
+import urllib.parse
+from pathlib import Path
+from typing import Iterable, Optional
+
+from .blobs import compress_blob, get_blob_path, store_blob
+from .compression import DEFAULT_PRECOMPRESS_SUFFIXES
+from .manifest import hash_file
+
+DEFAULT_SHARED_ASSET_SUFFIXES = (
+    ".css",
+    ".woff",
+    ".woff2",
+    ".ttf",
+    ".otf",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".webp",
+    ".ico",
+    ".svg",
+)
+
+# href="..." or src="..." attributes in HTML
+HTML_REFERENCE_PATTERN = re.compile(
+    r"""\b(?:href|src)\s*=\s*(?P<quote>["'])(?P<ref>[^"'<>]*)(?P=quote)""",
+    re.IGNORECASE,
+)
+# url(...) functions in CSS
+CSS_URL_PATTERN = re.compile(
+    r"""\burl\(\s*(?P<quote>["']?)(?P<ref>[^"')]*)(?P=quote)\s*\)""",
+    re.IGNORECASE,
+)
+# @import "..." rules in CSS
+CSS_IMPORT_PATTERN = re.compile(
+    r"""@import\s+(?P<quote>["'])(?P<ref>[^"']*)(?P=quote)"""
+)
+
+
+def resolve_reference(ref: str, source_rel_path: str, base_url: str) -> Optional[str]:
+    """
+    Return the path (relative to the site root) of the site file that a reference
+    refers to, or None if it does not refer to a site file.
+
+    :param ref: reference (e.g. URL in an attribute).
+    :param source_rel_path: path of the referencing file, relative to the site root.
+    :param base_url: base URL of the built site.
+    """
+    parsed = urllib.parse.urlsplit(ref)
+    if parsed.scheme or parsed.netloc or not parsed.path:
+        return None
+
+    # The base URL is compared before unquoting, as it may itself be quoted
+    path = parsed.path
+    if path.startswith("/"):
+        if not path.startswith(base_url):
+            return None
+        rel_path = urllib.parse.unquote(path[len(base_url) :])
+    else:
+        rel_path = posixpath.join(
+            posixpath.dirname(source_rel_path), urllib.parse.unquote(path)
+        )
+
+    rel_path = posixpath.normpath(rel_path)
+    if rel_path.startswith("../") or rel_path in (".", ".."):
+        return None
+    return rel_path
+
+
+def is_relative_reference(ref: str) -> bool:
+    """
+    Return True if a reference is resolved relative to the referencing file.
+
+    :param ref: reference (e.g. URL in an attribute).
+    """
+    parsed = urllib.parse.urlsplit(ref)
+    return not (
+        parsed.scheme or parsed.netloc or parsed.path.startswith("/") or not parsed.path
+    )
+
+
+def rewrite_references(
+    text: str,
+    patterns: Iterable[re.Pattern],
+    source_rel_path: str,
+    base_url: str,
+    shared_urls: dict[str, str],
+) -> tuple[str, int]:
+    """
+    Rewrite the references in a text file that refer to shared assets.
+
+    Return the new text, and the number of references that were rewritten.
+
+    :param text: contents of file.
+    :param patterns: patterns matching references, with a `ref` group.
+    :param source_rel_path: path of the file, relative to the site root.
+    :param base_url: base URL of the built site.
+    :param shared_urls: mapping of site path → shared URL.
+    """
+    n_rewritten = 0
+
+    def replace(match: re.Match) -> str:
+        nonlocal n_rewritten
+        rel_path = resolve_reference(match["ref"], source_rel_path, base_url)
+        shared_url = shared_urls.get(rel_path)
+        if shared_url is None:
+            return match[0]
+
+        n_rewritten += 1
+        start, end = match.span("ref")
+        offset = match.start()
+        return match[0][: start - offset] + shared_url + match[0][end - offset :]
+
+    for pattern in patterns:
+        text = pattern.sub(replace, text)
+    return text, n_rewritten
+
+
+def replace_text(path: Path, text: str):
+    """
+    Atomically replace the contents of a text file.
+
+    The file may be hardlinked, so it must not be modified in place.
+
+    :param path: path to file.
+    :param text: new contents.
+    """
+    tmp_path = path.with_name(f".tmp-{secrets.token_hex(8)}-{path.name}")
+    tmp_path.write_text(text, errors="surrogateescape")
+    os.replace(tmp_path, path)
+
+
+def share_asset(
+    path: Path, blobs_path: Path, assets_url: str, compress: bool
+) -> Optional[str]:
+    """
+    Store an asset in the blob store, and return its shared URL, or None if it
+    could not be stored.
+
+    :param path: path to asset.
+    :param blobs_path: root of blob store.
+    :param assets_url: URL under which blobs are served.
+    :param compress: whether to store compressed variants of the asset.
+    """
+    content_hash = hash_file(path)
+    blob_path = get_blob_path(blobs_path, content_hash)
+    try:
+        store_blob(path, blob_path)
+        if compress:
+            compress_blob(blob_path)
+    except OSError:
+        return None
+    return f"{assets_url}{content_hash}/{urllib.parse.quote(path.name)}"
+
+
+def share_assets(
+    site_path: Path,
+    base_url: str,
+    assets_url: str,
+    blobs_path: Path,
+    suffixes: Iterable[str] = DEFAULT_SHARED_ASSET_SUFFIXES,
+) -> int:
+    """
+    Rewrite the references to shareable assets in a built site (in HTML files and
+    stylesheets) to their shared URLs.
+
+    Stylesheets are rewritten first, so that a stylesheet whose references are
+    all to shared assets can itself be shared.
+    This is blocking, and should be run in a thread.
+    Return the number of references that were rewritten.
+
+    :param site_path: path to built site.
+    :param base_url: base URL of the built site.
+    :param assets_url: URL under which blobs are served.
+    :param blobs_path: root of blob store.
+    :param suffixes: suffixes of assets that may be shared.
+    """
+    suffixes = frozenset(suffixes)
+    base_url = base_url.rstrip("/") + "/"
+
+    html_paths, css_paths, leaf_paths = [], [], []
+    for root, _, names in os.walk(site_path):
+        for name in names:
+            path = Path(root) / name
+            if path.is_symlink():
+                continue
+
+            rel_path = path.relative_to(site_path).as_posix()
+            if path.suffix == ".html":
+                html_paths.append(rel_path)
+            elif path.suffix == ".css" and ".css" in suffixes:
+                css_paths.append(rel_path)
+            elif path.suffix in suffixes:
+                leaf_paths.append(rel_path)
+
+    # Site path → shared URL
+    shared_urls = {}
+
+    def share(rel_path: str):
+        compress = posixpath.splitext(rel_path)[1] in DEFAULT_PRECOMPRESS_SUFFIXES
+        url = share_asset(site_path / rel_path, blobs_path, assets_url, compress)
+        if url is not None:
+            shared_urls[rel_path] = url
+
+    for rel_path in leaf_paths:
+        share(rel_path)
+
+    n_rewritten = 0
+    css_patterns = (CSS_URL_PATTERN, CSS_IMPORT_PATTERN)
+    for rel_path in css_paths:
+        path = site_path / rel_path
+        text = path.read_text(errors="surrogateescape")
+        new_text, n = rewrite_references(
+            text, css_patterns, rel_path, base_url, shared_urls
+        )
+        if n:
+            replace_text(path, new_text)
+            n_rewritten += n
+
+        # Relative references would break at the shared URL
+        if not any(
+            is_relative_reference(match["ref"])
+            for pattern in css_patterns
+            for match in pattern.finditer(new_text)
+        ):
+            share(rel_path)
+
+    for rel_path in html_paths:
+        path = site_path / rel_path
+        text = path.read_text(errors="surrogateescape")
+        new_text, n = rewrite_references(
+            text, (HTML_REFERENCE_PATTERN,), rel_path, base_url, shared_urls
+        )
+        if n:
+            replace_text(path, new_text)
+            n_rewritten += n
+    return n_rewritten
@@ -0,0 +1,182 @@
+"""
+Content-addressed storage of built-site files.
+
+Built sites share many identical files (theme bundles, fonts, Pyodide assets).
+After a build, each file is hardlinked to a blob named by its content hash, and
+files whose content is already stored are replaced with a link to the existing
+blob. Identical files then occupy disk (and page cache) once, however many sites
+contain them.
+
+Blobs that are served directly (see `assets`) may also have compressed variants
+stored alongside them.
+
+A blob whose only link is the blob itself is no longer used by any site, and is
+removed by `collect_garbage`.
+"""
+
+import os
+import secrets
+import time
+from pathlib import Path
+
+from .compression import ENCODING_SUFFIXES, compress_file
+from .manifest import Manifest
+
+# Directory under the storage root in which blobs are stored
+BLOBS_NAME = "blobs"
+
+
+def get_blob_path(blobs_path: Path, content_hash: str) -> Path:
+    """
+    Return the path of the blob with the given content hash.
+
+    :param blobs_path: root of blob store.
+    :param content_hash: SHA-256 hex digest of content.
+    """
+    return blobs_path / content_hash[:2] / content_hash[2:]
+
+
+def link_into_place(source: Path, dest: Path):
+    """
+    Atomically replace dest with a hardlink to source.
+
+    :param source: path to existing file.
+    :param dest: path to replace.
+    """
+    tmp_path = dest.with_name(f".tmp-{secrets.token_hex(8)}-{dest.name}")
+    os.link(source, tmp_path)
+    try:
+        os.replace(tmp_path, dest)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def store_blob(path: Path, blob_path: Path) -> bool:
+    """
+    Share the storage of a file with the blob of the same content, adding the
+    file to the blob store if the blob does not yet exist.
+
+    Return True if the blob already existed.
+
+    :param path: path to file.
+    :param blob_path: path to blob with the same content (see `get_blob_path`).
+    """
+    try:
+        link_into_place(blob_path, path)
+    except FileNotFoundError:
+        # New content (or the blob was just collected)
+        pass
+    else:
+        return True
+
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(path, blob_path)
+    except FileExistsError:
+        # Stored concurrently by another build
+        link_into_place(blob_path, path)
+        return True
+    return False
+
+
+def deduplicate_site(
+    site_path: Path, manifest: Manifest, blobs_path: Path
+) -> tuple[int, int]:
+    """
+    Link the files of a built site into the blob store, sharing the storage of
+    files that are already stored.
+
+    The blob store must be on the same filesystem as the site.
+    This is blocking, and should be run in a thread.
+    Return the number of files, and number of bytes, that were already stored.
+
+    :param site_path: path to built site.
+    :param manifest: manifest of built site.
+    :param blobs_path: root of blob store.
+    """
+    n_shared = n_bytes_shared = 0
+    for rel_path, entry in manifest.files.items():
+        blob_path = get_blob_path(blobs_path, entry.hash)
+        if store_blob(site_path / rel_path, blob_path):
+            n_shared += 1
+            n_bytes_shared += entry.size
+    return n_shared, n_bytes_shared
+
+
+def compress_blob(blob_path: Path):
+    """
+    Write compressed variants of a blob alongside it (e.g. `<blob>.br`), for
+    blobs that are served directly. Existing variants are kept.
+
+    This is blocking, and should be run in a thread.
+
+    :param blob_path: path to blob.
+    """
+    variant_paths = [
+        blob_path.with_name(blob_path.name + suffix)
+        for suffix in ENCODING_SUFFIXES.values()
+    ]
+    if any(path.exists() for path in variant_paths):
+        return
+
+    # Compress a temporary link, so that variants appear atomically
+    tmp_path = blob_path.with_name(f".tmp-{secrets.token_hex(8)}-{blob_path.name}")
+    os.link(blob_path, tmp_path)
+    try:
+        for encoding in compress_file(tmp_path):
+            suffix = ENCODING_SUFFIXES[encoding]
+            os.replace(
+                tmp_path.with_name(tmp_path.name + suffix),
+                blob_path.with_name(blob_path.name + suffix),
+            )
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def collect_garbage(blobs_path: Path, tmp_max_age_seconds: float) -> tuple[int, int]:
+    """
+    Remove blobs that are no longer linked into any site, compressed variants of
+    removed blobs, and temporary files that were left behind.
+
+    This is blocking, and should be run in a thread.
+    Return the number of files removed, and the number of bytes freed.
+
+    :param blobs_path: root of blob store.
+    :param tmp_max_age_seconds: age after which temporary files are removed.
+    """
+    variant_suffixes = tuple(ENCODING_SUFFIXES.values())
+
+    now = time.time()
+    n_removed = n_bytes = 0
+    for root, _, names in os.walk(blobs_path):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.lstat(path)
+                if name.startswith(".tmp-"):
+                    if now - stat.st_mtime < tmp_max_age_seconds:
+                        continue
+                elif name.endswith(variant_suffixes):
+                    # Kept for as long as the blob itself
+                    blob_name, _ = os.path.splitext(name)
+                    if os.path.exists(os.path.join(root, blob_name)):
+                        continue
+                elif stat.st_nlink > 1:
+                    continue
+                else:
+                    # A build may have linked the blob since, but cannot once it
+                    # is moved out of place
+                    tmp_path = os.path.join(root, f".tmp-{secrets.token_hex(8)}-{name}")
+                    os.rename(path, tmp_path)
+                    if os.lstat(tmp_path).st_nlink > 1:
+                        os.replace(tmp_path, path)
+                        continue
+                    path = tmp_path
+
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            n_removed += 1
+            n_bytes += stat.st_size
+    return n_removed, n_bytes
@@ -16,6 +16,7 @@ class Builder(LoggingConfigurable):
         build_path: pathlib.Path,
         base_url: str,
         config_path: pathlib.Path = None,
+        cache_path: pathlib.Path = None,
     ) -> tuple[ReservedCommands | str, ...]:
         raise NotImplementedError
 
@@ -30,12 +31,14 @@ class GenericBuilder(Builder):
         build_path: pathlib.Path,
         base_url: str,
         config_path: pathlib.Path = None,
+        cache_path: pathlib.Path = None,
     ) -> tuple[ReservedCommands | str, ...]:
         template_variables = {
             "repo": repo_path,
             "build": build_path,
             "base_url": base_url,
             "config": config_path,
+            "cache": cache_path,
         }
         program, *raw_args = self.command
         args = [arg.format_map(template_variables) for arg in raw_args]
@@ -2,8 +2,16 @@ from traitlets import Unicode
 from traitlets.config import Application
 
 import asyncio
+import os
 from typing import override
 
+from ..tracing import (
+    TRACE_OUTPUT_ENV,
+    extract_trace_environment,
+    setup_tracing,
+    tracer,
+)
+
 
 class BuilderApplication(Application):
     repo_path = Unicode(
@@ -22,6 +30,16 @@ class BuilderApplication(Application):
         help="Optional base URL to use for built site",
     )
     config_file = Unicode("", help="Load this config file", config=True)
+    cache_path = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help="""
+        Optional path at which to cache build state for reuse by later builds.
+
+        Sibling directories hold the caches of other versions of the same repository.
+        """,
+    )
 
     aliases = {
         **Application.aliases,
@@ -29,6 +47,7 @@ class BuilderApplication(Application):
         "dest": "BuilderApplication.built_path",
         "base-url": "BuilderApplication.base_url",
         "config": "BuilderApplication.config_file",
+        "cache": "BuilderApplication.cache_path",
     }
 
     @override
@@ -46,4 +65,17 @@ class BuilderApplication(Application):
         )
 
     def start(self):
-        asyncio.run(self.render())
+        trace_output = os.environ.get(TRACE_OUTPUT_ENV)
+        provider = None
+        if trace_output:
+            provider = setup_tracing(trace_output, self.name)
+
+        try:
+            # Join the trace of the build that started us
+            with tracer.start_as_current_span(
+                "render", context=extract_trace_environment()
+            ):
+                asyncio.run(self.render())
+        finally:
+            if provider is not None:
+                provider.shutdown()
@@ -1,7 +1,10 @@
 """An AST to HTML renderer for Jupyter Book (myst) projects."""
 
 import asyncio
+import collections
 import dataclasses
+import fnmatch
+import os
 import shutil
 from pathlib import Path
 import tempfile
@@ -9,13 +12,16 @@ import pathlib
 import logging
 from typing import Optional
 
-from traitlets import default, Bool, Instance, Unicode
+from traitlets import default, Bool, Enum, Instance, Integer, List, Unicode
 
 
 from ruamel.yaml import YAML
 from jupyter_book_site_renderer import JupyterBookSiteRenderer
 
 from ..builder import Builder, ReservedCommands
+from ..staging import STAGING_STRATEGIES, stage_tree
+from ..tracing import tracer
+from ..utils import read_lines
 from .base import BuilderApplication
 
 # We don't have to roundtrip here, because nobody reads that YAML
@@ -26,6 +32,10 @@ yaml = YAML(typ="safe")
 # We find and replace this.
 ASSETS_FOLDER = "myst_assets_folder"
 
+# Layout of the build cache for a version of a repository
+CACHE_BUILD_DIR_NAME = "_build"
+CACHE_PROJECT_ROOT_NAME = "project-root"
+
 
 @dataclasses.dataclass
 class Route:
@@ -43,6 +53,7 @@ class JupyterBook2Builder(Builder):
         build_path: pathlib.Path,
         base_url: str,
         config_path: pathlib.Path = None,
+        cache_path: pathlib.Path = None,
     ) -> tuple[ReservedCommands | str, ...]:
         entrypoint = [
             ReservedCommands.python,
@@ -59,6 +70,8 @@ class JupyterBook2Builder(Builder):
         ]
         if config_path is not None:
             entrypoint.extend(["--config", config_path])
+        if cache_path is not None:
+            entrypoint.extend(["--cache", cache_path])
         return tuple(entrypoint)
 
 
@@ -78,6 +91,60 @@ class JupyterBook2BuilderApp(BuilderApplication):
 
     ast_renderer = Instance(JupyterBookSiteRenderer, help="Renderer for AST into HTML")
 
+    output_tail_lines = Integer(
+        1000,
+        help="Number of lines of process output to keep for reporting failures",
+        config=True,
+    )
+
+    incremental_builds = Bool(
+        True,
+        help="""
+        Seed each build from the cache of the most recent build of the same repository,
+        so that unchanged pages and notebooks needn't be rebuilt.
+
+        Requires a cache path to be given.
+        """,
+        config=True,
+    )
+
+    staging_strategy = Enum(
+        list(STAGING_STRATEGIES),
+        "auto",
+        help="""
+        How to create the writable copy of the source that is built.
+
+        `reflink` and `hardlink` avoid copying file data where the filesystem
+        supports it, falling back to `copy`. `auto` tries `reflink` and then `copy`.
+
+        `hardlink` shares files with the repository checkout, so is only safe if
+        the build never modifies source files in place (which executing notebooks
+        may do).
+        """,
+        config=True,
+    )
+    staging_root = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Directory in which to stage sources for building. Reflinks and hardlinks
+        require this to be on the same filesystem as the source.
+        """,
+        config=True,
+    )
+
+    project_root_ignore = List(
+        [".*", "_build", "node_modules", "__pycache__", "venv", "env", "site-packages"],
+        value_trait=Unicode(),
+        help="Glob patterns of directory names not to search for the project root",
+        config=True,
+    )
+    project_root_max_depth = Integer(
+        5,
+        help="Maximum depth below the repository root at which to search for the project root",
+        config=True,
+    )
+
     @default("ast_renderer")
     def _default_ast_renderer(self):
         return JupyterBookSiteRenderer(parent=self)
@@ -86,7 +153,8 @@ class JupyterBook2BuilderApp(BuilderApplication):
         """
         Helper to run a process that is expected to succeed.
 
-        If a non-zero return code is encountered, throw a ProcessFailedError and log the output.
+        If a non-zero return code is encountered, throw a ProcessFailedError and log the
+        tail of the output.
         """
         proc = await asyncio.create_subprocess_exec(
             *args,
@@ -94,11 +162,20 @@ class JupyterBook2BuilderApp(BuilderApplication):
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.STDOUT,
         )
-        stdout, _ = await proc.communicate()
-        retcode = await proc.wait()
+
+        # Stream the output rather than buffering it, keeping only the tail
+        output_tail = collections.deque(maxlen=self.output_tail_lines)
+        try:
+            async for line in read_lines(proc.stdout):
+                output_tail.append(line)
+            retcode = await proc.wait()
+        except asyncio.CancelledError:
+            proc.terminate()
+            await proc.wait()
+            raise
 
         if retcode != 0:
-            for line in stdout.decode().splitlines():
+            for line in output_tail:
                 self.log.error(line)
             raise ProcessFailedError("An error occurred whilst invoking process")
 
@@ -110,20 +187,88 @@ class JupyterBook2BuilderApp(BuilderApplication):
         if len(data["project"]["toc"]) == 1:
             data["site"]["template"] = "article-theme"
 
-        with open(myst_yml_path, "w") as f:
+        # Replace rather than modify the file, as it may be hardlinked (see staging)
+        tmp_path = myst_yml_path.with_name(f".{myst_yml_path.name}.tmp")
+        with open(tmp_path, "w") as f:
             yaml.dump(data, f)
+        tmp_path.replace(myst_yml_path)
 
     def find_project_root(self, repo_path: Path) -> Optional[Path]:
         """
-        Locate the root of a Jupyter Book project by finding the myst.yml.
+        Locate the root of a Jupyter Book project by finding the shallowest myst.yml.
 
+        The search is breadth-first, skipping directories matching
+        `project_root_ignore` and stopping at `project_root_max_depth`.
         Return None if it cannot be located.
 
         :param repo_path: path to repo contents.
         """
-        for dirname, _, filenames in repo_path.walk():
-            if "myst.yml" in filenames:
-                return dirname
+        pending = collections.deque([(repo_path, 0)])
+        while pending:
+            path, depth = pending.popleft()
+            try:
+                with os.scandir(path) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                continue
+
+            if any(e.name == "myst.yml" and e.is_file() for e in entries):
+                return path
+
+            if depth >= self.project_root_max_depth:
+                continue
+
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and not any(
+                    fnmatch.fnmatch(entry.name, pattern)
+                    for pattern in self.project_root_ignore
+                ):
+                    pending.append((Path(entry.path), depth + 1))
+        return None
+
+    def read_cached_project_root(self, repo_path: Path) -> Optional[Path]:
+        """
+        Return the project root recorded in the build cache by a previous build of
+        this version of the repository, or None if there is none.
+
+        :param repo_path: path to repo contents.
+        """
+        if self.cache_path is None:
+            return None
+
+        try:
+            relative_root = (
+                (Path(self.cache_path) / CACHE_PROJECT_ROOT_NAME).read_text().strip()
+            )
+        except OSError:
+            return None
+
+        # Resolve, so that neither `..` nor symlinks can lead out of the repo
+        project_root = repo_path / relative_root
+        if not project_root.resolve().is_relative_to(repo_path.resolve()) or not (
+            (project_root / "myst.yml").is_file()
+        ):
+            return None
+        return project_root
+
+    def write_cached_project_root(self, repo_path: Path, project_root: Path):
+        """
+        Record the project root in the build cache for this version of the repository.
+
+        :param repo_path: path to repo contents.
+        :param project_root: path to project root.
+        """
+        if self.cache_path is None:
+            return
+
+        cache_path = Path(self.cache_path)
+        try:
+            cache_path.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path / f".{CACHE_PROJECT_ROOT_NAME}.tmp"
+            tmp_path.write_text(project_root.relative_to(repo_path).as_posix())
+            tmp_path.replace(cache_path / CACHE_PROJECT_ROOT_NAME)
+        except OSError:
+            self.log.exception("Failed to cache project root")
 
     async def ensure_project_root(self, repo_path: Path) -> Path:
         """
@@ -134,19 +279,25 @@ class JupyterBook2BuilderApp(BuilderApplication):
 
         :param repo_path: path to repo contents.
         """
+        project_root = self.read_cached_project_root(repo_path)
+        if project_root is not None:
+            return project_root
+
         project_root = self.find_project_root(repo_path)
         if project_root is not None:
+            self.write_cached_project_root(repo_path, project_root)
             return project_root
 
         # No `myst.yml` found. Let's make one
         try:
-            await self.run_silent_process(
-                "jupyter",
-                "book",
-                "init",
-                "--write-toc",
-                cwd=repo_path,
-            )
+            with tracer.start_as_current_span("jupyter book init"):
+                await self.run_silent_process(
+                    "jupyter",
+                    "book",
+                    "init",
+                    "--write-toc",
+                    cwd=repo_path,
+                )
         except ProcessFailedError:
             raise RuntimeError(
                 "An error occurred whilst initialising Jupyter Book project"
@@ -164,13 +315,14 @@ class JupyterBook2BuilderApp(BuilderApplication):
         """
 
         try:
-            await self.run_silent_process(
-                "jupyter",
-                "book",
-                "build",
-                "--site",
-                cwd=project_path,
-            )
+            with tracer.start_as_current_span("jupyter book build"):
+                await self.run_silent_process(
+                    "jupyter",
+                    "book",
+                    "build",
+                    "--site",
+                    cwd=project_path,
+                )
         except ProcessFailedError:
             raise RuntimeError(
                 "An error occurred whilst building Jupyter Book AST"
@@ -189,10 +341,87 @@ class JupyterBook2BuilderApp(BuilderApplication):
         # The template from myst build --site is not installed (as only the
         # template.yml is needed). Let's now install it, so that we never pass around
         # an uninstalled template
-        await self.ast_renderer.install_downloaded_template(template_path)
+        with tracer.start_as_current_span("install template"):
+            await self.ast_renderer.install_downloaded_template(template_path)
 
         return ast_path, template_path
 
+    def seed_build_cache(self, build_dir: Path):
+        """
+        Seed a project's build directory from the cache of this version of the
+        repository if there is one, or else from that of the most recently built
+        version.
+
+        :param build_dir: path to the project's `_build` directory.
+        """
+        cache_path = Path(self.cache_path)
+        if build_dir.exists() or not cache_path.parent.exists():
+            return
+
+        if (cache_path / CACHE_BUILD_DIR_NAME).exists():
+            seed_path = cache_path / CACHE_BUILD_DIR_NAME
+        else:
+            candidates = [
+                p / CACHE_BUILD_DIR_NAME
+                for p in cache_path.parent.iterdir()
+                if not p.name.startswith(".") and (p / CACHE_BUILD_DIR_NAME).is_dir()
+            ]
+            if not candidates:
+                return
+            seed_path = max(candidates, key=lambda p: p.stat().st_mtime)
+
+        self.log.info(f"Seeding build from {seed_path}")
+        # The build may modify cached files in place, so never hardlink them
+        stage_tree(seed_path, build_dir, "reflink")
+
+    def save_build_cache(self, build_dir: Path):
+        """
+        Save a project's build directory as the cache of this version of the
+        repository, and remove the caches of other versions.
+
+        :param build_dir: path to the project's `_build` directory.
+        """
+        cache_path = Path(self.cache_path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Stage alongside the cache, so that it is never seen partially written
+        staging_path = Path(
+            tempfile.mkdtemp(prefix=f".{cache_path.name}-", dir=cache_path.parent)
+        )
+        try:
+            staging_build_dir = staging_path / CACHE_BUILD_DIR_NAME
+            staging_build_dir.mkdir()
+
+            # Rendered HTML is kept in the built site, not the cache
+            for path in build_dir.iterdir():
+                if path.name == "html":
+                    continue
+                if path.is_dir() and not path.is_symlink():
+                    stage_tree(
+                        path, staging_build_dir / path.name, self.staging_strategy
+                    )
+                else:
+                    shutil.copy2(
+                        path, staging_build_dir / path.name, follow_symlinks=False
+                    )
+
+            if cache_path.exists():
+                # Preserve the project root
+                project_root_path = cache_path / CACHE_PROJECT_ROOT_NAME
+                if project_root_path.exists():
+                    shutil.copy2(
+                        project_root_path, staging_path / CACHE_PROJECT_ROOT_NAME
+                    )
+                shutil.rmtree(cache_path)
+            staging_path.rename(cache_path)
+        finally:
+            shutil.rmtree(staging_path, ignore_errors=True)
+
+        # Only the most recent version is used to seed builds
+        for path in cache_path.parent.iterdir():
+            if path != cache_path and not path.name.startswith("."):
+                shutil.rmtree(path, ignore_errors=True)
+
     async def render(self):
         """
         Render a Jupyter Book into HTML. There are several pathways:
@@ -216,9 +445,10 @@ class JupyterBook2BuilderApp(BuilderApplication):
 
         # Source is AST, build HTML from it
         if (source_or_ast_path / "config.json").exists():
-            await self.ast_renderer.render_html(
-                source_or_ast_path, built_path, base_url=base_url
-            )
+            with tracer.start_as_current_span("render html"):
+                await self.ast_renderer.render_html(
+                    source_or_ast_path, built_path, base_url=base_url
+                )
             return
 
         # Source is a Jupyter Book
@@ -232,15 +462,40 @@ class JupyterBook2BuilderApp(BuilderApplication):
 
         # Otherwise try build from source
         if self.allow_source_builds:
-            with tempfile.TemporaryDirectory() as _tmpdir:
-                # Copy the source to somewhere writeable
+            with tempfile.TemporaryDirectory(dir=self.staging_root) as _tmpdir:
+                # Stage the source somewhere writeable
                 source_path = Path(_tmpdir)
-                shutil.copytree(source_or_ast_path, source_path, dirs_exist_ok=True)
-
-                ast_path, template_path = await self.build_site_from_book(source_path)
-                await self.ast_renderer.render_html(
-                    ast_path, built_path, template_path, base_url
-                )
+                with tracer.start_as_current_span("stage source"):
+                    counts = stage_tree(
+                        source_or_ast_path, source_path, self.staging_strategy
+                    )
+                self.log.info(f"Staged source files: {counts}")
+
+                # Build from the staged project root
+                project_path = source_path / book_root.relative_to(source_or_ast_path)
+                build_dir = project_path / "_build"
+
+                use_cache = self.incremental_builds and self.cache_path is not None
+                if use_cache:
+                    try:
+                        with tracer.start_as_current_span("seed build cache"):
+                            self.seed_build_cache(build_dir)
+                    except Exception:
+                        self.log.exception("Failed to seed build from cache")
+                        shutil.rmtree(build_dir, ignore_errors=True)
+
+                ast_path, template_path = await self.build_site_from_book(project_path)
+                with tracer.start_as_current_span("render html"):
+                    await self.ast_renderer.render_html(
+                        ast_path, built_path, template_path, base_url
+                    )
+
+                if use_cache:
+                    try:
+                        with tracer.start_as_current_span("save build cache"):
+                            self.save_build_cache(build_dir)
+                    except Exception:
+                        self.log.exception("Failed to save build cache")
                 return
         else:
             raise RuntimeError("Not permitted to build AST from project sources")
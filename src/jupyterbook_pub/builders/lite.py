@@ -9,6 +9,7 @@ class JupyterLiteBuilder(Builder):
         build_path: pathlib.Path,
         base_url: str,
         config_path: pathlib.Path = None,
+        cache_path: pathlib.Path = None,
     ) -> tuple[ReservedCommands | str, ...]:
         """
         Tuple of executable entrypoint items required to launch this renderer.
@@ -8,10 +8,14 @@ to make sure we can serve a ton of users very cheaply.
 import hashlib
 import json
 from base64 import urlsafe_b64encode
+from typing import Optional
 
 from repoproviders.resolvers.base import MaybeExists, Repo
 from repoproviders.resolvers.serialize import JSONEncoder, to_dict
 
+# Fields of repos that identify a particular version, rather than the repo itself
+VERSION_FIELDS = frozenset({"ref", "version", "dir_hash"})
+
 
 def make_rendered_cache_key(repo: Repo, base_url: str) -> str:
     answer = MaybeExists(repo)
@@ -26,3 +30,34 @@ def make_checkout_cache_key(repo: Repo) -> str:
     return urlsafe_b64encode(
         hashlib.sha256(json.dumps(to_dict(answer), cls=JSONEncoder).encode()).digest()
     ).decode()
+
+
+def make_repo_cache_key(repo: Repo) -> str:
+    """
+    Make a key that identifies a repository, independent of its version.
+
+    Different versions of the same repository (e.g. commits on a branch) share
+    the same key, so that they can share build caches.
+
+    :param repo: repository.
+    """
+    data = to_dict(MaybeExists(repo))
+    data["data"] = {
+        key: value for key, value in data["data"].items() if key not in VERSION_FIELDS
+    }
+    return urlsafe_b64encode(
+        hashlib.sha256(json.dumps(data, cls=JSONEncoder).encode()).digest()
+    ).decode()
+
+
+def get_repo_version(repo: Repo) -> Optional[str]:
+    """
+    Return the version (e.g. commit) of a repository, or None if it has none.
+
+    :param repo: repository.
+    """
+    data = to_dict(MaybeExists(repo))["data"]
+    for key in ("ref", "version", "dir_hash"):
+        if data.get(key) is not None:
+            return str(data[key])
+    return None
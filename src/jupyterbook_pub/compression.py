@@ -0,0 +1,137 @@
+"""
+Pre-compression of built sites.
+
+Built sites never change once they have been moved into place, so rather than
+compressing responses on every request we write compressed sidecars (e.g.
+`index.html.br`) once, after the build, and serve those directly.
+"""
+
+import gzip
+import os
+from pathlib import Path
+from typing import Iterable, Optional
+
+import brotli
+
+# Content-Encoding → sidecar suffix, in order of server preference
+ENCODING_SUFFIXES = {
+    "br": ".br",
+    "gzip": ".gz",
+}
+
+DEFAULT_PRECOMPRESS_SUFFIXES = (".html", ".js", ".css", ".json", ".svg")
+
+
+def compress_file(
+    path: Path,
+    *,
+    min_size: int = 1024,
+    gzip_level: int = 9,
+    brotli_quality: int = 11,
+) -> list[str]:
+    """
+    Write compressed sidecars for a single file.
+
+    Sidecars that are not meaningfully smaller than the original are not written.
+    Return the list of encodings for which sidecars were written.
+
+    :param path: path to file to compress.
+    :param min_size: size (in bytes) below which files are not compressed.
+    :param gzip_level: gzip compression level.
+    :param brotli_quality: brotli compression quality.
+    """
+    data = path.read_bytes()
+    if len(data) < min_size:
+        return []
+
+    compressors = {
+        "br": lambda d: brotli.compress(d, quality=brotli_quality),
+        # Fix the mtime so that identical inputs produce identical sidecars
+        "gzip": lambda d: gzip.compress(d, compresslevel=gzip_level, mtime=0),
+    }
+
+    encodings = []
+    for encoding, suffix in ENCODING_SUFFIXES.items():
+        compressed = compressors[encoding](data)
+        # Not worth the CPU on the client
+        if len(compressed) >= len(data) * 0.9:
+            continue
+
+        sidecar_path = path.with_name(path.name + suffix)
+        sidecar_path.write_bytes(compressed)
+        encodings.append(encoding)
+    return encodings
+
+
+def precompress_site(
+    site_path: Path, suffixes: Iterable[str] = DEFAULT_PRECOMPRESS_SUFFIXES, **kwargs
+) -> int:
+    """
+    Write compressed sidecars for all compressible files in a built site.
+
+    This is blocking, and should be run in a thread.
+    Return the number of files that were compressed.
+
+    :param site_path: path to built site.
+    :param suffixes: file suffixes to compress.
+    :param kwargs: extra arguments to pass to `compress_file`.
+    """
+    suffixes = frozenset(suffixes)
+    sidecar_suffixes = frozenset(ENCODING_SUFFIXES.values())
+
+    n_compressed = 0
+    for root, _, names in os.walk(site_path):
+        for name in names:
+            path = Path(root) / name
+            if path.suffix not in suffixes or path.suffix in sidecar_suffixes:
+                continue
+            if compress_file(path, **kwargs):
+                n_compressed += 1
+    return n_compressed
+
+
+def parse_accept_encoding(header: str) -> dict[str, float]:
+    """
+    Parse an Accept-Encoding header into a mapping of coding → q-value.
+
+    :param header: value of the Accept-Encoding header.
+    """
+    codings = {}
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def acceptable_encodings(header: Optional[str]) -> list[str]:
+    """
+    Return the encodings that we can serve for a given Accept-Encoding header,
+    most preferred first.
+
+    :param header: value of the Accept-Encoding header.
+    """
+    if not header:
+        return []
+
+    codings = parse_accept_encoding(header)
+    wildcard_q = codings.get("*", 0.0)
+
+    # Sort by q-value, falling back on server preference (dict order)
+    ranked = [
+        (q, -i, encoding)
+        for i, encoding in enumerate(ENCODING_SUFFIXES)
+        if (q := codings.get(encoding, wildcard_q)) > 0
+    ]
+    return [encoding for *_, encoding in sorted(ranked, reverse=True)]
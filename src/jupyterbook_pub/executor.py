@@ -1,25 +1,45 @@
-from traitlets import Bool, Dict, Instance, Type, List, Unicode
+from traitlets import Bool, Dict, Float, Instance, Integer, Type, List, Set, Unicode
 from traitlets.config import LoggingConfigurable
 import asyncio
+import collections
 import sys
 from pathlib import Path
+from typing import Iterable, Optional
 import tempfile
 import os
 import os.path
 import hashlib
+import json
+import secrets
+import shutil
+import time
 
 
-from kubernetes_asyncio import config
+from kubernetes_asyncio import config, watch
+from opentelemetry import trace
 from kubernetes_asyncio.client.api_client import ApiClient
 from kubernetes_asyncio.client.api import core_v1_api
 from kubernetes_asyncio.client.rest import ApiException
 from kubernetes_asyncio.client import Configuration
 
 from .builder import Builder, ReservedCommands
+from .assets import DEFAULT_SHARED_ASSET_SUFFIXES, share_assets
+from .blobs import BLOBS_NAME, deduplicate_site
 from .builders.book import JupyterBook2Builder
+from .compression import DEFAULT_PRECOMPRESS_SUFFIXES, precompress_site
+from .locks import hold_in_use
+from .manifest import Manifest, write_manifest
+from . import pool_agent
+from .staging import stage_tree
+from .tracing import get_trace_environment, tracer
+from .utils import read_lines
 
 
-class ProcessFailedError(Exception): ...
+class ProcessFailedError(Exception):
+    def __init__(self, message: str, output: Iterable[str] = ()):
+        super().__init__(message)
+        # Tail of the process output
+        self.output = list(output)
 
 
 class BuildExecutor(LoggingConfigurable):
@@ -49,9 +69,30 @@ class BuildExecutor(LoggingConfigurable):
         repo_path: Path,
         dest_path: Path,
         base_url: str,
+        cache_path: Optional[Path] = None,
     ):
+        """
+        Build a repository into dest_path.
+
+        :param repo_path: path to repository contents.
+        :param dest_path: path at which to create the built site.
+        :param base_url: base URL of the built site.
+        :param cache_path: optional path at which the builder may cache build state.
+        Sibling directories hold the caches of other versions of the same repository.
+        """
         raise NotImplementedError
 
+    def start(self):
+        """
+        Start any background tasks. Called once the event loop is running.
+        """
+
+    async def stop(self):
+        """
+        Stop any background tasks, and release resources. Called before the event
+        loop stops.
+        """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -60,14 +101,50 @@ class BuildExecutor(LoggingConfigurable):
 
 class LockingExecutor(BuildExecutor):
     """
-    Build executor that uses in-memory events for concurrency control.
+    Build executor that builds into a temporary path, and atomically moves the
+    result into place.
+
+    Callers are responsible for ensuring that the same destination is not built
+    concurrently (see `BuildQueue`).
     """
 
-    # Ensure that concurrent processes don't interleave around proc spawning
-    # and PID writing. This is aggressive — we should really map this by path
-    _build_events = Dict(
-        key_trait=Instance(Path),
-        value_trait=Instance(asyncio.Event),
+    precompress = Bool(
+        True,
+        config=True,
+        help="Write compressed (gzip, brotli) sidecars for built files after each build",
+    )
+    precompress_suffixes = List(
+        list(DEFAULT_PRECOMPRESS_SUFFIXES),
+        value_trait=Unicode(),
+        config=True,
+        help="File suffixes for which compressed sidecars are written",
+    )
+    deduplicate = Bool(
+        False,
+        config=True,
+        help="""
+        Store built files by content hash under the storage root after each build,
+        so that identical files in different builds share storage. Required by
+        `JupyterBookPubApp.shared_assets`.
+
+        The storage root must be a single filesystem that supports hardlinks.
+        Enable with e.g. `c.LocalProcessExecutor.deduplicate = True`.
+        """,
+    )
+    shared_assets_url = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        URL under which blobs are served (ending in /), or None. When set,
+        references to common assets in built sites are rewritten to shared,
+        content-addressed URLs under this URL.
+        """,
+    )
+    shared_asset_suffixes = List(
+        list(DEFAULT_SHARED_ASSET_SUFFIXES),
+        value_trait=Unicode(),
+        config=True,
+        help="File suffixes of assets that may be served from shared URLs",
     )
 
     def get_temporary_build_path(self, build_path: Path) -> Path:
@@ -80,41 +157,100 @@ class LockingExecutor(BuildExecutor):
         """
         raise NotImplementedError
 
+    async def finalize_build(self, build_path: Path, base_url: str):
+        """
+        Post-process a completed build before it is moved into place.
+
+        :param build_path: path to the (temporary) build outputs.
+        :param base_url: base URL of the built site.
+        """
+        # Sidecars and the manifest must reflect the rewritten files
+        if self.shared_assets_url is not None and self.deduplicate:
+            try:
+                n_rewritten = await asyncio.to_thread(
+                    share_assets,
+                    build_path,
+                    base_url,
+                    self.shared_assets_url,
+                    Path(self.storage_root) / BLOBS_NAME,
+                    self.shared_asset_suffixes,
+                )
+            except Exception:
+                # Assets are still served by the site itself
+                self.log.exception("An error occurred whilst sharing assets")
+            else:
+                self.log.info(f"Rewrote {n_rewritten} references to shared assets")
+
+        if self.precompress:
+            try:
+                n_compressed = await asyncio.to_thread(
+                    precompress_site, build_path, self.precompress_suffixes
+                )
+            except Exception:
+                # Serving uncompressed files is better than not serving at all
+                self.log.exception("An error occurred whilst compressing build")
+            else:
+                self.log.info(f"Compressed {n_compressed} files")
+
+        # Record the final set of files, so that they needn't be re-read when serving
+        try:
+            manifest = await asyncio.to_thread(write_manifest, build_path)
+        except Exception:
+            self.log.exception("An error occurred whilst writing build manifest")
+        else:
+            self.log.info(f"Wrote manifest of {len(manifest.files)} files")
+
+            if self.deduplicate:
+                await self.deduplicate_build(build_path, manifest)
+
+    async def deduplicate_build(self, build_path: Path, manifest: Manifest):
+        """
+        Share the storage of built files with identical files of other builds.
+
+        :param build_path: path to the (temporary) build outputs.
+        :param manifest: manifest of build outputs.
+        """
+        try:
+            n_shared, n_bytes_shared = await asyncio.to_thread(
+                deduplicate_site,
+                build_path,
+                manifest,
+                Path(self.storage_root) / BLOBS_NAME,
+            )
+        except Exception:
+            # Unshared files are still served correctly
+            self.log.exception("An error occurred whilst deduplicating build")
+        else:
+            self.log.info(
+                f"Deduplicated {n_shared} files, sharing {n_bytes_shared} bytes"
+            )
+
     async def execute(
         self,
         repo_path: Path,
         dest_path: Path,
         base_url: str,
+        cache_path: Optional[Path] = None,
     ):
         # Temporary build path
         build_path = self.get_temporary_build_path(dest_path)
         build_path.mkdir(exist_ok=True)
 
-        try:
-            build_finished_event = self._build_events[dest_path]
-        except KeyError:
-            # The build path doesn't exist, so this is either the first build or a pending
-            # build
-            build_finished_event = self._build_events[dest_path] = asyncio.Event()
-
-            try:
-                self.log.info("Running first build")
-                await self.perform_build(repo_path, build_path, base_url)
+        # The cache directory for the repository must exist to be mounted
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
 
-                # Atomic move
-                build_path.rename(dest_path)
-                self.log.info("Build completed")
-            finally:
-                # Signal to other consumers, even if the build failed
-                # (we don't want people waiting on never-to-finish builds)
-                build_finished_event.set()
+        # Mark the build as in progress, so that it is not reclaimed as an orphan
+        async with hold_in_use(build_path):
+            self.log.info("Running build")
+            with tracer.start_as_current_span("perform build"):
+                await self.perform_build(repo_path, build_path, base_url, cache_path)
+            with tracer.start_as_current_span("finalize build"):
+                await self.finalize_build(build_path, base_url)
 
-                # Clear event
-                self._build_events.pop(dest_path)
-        else:
-            self.log.info("Waiting for concurrent build to finish")
-            await build_finished_event.wait()
-            return
+            # Atomic move
+            build_path.rename(dest_path)
+        self.log.info("Build completed")
 
 
 class LockingProcessExecutor(LockingExecutor):
@@ -122,13 +258,20 @@ class LockingProcessExecutor(LockingExecutor):
     Build executor that performs concurrent builds using local processes.
     """
 
+    output_tail_lines = Integer(
+        1000,
+        config=True,
+        help="Number of lines of build error output to keep for reporting failures",
+    )
+
     async def perform_build(
         self,
         repo_path: Path,
         build_path: Path,
         base_url: str,
+        cache_path: Optional[Path] = None,
     ):
-        cmd = self.prepare_process_cmd(repo_path, build_path, base_url)
+        cmd = self.prepare_process_cmd(repo_path, build_path, base_url, cache_path)
 
         await self.run_process(cmd)
 
@@ -137,11 +280,14 @@ class LockingProcessExecutor(LockingExecutor):
         repo_path: Path,
         build_path: Path,
         base_url: str,
+        cache_path: Optional[Path] = None,
     ) -> list[str]:
         raise NotImplementedError
 
     def get_temporary_build_path(self, build_path: Path) -> Path:
-        return Path(tempfile.mkdtemp())
+        # Build alongside the destination, so that the final move is atomic, and
+        # the storage manager can reclaim the directory if the build is abandoned
+        return Path(tempfile.mkdtemp(prefix=".build-", dir=build_path.parent))
 
     async def run_process(
         self,
@@ -154,28 +300,42 @@ class LockingProcessExecutor(LockingExecutor):
             *args,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
+            # Join the builder to the current trace
+            env={**os.environ, **get_trace_environment()},
         )
+
+        # Stream the output rather than buffering it, keeping only the tail of
+        # stderr to report if the process fails
+        stderr_tail = collections.deque(maxlen=self.output_tail_lines)
+
+        async def consume_stdout():
+            async for line in read_lines(proc.stdout):
+                if log_output:
+                    self.log.info(line)
+
+        async def consume_stderr():
+            async for line in read_lines(proc.stderr):
+                stderr_tail.append(line)
+                if log_output:
+                    self.log.debug(line)
+
         try:
-            stdout, stderr = await proc.communicate()
+            await asyncio.gather(consume_stdout(), consume_stderr())
+            await proc.wait()
         except asyncio.CancelledError:
             # Clean up on cancellation
             proc.terminate()
             await proc.wait()
             raise
 
-        is_error = proc.returncode != 0
-
-        if log_output:
-            for line in stdout.decode().splitlines():
-                self.log.info(line)
-
-            log_stderr = self.log.error if is_error else self.log.debug
-            for line in stderr.decode().splitlines():
-                log_stderr(line)
-
         # If there's an error, surface it
-        if is_error:
-            raise ProcessFailedError("An error occurred whilst invoking process")
+        if proc.returncode != 0:
+            if log_output:
+                for line in stderr_tail:
+                    self.log.error(line)
+            raise ProcessFailedError(
+                "An error occurred whilst invoking process", output=stderr_tail
+            )
 
 
 class DockerExecutor(LockingProcessExecutor):
@@ -204,6 +364,7 @@ class DockerExecutor(LockingProcessExecutor):
         repo_path: Path,
         build_path: Path,
         base_url: str,
+        cache_path: Optional[Path] = None,
     ):
         repo_mount_path = "/srv/source"
         dest_mount_path = "/srv/build"
@@ -213,6 +374,14 @@ class DockerExecutor(LockingProcessExecutor):
             f"type=bind,src={build_path},dst={dest_mount_path}",
         ]
 
+        # Mount the caches of all versions of the repository, so that the builder
+        # can seed from them
+        container_cache_path = None
+        if cache_path is not None:
+            cache_mount_path = Path("/srv/cache")
+            container_cache_path = cache_mount_path / cache_path.name
+            mounts.append(f"type=bind,src={cache_path.parent},dst={cache_mount_path}")
+
         # Debug
         extra_flags = []
 
@@ -224,6 +393,10 @@ class DockerExecutor(LockingProcessExecutor):
             )
             extra_flags.extend(["--env", "PYTHONPATH=/opt/packages/"])
 
+        # Pass through the trace context (from the environment of the CLI)
+        for name in get_trace_environment():
+            extra_flags.extend(["--env", name])
+
         working_dir = Path("/tmp")
 
         # Allow pass-in of configuration
@@ -261,6 +434,7 @@ class DockerExecutor(LockingProcessExecutor):
                 dest_mount_path,
                 base_url,
                 config_path=container_config_path,
+                cache_path=container_cache_path,
             )
         ]
         return [*invocation_cmd, *builder_cmd]
@@ -276,6 +450,7 @@ class LocalProcessExecutor(LockingProcessExecutor):
         repo_path: Path,
         build_path: Path,
         base_url: str,
+        cache_path: Optional[Path] = None,
     ):
         return tuple(
             [
@@ -285,17 +460,32 @@ class LocalProcessExecutor(LockingProcessExecutor):
                     build_path,
                     base_url,
                     config_path=self.builder_config_file,
+                    cache_path=cache_path,
                 )
             ]
         )
 
 
-def exponential_periods(dt: float, limit: float = None):
-    while True:
-        yield dt
-        dt *= 2
+# Label that identifies the build pods, for watching
+BUILD_POD_LABEL = "jupyterbook.pub/component"
+# Label that identifies pods in the warm pool
+POOL_POD_LABEL = "jupyterbook.pub/pool"
+
+# Paths at which build pods mount their repo, build and cache
+REPO_MOUNT_PATH = Path("/srv/repo")
+BUILD_MOUNT_PATH = Path("/srv/build")
+CACHE_MOUNT_PATH = Path("/srv/cache")
 
-        dt = min(dt, limit or dt)
+# Directory under the storage root holding a slot for each pool pod, from which it
+# reads its job and repo, and to which it writes its build and cache
+POOL_SLOTS_NAME = "pool_slots"
+# Path at which pool pods mount the job directory of their slot
+POOL_JOB_MOUNT_PATH = Path("/srv/job")
+# Name of the job file in the job directory of a slot
+POOL_JOB_NAME = "job.json"
+# Time (in seconds) before its idle timeout after which a pool pod is not claimed,
+# so that it does not exit before picking up the job
+POOL_CLAIM_MARGIN_SECONDS = 60
 
 
 class KubernetesExecutor(LockingExecutor):
@@ -316,6 +506,15 @@ class KubernetesExecutor(LockingExecutor):
     this file.
 
     The Kubernetes executor provides the config file from a secret.
+
+    Build pods are tracked with a single shared watch (filtered by label), rather
+    than by polling each pod, so that the load on the API server does not grow with
+    the number of concurrent builds.
+
+    Optionally, a pool of idle build pods can be kept running (see `pool_size`).
+    Each pool pod mounts only its own slot under the storage root, into which the
+    repo and job are placed when it is claimed, and then runs the builder, which
+    moves pod startup off the critical path.
     """
 
     namespace = Unicode(
@@ -369,6 +568,67 @@ class KubernetesExecutor(LockingExecutor):
     disable_strict_ssl_verification = Bool(
         False, help="Disable strict X509 SSL verification", config=True
     )
+    watch_timeout_seconds = Integer(
+        5 * 60,
+        help="How long each pod watch request lasts before it is renewed (in seconds)",
+        config=True,
+    )
+    pool_size = Integer(
+        0,
+        help="""
+        Number of idle build pods to keep ready to accept builds (0 to disable).
+
+        Because a pool pod does not know which repo it will build in advance, the
+        repo (and build cache) is copied into the pod's slot when it is claimed,
+        using hardlinks (or reflinks) where the storage volume supports them.
+        """,
+        config=True,
+    )
+    pool_pod_idle_timeout_seconds = Integer(
+        60 * 60,
+        help="How long an idle pool pod waits for a build before exiting (in seconds)",
+        config=True,
+    )
+
+    # Shared client, created on first use
+    _api_client = Instance(klass=ApiClient, allow_none=True)
+    # Pending pod completions, by pod name
+    _pod_waiters = Dict(key_trait=Unicode(), value_trait=Instance(asyncio.Future))
+    # Names of pods that are known to have been created
+    _created_pods = Set(Unicode())
+    _watch_task = Instance(klass=asyncio.Task, allow_none=True)
+    # Unclaimed pool pods, and their phase
+    _pool_pods = Dict(key_trait=Unicode(), value_trait=Unicode(allow_none=True))
+    # Time (from time.monotonic) after which unclaimed pool pods exit, by pod name
+    _pool_pod_deadlines = Dict(key_trait=Unicode(), value_trait=Float())
+    # Pool pods that have exited without being claimed, and should be deleted
+    _dead_pool_pods = Set(Unicode())
+    _pool_task = Instance(klass=asyncio.Task, allow_none=True)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._api_client_lock = asyncio.Lock()
+        self._pool_changed = asyncio.Event()
+
+    def start(self):
+        if self.pool_size:
+            self.ensure_watching()
+            self._pool_task = asyncio.create_task(self.maintain_pool())
+
+    async def stop(self):
+        tasks = [
+            task for task in (self._watch_task, self._pool_task) if task is not None
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Close the session once nothing else is using it
+        async with self._api_client_lock:
+            if self._api_client is not None:
+                await self._api_client.close()
+                self._api_client = None
 
     def get_temporary_build_path(self, build_path: Path) -> Path:
         # The LockingExecutor uses move-after-build for "atomic" builds
@@ -385,51 +645,40 @@ class KubernetesExecutor(LockingExecutor):
         factory.update(base_url.encode("utf-8"))
         return f"jupyterbook-pub-build-{factory.hexdigest(16)}"
 
-    def get_pod_manifest(
-        self, pod_name: str, repo_path: Path, build_path: Path, base_url: str
-    ) -> dict:
-        repo_mount_path = Path("/srv/repo")
-        dest_mount_path = Path("/srv/build")
-
+    def get_builder_config_paths(self) -> tuple[Optional[Path], Optional[Path]]:
+        """
+        Return the path at which the builder config secret is mounted, and the path
+        of the builder config file, or (None, None) if there is no builder config.
+        """
         # If there is a builder config file, we mount it as a secret
         if self.builder_config_name is None:
-            builder_config_file_path = None
-            builder_config_mount_path = None
-        else:
-            builder_config_mount_path = Path("/var/run/secrets/jupyterbook.pub/")
-            builder_config_file_path = (
-                builder_config_mount_path / self.builder_config_name
-            )
+            return None, None
 
-        builder_cmd = [
-            str(p)
-            for p in self.builder.entrypoint(
-                repo_mount_path,
-                dest_mount_path,
-                base_url,
-                config_path=builder_config_file_path,
-            )
-        ]
+        builder_config_mount_path = Path("/var/run/secrets/jupyterbook.pub/")
+        return (
+            builder_config_mount_path,
+            builder_config_mount_path / self.builder_config_name,
+        )
 
-        # Resolve the build path (temporary) and repo path relative to the storage root.
-        repo_path_relative_storage = repo_path.relative_to(self.storage_root)
-        build_path_relative_storage = build_path.relative_to(self.storage_root)
+    def make_pod_manifest(
+        self,
+        pod_name: str,
+        args: list[str],
+        volume_mounts: list[dict],
+        labels: dict[str, str],
+    ) -> dict:
+        """
+        Return the manifest of a build pod.
 
-        volumeMounts = [
-            {
-                "name": "storage",
-                "mountPath": os.fspath(repo_mount_path),
-                "readOnly": True,
-                "subPath": os.fspath(repo_path_relative_storage),
-            },
-            {
-                "name": "storage",
-                "mountPath": os.fspath(dest_mount_path),
-                "subPath": os.fspath(build_path_relative_storage),
-            },
-        ]
+        :param pod_name: name of pod.
+        :param args: command to run in the build container.
+        :param volume_mounts: mounts of the storage volume.
+        :param labels: labels to add to the pod.
+        """
+        volumeMounts = list(volume_mounts)
         volumes = [{"name": "storage", **self.storage_volume}]
 
+        builder_config_mount_path, _ = self.get_builder_config_paths()
         if builder_config_mount_path is not None:
             volumeMounts.append(
                 {
@@ -444,7 +693,11 @@ class KubernetesExecutor(LockingExecutor):
         build_container = {
             "image": self.image,
             "name": "build",
-            "args": builder_cmd,
+            "args": args,
+            "env": [
+                {"name": name, "value": value}
+                for name, value in get_trace_environment().items()
+            ],
             "volumeMounts": volumeMounts,
             "securityContext": self.security_context,
             "imagePullSecrets": self.image_pull_secrets,
@@ -465,78 +718,500 @@ class KubernetesExecutor(LockingExecutor):
             "kind": "Pod",
             "metadata": {
                 "name": pod_name,
-                "labels": {**self.labels, **self.extraLabels},
+                "labels": {
+                    **self.get_pod_selector_labels(),
+                    **labels,
+                    **self.extraLabels,
+                },
                 "annotations": self.annotations,
             },
             "spec": pod_spec,
         }
 
-    async def perform_build(self, repo_path: Path, build_path: Path, base_url: str):
-        configuration = Configuration()
-        try:
-            config.load_incluster_config(client_configuration=configuration)
-        except config.ConfigException:
-            await config.load_kube_config(client_configuration=configuration)
-
-        # Some clusters have certificates that violate X509 strict requirements,
-        # such as JetStream2 on K8s 1.33
-        configuration.disable_strict_ssl_verification = (
-            self.disable_strict_ssl_verification
+    def get_builder_cmd(self, base_url: str, cache_path: Optional[Path]) -> list[str]:
+        """
+        Return the command that builds the repo mounted in a build pod.
+
+        :param base_url: base URL of the built site.
+        :param cache_path: path at which the builder may cache build state, or None.
+        """
+        _, builder_config_file_path = self.get_builder_config_paths()
+        return [
+            str(p)
+            for p in self.builder.entrypoint(
+                REPO_MOUNT_PATH,
+                BUILD_MOUNT_PATH,
+                base_url,
+                config_path=builder_config_file_path,
+                cache_path=(
+                    None if cache_path is None else CACHE_MOUNT_PATH / cache_path.name
+                ),
+            )
+        ]
+
+    def get_pod_manifest(
+        self,
+        pod_name: str,
+        repo_path: Path,
+        build_path: Path,
+        base_url: str,
+        cache_path: Optional[Path] = None,
+    ) -> dict:
+        builder_cmd = self.get_builder_cmd(base_url, cache_path)
+
+        # Resolve the build path (temporary) and repo path relative to the storage root.
+        repo_path_relative_storage = repo_path.relative_to(self.storage_root)
+        build_path_relative_storage = build_path.relative_to(self.storage_root)
+
+        volumeMounts = [
+            {
+                "name": "storage",
+                "mountPath": os.fspath(REPO_MOUNT_PATH),
+                "readOnly": True,
+                "subPath": os.fspath(repo_path_relative_storage),
+            },
+            {
+                "name": "storage",
+                "mountPath": os.fspath(BUILD_MOUNT_PATH),
+                "subPath": os.fspath(build_path_relative_storage),
+            },
+        ]
+
+        # Mount the caches of all versions of the repository, so that the builder
+        # can seed from them
+        if cache_path is not None:
+            volumeMounts.append(
+                {
+                    "name": "storage",
+                    "mountPath": os.fspath(CACHE_MOUNT_PATH),
+                    "subPath": os.fspath(
+                        cache_path.parent.relative_to(self.storage_root)
+                    ),
+                }
+            )
+        return self.make_pod_manifest(pod_name, builder_cmd, volumeMounts, {})
+
+    def get_pool_slot_path(self, pod_name: str) -> Path:
+        return Path(self.storage_root) / POOL_SLOTS_NAME / pod_name
+
+    def get_pool_pod_manifest(self, pod_name: str) -> dict:
+        agent_cmd = [
+            "python",
+            "-m",
+            pool_agent.__name__,
+            os.fspath(POOL_JOB_MOUNT_PATH / POOL_JOB_NAME),
+            "--timeout",
+            str(self.pool_pod_idle_timeout_seconds),
+        ]
+
+        # Pool pods don't know what they will build, so they mount only their own
+        # slot, into which the repo and job are placed when the pod is claimed
+        slot_path_relative_storage = self.get_pool_slot_path(pod_name).relative_to(
+            self.storage_root
+        )
+        volumeMounts = [
+            {
+                "name": "storage",
+                "mountPath": os.fspath(mount_path),
+                "readOnly": name == "repo",
+                "subPath": os.fspath(slot_path_relative_storage / name),
+            }
+            for name, mount_path in (
+                ("job", POOL_JOB_MOUNT_PATH),
+                ("repo", REPO_MOUNT_PATH),
+                ("build", BUILD_MOUNT_PATH),
+                ("cache", CACHE_MOUNT_PATH),
+            )
+        ]
+        return self.make_pod_manifest(
+            pod_name, agent_cmd, volumeMounts, {POOL_POD_LABEL: "true"}
         )
 
-        async with ApiClient(configuration=configuration) as client:
-            core_api = core_v1_api.CoreV1Api(client)
+    def get_pod_selector_labels(self) -> dict[str, str]:
+        """
+        Return the labels that identify the build pods created by this executor.
+        """
+        return {**self.labels, BUILD_POD_LABEL: "build"}
 
-            pod_name = self.get_pod_name(repo_path, build_path, base_url)
+    async def get_api_client(self) -> ApiClient:
+        """
+        Return the shared API client, creating it on first use.
+        """
+        async with self._api_client_lock:
+            if self._api_client is None:
+                configuration = Configuration()
+                try:
+                    config.load_incluster_config(client_configuration=configuration)
+                except config.ConfigException:
+                    await config.load_kube_config(client_configuration=configuration)
+
+                # Some clusters have certificates that violate X509 strict requirements,
+                # such as JetStream2 on K8s 1.33
+                configuration.disable_strict_ssl_verification = (
+                    self.disable_strict_ssl_verification
+                )
+                self._api_client = ApiClient(configuration=configuration)
+            return self._api_client
 
-            self.log.info("Checking for existing pod")
+    def ensure_watching(self):
+        """
+        Start the shared pod watch, if it is not already running.
+        """
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.create_task(self.watch_pods())
+
+    def notify_pod_phase(self, pod_name: str, phase: Optional[str]):
+        """
+        Wake the build waiting on a pod, if the pod has finished.
+
+        :param pod_name: name of pod.
+        :param phase: phase of pod, or None if the pod no longer exists.
+        """
+        if pod_name in self._pool_pods:
+            self.notify_pool_pod_phase(pod_name, phase)
+            return
+
+        if phase not in ("Succeeded", "Failed", None):
+            return
+
+        waiter = self._pod_waiters.get(pod_name)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(phase)
+
+    async def watch_pods(self):
+        """
+        Watch the build pods, waking builds as their pods finish.
+
+        The watch is resumed from the last seen resource version when each watch
+        request times out, and restarted from a fresh listing if that version has
+        expired.
+        """
+        core_api = core_v1_api.CoreV1Api(await self.get_api_client())
+        label_selector = ",".join(
+            f"{key}={value}" for key, value in self.get_pod_selector_labels().items()
+        )
+
+        resource_version = None
+        while True:
             try:
-                await core_api.read_namespaced_pod(
-                    name=pod_name, namespace=self.namespace
-                )
+                if resource_version is None:
+                    # (Re)list, catching up on anything that the watch missed.
+                    # Only pods created before the listing can be missing from it
+                    # because they were deleted
+                    created_pods = set(self._created_pods)
+                    pods = await core_api.list_namespaced_pod(
+                        namespace=self.namespace, label_selector=label_selector
+                    )
+                    for pod in pods.items:
+                        self.notify_pod_phase(pod.metadata.name, pod.status.phase)
+                    for pod_name in created_pods - {
+                        pod.metadata.name for pod in pods.items
+                    }:
+                        self.notify_pod_phase(pod_name, None)
+                    resource_version = pods.metadata.resource_version
+
+                async with watch.Watch() as w:
+                    async for event in w.stream(
+                        core_api.list_namespaced_pod,
+                        namespace=self.namespace,
+                        label_selector=label_selector,
+                        resource_version=resource_version,
+                        timeout_seconds=self.watch_timeout_seconds,
+                    ):
+                        pod = event["object"]
+                        self.notify_pod_phase(
+                            pod.metadata.name,
+                            None if event["type"] == "DELETED" else pod.status.phase,
+                        )
+                        resource_version = w.resource_version
             except ApiException as err:
-                # We expect to be the only build job due to LockingExecutor
-                if err.status != 404:
-                    raise RuntimeError(f"Unknown error: {err}")
-            else:
-                raise RuntimeError(f"Existing build pod encountered: {pod_name}")
+                if err.status == 410:
+                    self.log.debug("Pod watch expired, relisting")
+                else:
+                    self.log.warning(f"Error watching build pods: {err}")
+                    await asyncio.sleep(1)
+                resource_version = None
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("Error watching build pods")
+                await asyncio.sleep(1)
+                resource_version = None
+
+    def notify_pool_pod_phase(self, pod_name: str, phase: Optional[str]):
+        """
+        Track the phase of an unclaimed pool pod.
 
-            # Create build pod
-            self.log.info("Creating build pod")
-            pod_manifest = self.get_pod_manifest(
-                pod_name, repo_path, build_path, base_url
-            )
-            resp = await core_api.create_namespaced_pod(
-                body=pod_manifest, namespace=self.namespace
-            )
+        :param pod_name: name of pod.
+        :param phase: phase of pod, or None if the pod no longer exists.
+        """
+        if phase in ("Pending", "Running"):
+            self._pool_pods[pod_name] = phase
+            return
+
+        # Pod exited (or was deleted) before it was claimed, so replace it
+        self.log.info(f"Pool pod {pod_name} exited whilst idle")
+        del self._pool_pods[pod_name]
+        self._pool_pod_deadlines.pop(pod_name, None)
+        self._created_pods.discard(pod_name)
+        self._dead_pool_pods.add(pod_name)
+        self._pool_changed.set()
+
+    def claim_pool_pod(self) -> Optional[str]:
+        """
+        Claim a running pool pod, returning its name, or None if there are none.
+
+        Pods that are about to reach their idle timeout are not claimed, as they
+        may exit before picking up the job.
+        """
+        now = time.monotonic()
+        for pod_name, phase in self._pool_pods.items():
+            deadline = self._pool_pod_deadlines.get(pod_name, 0)
+            if phase == "Running" and now < deadline - POOL_CLAIM_MARGIN_SECONDS:
+                del self._pool_pods[pod_name]
+                del self._pool_pod_deadlines[pod_name]
+                self._pool_changed.set()
+                return pod_name
+        return None
+
+    async def maintain_pool(self):
+        """
+        Keep `pool_size` unclaimed pods in the pool, replacing pods as they are
+        claimed or exit.
+        """
+        core_api = core_v1_api.CoreV1Api(await self.get_api_client())
+
+        while True:
+            self._pool_changed.clear()
             try:
-                # Wait for pod to have non-pending status
-                for dt in exponential_periods(0.1, limit=5):
+                for pod_name in list(self._dead_pool_pods):
+                    await self.delete_pod(core_api, pod_name)
+                    await asyncio.to_thread(
+                        shutil.rmtree,
+                        self.get_pool_slot_path(pod_name),
+                        ignore_errors=True,
+                    )
+                    self._dead_pool_pods.discard(pod_name)
+
+                while len(self._pool_pods) < self.pool_size:
+                    pod_name = f"jupyterbook-pub-pool-{secrets.token_hex(8)}"
+                    self.log.info(f"Creating pool pod {pod_name}")
+
+                    # The slot must exist to be mounted
+                    slot_path = self.get_pool_slot_path(pod_name)
+                    for name in ("job", "repo", "build", "cache"):
+                        await asyncio.to_thread(
+                            (slot_path / name).mkdir, parents=True, exist_ok=True
+                        )
+
+                    # Track the pod before it is created, so that no events are missed
+                    self._pool_pods[pod_name] = "Pending"
+                    self._pool_pod_deadlines[pod_name] = (
+                        time.monotonic() + self.pool_pod_idle_timeout_seconds
+                    )
                     try:
-                        resp = await core_api.read_namespaced_pod(
-                            name=pod_name, namespace=self.namespace
+                        await core_api.create_namespaced_pod(
+                            body=self.get_pool_pod_manifest(pod_name),
+                            namespace=self.namespace,
+                        )
+                    except BaseException:
+                        self._pool_pods.pop(pod_name, None)
+                        self._pool_pod_deadlines.pop(pod_name, None)
+                        await asyncio.to_thread(
+                            shutil.rmtree, slot_path, ignore_errors=True
+                        )
+                        raise
+                    self._created_pods.add(pod_name)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("Error maintaining build pod pool")
+                await asyncio.sleep(1)
+                continue
+
+            await self._pool_changed.wait()
+
+    async def delete_pod(self, core_api: core_v1_api.CoreV1Api, pod_name: str):
+        try:
+            await core_api.delete_namespaced_pod(
+                name=pod_name, namespace=self.namespace
+            )
+        except ApiException as err:
+            # We expect to be the only build job due to BuildQueue
+            if err.status != 404:
+                raise RuntimeError(f"Unknown error: {err}")
+
+    async def create_build_pod(
+        self,
+        core_api: core_v1_api.CoreV1Api,
+        pod_name: str,
+        repo_path: Path,
+        build_path: Path,
+        base_url: str,
+        cache_path: Optional[Path] = None,
+    ):
+        self.log.info("Checking for existing pod")
+        try:
+            await core_api.read_namespaced_pod(name=pod_name, namespace=self.namespace)
+        except ApiException as err:
+            # We expect to be the only build job due to BuildQueue
+            if err.status != 404:
+                raise RuntimeError(f"Unknown error: {err}")
+        else:
+            raise RuntimeError(f"Existing build pod encountered: {pod_name}")
+
+        # Create build pod
+        self.log.info("Creating build pod")
+        pod_manifest = self.get_pod_manifest(
+            pod_name, repo_path, build_path, base_url, cache_path
+        )
+        await core_api.create_namespaced_pod(
+            body=pod_manifest, namespace=self.namespace
+        )
+
+    async def submit_pool_job(
+        self,
+        pod_name: str,
+        repo_path: Path,
+        build_path: Path,
+        base_url: str,
+        cache_path: Optional[Path] = None,
+    ):
+        slot_path = self.get_pool_slot_path(pod_name)
+        with tracer.start_as_current_span("stage pool slot"):
+            # The pod mounts the repo read-only, so it may share files with the
+            # checkout
+            await asyncio.to_thread(
+                stage_tree, repo_path, slot_path / "repo", "hardlink"
+            )
+            # The build may modify cached files in place, so never hardlink them
+            if cache_path is not None and cache_path.parent.exists():
+                for path in cache_path.parent.iterdir():
+                    if not path.name.startswith("."):
+                        await asyncio.to_thread(
+                            stage_tree, path, slot_path / "cache" / path.name, "reflink"
                         )
-                    except ApiException as err:
-                        if err.status == 404:
-                            # Pod finished and was cleaned up, we don't need to delete
-                            return
-
-                        raise RuntimeError(f"Unknown error reading pod status: {err}")
-                    match resp.status.phase:
-                        case "Pending" | "Running":
-                            await asyncio.sleep(dt)
-                        case "Succeeded":
-                            break
-                        case "Failed":
-                            raise RuntimeError(f"Pod failed: {pod_name}")
+
+        # Write atomically, so that the agent never sees a partial job
+        self.log.info(f"Submitting build to pool pod {pod_name}")
+        job_path = slot_path / "job" / POOL_JOB_NAME
+        staging_path = job_path.with_name(f".{job_path.name}")
+        await asyncio.to_thread(
+            staging_path.write_text,
+            json.dumps(
+                {
+                    "args": self.get_builder_cmd(base_url, cache_path),
+                    "env": get_trace_environment(),
+                }
+            ),
+        )
+        await asyncio.to_thread(staging_path.replace, job_path)
+
+    def collect_pool_build(
+        self, pod_name: str, build_path: Path, cache_path: Optional[Path] = None
+    ):
+        """
+        Move the build, and the cache saved by the builder, out of the slot of a
+        pool pod.
+
+        This is blocking, and should be run in a thread.
+
+        :param pod_name: name of pool pod.
+        :param build_path: path to (empty) temporary build directory.
+        :param cache_path: path at which the builder was asked to cache build state.
+        """
+        slot_path = self.get_pool_slot_path(pod_name)
+        # Move the contents rather than the directory, which is marked as in use
+        for path in (slot_path / "build").iterdir():
+            path.rename(build_path / path.name)
+
+        if cache_path is None:
+            return
+        slot_cache_path = slot_path / "cache" / cache_path.name
+        if not slot_cache_path.exists():
+            return
+
+        # As the builder does, replace the cache of this version, and remove the
+        # caches of other versions
+        if cache_path.exists():
+            old_path = cache_path.with_name(
+                f".{cache_path.name}-{secrets.token_hex(8)}"
+            )
+            cache_path.rename(old_path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        slot_cache_path.rename(cache_path)
+        for path in cache_path.parent.iterdir():
+            if path != cache_path and not path.name.startswith("."):
+                shutil.rmtree(path, ignore_errors=True)
+
+    async def perform_build(
+        self,
+        repo_path: Path,
+        build_path: Path,
+        base_url: str,
+        cache_path: Optional[Path] = None,
+    ):
+        core_api = core_v1_api.CoreV1Api(await self.get_api_client())
+        span = trace.get_current_span()
+
+        pod_name = self.claim_pool_pod()
+        is_pool_pod = pod_name is not None
+        span.set_attribute("jupyterbook_pub.pool", is_pool_pod)
+        if not is_pool_pod:
+            pod_name = self.get_pod_name(repo_path, build_path, base_url)
+            start = self.create_build_pod(
+                core_api, pod_name, repo_path, build_path, base_url, cache_path
+            )
+        else:
+            start = self.submit_pool_job(
+                pod_name, repo_path, build_path, base_url, cache_path
+            )
+
+        # Register interest in the pod before it is started, so that no events are missed
+        waiter = self._pod_waiters[pod_name] = (
+            asyncio.get_running_loop().create_future()
+        )
+        try:
+            self.ensure_watching()
+            try:
+                await start
+                self._created_pods.add(pod_name)
+                span.set_attribute("k8s.pod.name", pod_name)
+
+                # Wait for pod to finish, including scheduling it if it is new
+                with tracer.start_as_current_span("wait for pod"):
+                    phase = await waiter
+
+                # The agent removes the job when it picks it up
+                if is_pool_pod and await asyncio.to_thread(
+                    (self.get_pool_slot_path(pod_name) / "job" / POOL_JOB_NAME).exists
+                ):
+                    raise RuntimeError(
+                        f"Pool pod exited before it picked up the build: {pod_name}"
+                    )
+                match phase:
+                    case "Failed":
+                        raise RuntimeError(f"Pod failed: {pod_name}")
+                    case None if is_pool_pod:
+                        # Its build may not have been written to the slot
+                        raise RuntimeError(f"Pool pod vanished: {pod_name}")
+                    case None:
+                        # Pod finished and was cleaned up, we don't need to delete
+                        return
+                if is_pool_pod:
+                    await asyncio.to_thread(
+                        self.collect_pool_build, pod_name, build_path, cache_path
+                    )
             # Cleanup
             finally:
                 self.log.info("Deleting build pod")
-                try:
-                    await core_api.delete_namespaced_pod(
-                        name=pod_name, namespace=self.namespace
-                    )
-                except ApiException as err:
-                    # We expect to be the only build job due to LockingExecutor
-                    if err.status != 404:
-                        raise RuntimeError(f"Unknown error: {err}")
+                await self.delete_pod(core_api, pod_name)
+        finally:
+            del self._pod_waiters[pod_name]
+            self._created_pods.discard(pod_name)
+            if is_pool_pod:
+                await asyncio.to_thread(
+                    shutil.rmtree,
+                    self.get_pool_slot_path(pod_name),
+                    ignore_errors=True,
+                )
@@ -0,0 +1,658 @@
+"""
+Asynchronous build jobs.
+
+Builds can take minutes, so rather than holding a request open for the duration
+of a build, requests submit a job to an in-process queue and poll for its status.
+"""
+
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import enum
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Optional
+
+from cachetools import TTLCache
+from opentelemetry import context, trace
+from repoproviders.fetchers.fetcher import fetch
+from repoproviders.resolvers.base import Repo
+from traitlets import Dict, Instance, Integer, List, Unicode
+from traitlets.config import LoggingConfigurable
+
+from .executor import BuildExecutor
+from .latest_builds import LatestBuildIndex
+from .locks import file_lock, file_semaphore, get_lock_path, hold_in_use
+from .metrics import (
+    BUILD_DURATION,
+    BUILD_QUEUE_DEPTH,
+    BUILD_QUEUE_WAIT_DURATION,
+    BUILDS_RUNNING,
+    FETCH_DURATION,
+)
+from .storage import StorageManager
+from .tracing import tracer
+
+
+# Age after which the status of an unfinished job is assumed to have been left
+# behind by a process that exited (in seconds)
+ORPHANED_STATUS_AGE_SECONDS = 24 * 60 * 60
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a build cannot be admitted to the queue.
+    """
+
+
+class BuildPriority(enum.IntEnum):
+    # Lower values are scheduled first
+    interactive = 0
+    warmup = 1
+    prebuild = 2
+
+
+class BuildState(enum.StrEnum):
+    queued = "queued"
+    fetching = "fetching"
+    building = "building"
+    done = "done"
+    failed = "failed"
+
+
+@dataclasses.dataclass
+class BuildJob:
+    id: str
+    repo: Repo
+    repo_path: Path
+    build_path: Path
+    base_url: str
+    # Path at which the builder may cache build state
+    cache_path: Optional[Path] = None
+    # Identity of the client that submitted the build, for fair scheduling
+    client: str = ""
+    priority: BuildPriority = BuildPriority.interactive
+    state: BuildState = BuildState.queued
+    # Wall-clock time at which each state was entered
+    timings: dict[BuildState, float] = dataclasses.field(default_factory=dict)
+    error: Optional[str] = None
+    finished: asyncio.Event = dataclasses.field(default_factory=asyncio.Event)
+    # Trace context of the request that submitted the build
+    trace_context: Optional[context.Context] = None
+
+    def __post_init__(self):
+        self.timings[self.state] = time.time()
+
+    def transition(self, state: BuildState):
+        self.state = state
+        self.timings[state] = time.time()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.state in (BuildState.done, BuildState.failed)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "priority": self.priority.name,
+            "timings": {str(state): t for state, t in self.timings.items()},
+            "error": self.error,
+        }
+
+
+class FairScheduler:
+    """
+    Queue of pending jobs that is strictly ordered by priority, and round-robins
+    between clients within each priority.
+    """
+
+    def __init__(self):
+        # priority → client → jobs, with clients in round-robin order
+        self._queues: dict[
+            BuildPriority, collections.OrderedDict[str, collections.deque[BuildJob]]
+        ] = {priority: collections.OrderedDict() for priority in BuildPriority}
+
+    def __len__(self) -> int:
+        return sum(
+            len(jobs) for clients in self._queues.values() for jobs in clients.values()
+        )
+
+    def __iter__(self):
+        """
+        Iterate over pending jobs in the order that they will be popped.
+        """
+        for priority in sorted(BuildPriority):
+            rotation = list(self._queues[priority].values())
+            for i in range(max(map(len, rotation), default=0)):
+                for jobs in rotation:
+                    if i < len(jobs):
+                        yield jobs[i]
+
+    def push(self, job: BuildJob):
+        self._queues[job.priority].setdefault(job.client, collections.deque()).append(
+            job
+        )
+
+    def pop(self) -> BuildJob:
+        for priority in sorted(BuildPriority):
+            clients = self._queues[priority]
+            if not clients:
+                continue
+
+            # Take the next job from the client at the front of the rotation,
+            # then move that client to the back
+            client, jobs = next(iter(clients.items()))
+            job = jobs.popleft()
+            if jobs:
+                clients.move_to_end(client)
+            else:
+                del clients[client]
+            return job
+        raise IndexError("pop from empty scheduler")
+
+    def remove(self, job: BuildJob) -> bool:
+        """
+        Remove a pending job, returning False if it was not pending (e.g. it has
+        already been popped).
+
+        :param job: job to remove.
+        """
+        clients = self._queues[job.priority]
+        jobs = clients.get(job.client)
+        if jobs is None or job not in jobs:
+            return False
+
+        jobs.remove(job)
+        if not jobs:
+            del clients[job.client]
+        return True
+
+    def count_client(self, client: str) -> int:
+        """
+        Return the number of pending jobs submitted by a client.
+
+        :param client: identity of client.
+        """
+        return sum(len(clients.get(client, ())) for clients in self._queues.values())
+
+
+class BuildQueue(LoggingConfigurable):
+    """
+    In-process queue of build jobs, processed by a fixed number of workers.
+
+    Jobs are deduplicated by build path, so that concurrent requests for the same
+    build share a single job. Pending jobs are scheduled by priority, and then
+    fairly between clients.
+    """
+
+    executor = Instance(klass=BuildExecutor, help="Executor that performs builds")
+    storage_managers = List(
+        Instance(klass=StorageManager),
+        help="Storage managers to notify after each successful build",
+    )
+    latest_builds = Instance(
+        klass=LatestBuildIndex,
+        allow_none=True,
+        help="Index in which to record the latest successful build of each repository",
+    )
+    max_concurrent_builds = Integer(4, help="Maximum number of concurrent builds")
+    build_timeout_seconds = Integer(
+        5 * 60, help="Max age of build in seconds before it is cancelled"
+    )
+    max_queued_builds = Integer(
+        100,
+        config=True,
+        help="Maximum number of pending builds. Further builds are refused (0 for no limit)",
+    )
+    max_queued_builds_per_client = Integer(
+        10,
+        config=True,
+        help="Maximum number of pending builds per client (0 for no limit)",
+    )
+    retry_after_seconds = Integer(
+        30,
+        config=True,
+        help="How long clients are told to wait before retrying a refused build",
+    )
+    finished_jobs_ttl_seconds = Integer(
+        60 * 60, help="How long to report the status of finished jobs (in seconds)"
+    )
+    finished_jobs_max_size = Integer(
+        1024, help="Max number of finished jobs to report the status of"
+    )
+    lock_path = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Directory of lock files with which builds are coordinated between processes
+        sharing the storage root, or None if this is the only process. Builds of
+        the same site are then coalesced, and `max_concurrent_builds` applies to
+        all processes together.
+        """,
+    )
+    status_path = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Directory in which the status of each job is written, so that it can be
+        reported by other processes sharing the storage root, or None.
+        """,
+    )
+
+    # Jobs that are queued or running, by ID
+    _jobs = Dict(key_trait=Unicode(), value_trait=Instance(BuildJob))
+    # Jobs that are queued or running, by build path
+    _jobs_by_build_path = Dict(key_trait=Instance(Path), value_trait=Instance(BuildJob))
+    _finished_jobs = Instance(klass=TTLCache)
+    # In-flight fetches, by repo path
+    _fetches = Dict(key_trait=Instance(Path), value_trait=Instance(asyncio.Future))
+    _workers = List(Instance(asyncio.Task))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._pending = FairScheduler()
+        self._pending_changed = asyncio.Condition()
+        self._finished_jobs = TTLCache(
+            maxsize=self.finished_jobs_max_size, ttl=self.finished_jobs_ttl_seconds
+        )
+
+    def start(self):
+        """
+        Start the workers that process the queue.
+        """
+        self._workers = [
+            asyncio.create_task(self.worker())
+            for _ in range(self.max_concurrent_builds)
+        ]
+
+    async def submit(
+        self,
+        repo: Repo,
+        repo_path: Path,
+        build_path: Path,
+        base_url: str,
+        *,
+        cache_path: Optional[Path] = None,
+        client: str = "",
+        priority: BuildPriority = BuildPriority.interactive,
+    ) -> BuildJob:
+        """
+        Submit a build, returning the job that will perform it.
+
+        If a job for the same build path is already queued or running, return that.
+        Otherwise, raise QueueFullError if the job cannot be admitted.
+
+        :param repo: repository to build.
+        :param repo_path: path into which the repository is fetched.
+        :param build_path: path at which the built site will be created.
+        :param base_url: base URL of the built site.
+        :param cache_path: path at which the builder may cache build state.
+        :param client: identity of the submitting client.
+        :param priority: priority of the build.
+        """
+        try:
+            job = self._jobs_by_build_path[build_path]
+        except KeyError:
+            pass
+        else:
+            self.log.info(f"Joining existing build job {job.id}")
+
+            # Someone is waiting on a background build, so hurry it along. A worker
+            # may take the job whilst we wait for the lock
+            if job.state == BuildState.queued and priority < job.priority:
+                async with self._pending_changed:
+                    if self._pending.remove(job):
+                        job.priority = priority
+                        self._pending.push(job)
+            return job
+
+        self.check_admission(client)
+
+        job = BuildJob(
+            id=uuid.uuid4().hex,
+            repo=repo,
+            repo_path=repo_path,
+            build_path=build_path,
+            base_url=base_url,
+            cache_path=cache_path,
+            client=client,
+            priority=priority,
+            trace_context=context.get_current(),
+        )
+        self._jobs[job.id] = job
+        self._jobs_by_build_path[build_path] = job
+        self.write_status(job)
+        self.log.info(
+            f"Queued {priority.name} build job {job.id} for {repo} from {client!r}"
+        )
+
+        async with self._pending_changed:
+            self._pending.push(job)
+            BUILD_QUEUE_DEPTH.set(len(self._pending))
+            self._pending_changed.notify()
+        return job
+
+    def check_admission(self, client: str):
+        """
+        Raise QueueFullError if a new job from the given client cannot be admitted.
+
+        :param client: identity of the submitting client.
+        """
+        if 0 < self.max_queued_builds <= len(self._pending):
+            raise QueueFullError("Too many builds are queued")
+
+        if 0 < self.max_queued_builds_per_client <= self._pending.count_client(client):
+            raise QueueFullError("Too many builds are queued for this client")
+
+    def get_job(self, job_id: str) -> Optional[BuildJob]:
+        """
+        Return the job with the given ID, or None if it is not known.
+
+        :param job_id: ID of job.
+        """
+        return self._jobs.get(job_id) or self._finished_jobs.get(job_id)
+
+    async def get_job_status(self, job_id: str) -> Optional[dict[str, Any]]:
+        """
+        Return the status of the job with the given ID, which may have been
+        submitted to another process, or None if it is not known.
+
+        :param job_id: ID of job.
+        """
+        job = self.get_job(job_id)
+        if job is not None:
+            return {**job.to_dict(), "position": self.get_position(job)}
+
+        if self.status_path is None:
+            return None
+        status = await asyncio.to_thread(self.read_status, job_id)
+        if status is not None:
+            # Positions in the queues of other processes aren't comparable
+            status["position"] = None
+        return status
+
+    def set_state(self, job: BuildJob, state: BuildState):
+        job.transition(state)
+        self.write_status(job)
+
+    def write_status(self, job: BuildJob):
+        """
+        Atomically write the status of a job, if statuses are shared.
+
+        :param job: job whose status has changed.
+        """
+        if self.status_path is None:
+            return
+
+        path = Path(self.status_path) / f"{job.id}.json"
+        tmp_path = path.with_name(f".tmp-{path.name}")
+        tmp_path.write_text(json.dumps(job.to_dict()))
+        os.replace(tmp_path, path)
+
+    def read_status(self, job_id: str) -> Optional[dict[str, Any]]:
+        """
+        Return the status of a job written by any process, or None if there is none.
+
+        :param job_id: ID of job.
+        """
+        try:
+            return json.loads((Path(self.status_path) / f"{job_id}.json").read_text())
+        except FileNotFoundError:
+            return None
+
+    def remove_expired_statuses(self):
+        """
+        Remove the statuses of jobs that finished longer than
+        `finished_jobs_ttl_seconds` ago.
+
+        Queued and running jobs may go unchanged for longer than that, so their
+        statuses are kept, unless they were orphaned by a process that exited.
+
+        This is blocking, and should be run in a thread.
+        """
+        now = time.time()
+        for entry in os.scandir(self.status_path):
+            try:
+                age_s = now - entry.stat().st_mtime
+                if age_s < self.finished_jobs_ttl_seconds:
+                    continue
+
+                # Hidden files are partial writes, left behind by a process that exited
+                is_orphaned = (
+                    entry.name.startswith(".") or age_s >= ORPHANED_STATUS_AGE_SECONDS
+                )
+                if not is_orphaned:
+                    with open(entry.path) as f:
+                        state = json.load(f)["state"]
+                    if state not in (BuildState.done, BuildState.failed):
+                        continue
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                # Removed by another process
+                pass
+            except (OSError, ValueError, KeyError, TypeError):
+                self.log.warning(f"Ignoring unreadable job status {entry.path}")
+
+    @contextlib.asynccontextmanager
+    async def hold_build_locks(self, job: BuildJob):
+        """
+        Hold the lock on the build path of a job, and a build slot, shared with
+        other processes (if builds are coordinated between processes).
+
+        :param job: job to build.
+        """
+        if self.lock_path is None:
+            yield
+            return
+
+        lock_path = Path(self.lock_path)
+        async with contextlib.AsyncExitStack() as stack:
+            with tracer.start_as_current_span("wait for build locks"):
+                await stack.enter_async_context(
+                    file_lock(get_lock_path(lock_path / "sites", job.build_path.name))
+                )
+                await stack.enter_async_context(
+                    file_semaphore(lock_path / "slots", self.max_concurrent_builds)
+                )
+            yield
+
+    def get_position(self, job: BuildJob) -> Optional[int]:
+        """
+        Return the number of jobs ahead of a queued job, or None if it is not queued.
+
+        :param job: queued job.
+        """
+        if job.state != BuildState.queued:
+            return None
+
+        for position, pending_job in enumerate(self._pending):
+            if pending_job is job:
+                return position
+        return None
+
+    async def worker(self):
+        while True:
+            async with self._pending_changed:
+                await self._pending_changed.wait_for(lambda: self._pending)
+                job = self._pending.pop()
+                BUILD_QUEUE_DEPTH.set(len(self._pending))
+
+            queued_at = job.timings[BuildState.queued]
+            BUILD_QUEUE_WAIT_DURATION.labels(priority=job.priority.name).observe(
+                time.time() - queued_at
+            )
+            BUILDS_RUNNING.inc()
+            try:
+                with tracer.start_as_current_span(
+                    "build job",
+                    context=job.trace_context,
+                    start_time=int(queued_at * 1e9),
+                    attributes={
+                        "jupyterbook_pub.job": job.id,
+                        "jupyterbook_pub.repo": str(job.repo),
+                        "jupyterbook_pub.priority": job.priority.name,
+                    },
+                ):
+                    # Record the time spent waiting for a worker
+                    tracer.start_span("queued", start_time=int(queued_at * 1e9)).end()
+                    await self.run_job(job)
+            except Exception as err:
+                self.log.exception(f"Build job {job.id} failed")
+                job.error = str(err) or err.__class__.__name__
+                self.set_state(job, BuildState.failed)
+            else:
+                self.set_state(job, BuildState.done)
+            finally:
+                BUILDS_RUNNING.dec()
+                # Signal to waiters, even if the build failed
+                job.finished.set()
+
+                del self._jobs[job.id]
+                del self._jobs_by_build_path[job.build_path]
+                self._finished_jobs[job.id] = job
+
+            if self.status_path is not None:
+                await asyncio.to_thread(self.remove_expired_statuses)
+
+    async def run_job(self, job: BuildJob):
+        """
+        Fetch and build the repository for a job.
+
+        :param job: job to run.
+        """
+        # If directly invoked, build path may exist
+        if job.build_path.exists():
+            return
+
+        async with self.hold_build_locks(job):
+            # Another process may have built it whilst we waited
+            if job.build_path.exists():
+                return
+            await self.fetch_and_build(job)
+
+    async def fetch_and_build(self, job: BuildJob):
+        """
+        Fetch and build the repository for a job, which must not be built
+        concurrently.
+
+        :param job: job to run.
+        """
+        self.set_state(job, BuildState.fetching)
+        with tracer.start_as_current_span("fetch"):
+            await self.ensure_fetched(job.repo, job.repo_path)
+
+        self.set_state(job, BuildState.building)
+        status = "failure"
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(self.build_timeout_seconds):
+                with tracer.start_as_current_span(
+                    "execute",
+                    attributes={
+                        "jupyterbook_pub.executor": type(self.executor).__name__,
+                        "jupyterbook_pub.builder": type(self.executor.builder).__name__,
+                    },
+                ):
+                    await self.executor.execute(
+                        job.repo_path, job.build_path, job.base_url, job.cache_path
+                    )
+            status = "success"
+        except TimeoutError:
+            status = "timeout"
+            raise TimeoutError(
+                f"Build exceeded {self.build_timeout_seconds} seconds"
+            ) from None
+        finally:
+            trace.get_current_span().set_attribute("jupyterbook_pub.status", status)
+            BUILD_DURATION.labels(
+                executor=type(self.executor).__name__,
+                builder=type(self.executor.builder).__name__,
+                status=status,
+            ).observe(time.perf_counter() - start)
+
+        if self.latest_builds is not None:
+            await asyncio.to_thread(
+                self.latest_builds.record, job.repo, job.build_path.name
+            )
+
+        # Sweep the storage
+        for storage_manager in self.storage_managers:
+            storage_manager.notify_of_build()
+
+    async def ensure_fetched(self, repo: Repo, repo_path: Path):
+        """
+        Ensure that a repository has been fetched into repo_path.
+
+        Concurrent fetches of the same repo path share a single fetch.
+
+        :param repo: repository to fetch.
+        :param repo_path: path into which the repository is fetched.
+        """
+        if repo_path.exists():
+            return
+
+        try:
+            fetch_future = self._fetches[repo_path]
+        except KeyError:
+            fetch_future = self._fetches[repo_path] = asyncio.ensure_future(
+                self.fetch_atomic(repo, repo_path)
+            )
+            fetch_future.add_done_callback(lambda f: self._on_fetch_done(repo_path, f))
+        else:
+            self.log.info(f"Waiting for in-flight fetch of {repo}")
+
+        # Don't let one cancelled job cancel the fetch for everyone else
+        await asyncio.shield(fetch_future)
+
+    def _on_fetch_done(self, repo_path: Path, fetch_future: asyncio.Future):
+        self._fetches.pop(repo_path, None)
+
+        # Mark any exception as retrieved, in case every waiter was cancelled
+        if not fetch_future.cancelled():
+            fetch_future.exception()
+
+    async def fetch_atomic(self, repo: Repo, repo_path: Path):
+        """
+        Fetch a repository into a staging directory, and atomically move it to
+        repo_path, so that a partial checkout is never visible.
+
+        :param repo: repository to fetch.
+        :param repo_path: path into which the repository is fetched.
+        """
+        # Stage alongside the destination, so that the rename is atomic
+        staging_path = Path(
+            tempfile.mkdtemp(prefix=f".fetch-{repo_path.name}-", dir=repo_path.parent)
+        )
+        try:
+            # Mark the fetch as in progress, so that it is not reclaimed as an orphan
+            async with hold_in_use(staging_path):
+                self.log.info(f"Fetching {repo}...\n")
+                # Fetchers expect to create the output directory themselves
+                checkout_path = staging_path / "checkout"
+                status = "failure"
+                start = time.perf_counter()
+                try:
+                    await fetch(repo, checkout_path)
+                    status = "success"
+                finally:
+                    FETCH_DURATION.labels(status=status).observe(
+                        time.perf_counter() - start
+                    )
+
+                try:
+                    checkout_path.rename(repo_path)
+                except OSError:
+                    # Somebody else (e.g. another process) got there first
+                    if not repo_path.exists():
+                        raise
+                self.log.info(f"Fetched {repo}")
+        finally:
+            await asyncio.to_thread(shutil.rmtree, staging_path, ignore_errors=True)
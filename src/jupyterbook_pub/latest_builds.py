@@ -0,0 +1,78 @@
+"""
+Index of the latest successful build of each repository.
+
+Each commit of a moving ref (e.g. a branch) is built into a different site, so
+a new commit would otherwise make its readers wait for a build. Recording the
+latest build of each repository, independent of its version, lets the previous
+build be served while the new one is built in the background.
+"""
+
+import dataclasses
+import json
+import os
+import secrets
+from pathlib import Path
+from typing import Optional
+
+from repoproviders.resolvers.base import Repo
+from traitlets import Unicode
+from traitlets.config import LoggingConfigurable
+
+from .cache import get_repo_version, make_repo_cache_key
+
+
+@dataclasses.dataclass(frozen=True)
+class LatestBuild:
+    # Rendered cache key of the built site
+    build_cache_key: str
+    # Version (e.g. commit) of the repository that was built
+    version: Optional[str]
+
+
+class LatestBuildIndex(LoggingConfigurable):
+    """
+    Record the latest successful build of each repository, as one small file per
+    repository (keyed by its version-independent cache key).
+
+    Records are replaced atomically, so that readers in any process see either
+    the previous build or the new one.
+    """
+
+    path = Unicode(help="Path to directory in which builds are recorded")
+
+    def get_record_path(self, repo: Repo) -> Path:
+        return Path(self.path) / make_repo_cache_key(repo)
+
+    def get(self, repo: Repo) -> Optional[LatestBuild]:
+        """
+        Return the latest successful build of any version of a repository, or None
+        if there is none.
+
+        :param repo: repository.
+        """
+        try:
+            with open(self.get_record_path(repo)) as f:
+                data = json.load(f)
+            return LatestBuild(
+                build_cache_key=data["build_cache_key"], version=data["version"]
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            self.log.warning(f"Ignoring unreadable latest build record for {repo}")
+            return None
+
+    def record(self, repo: Repo, build_cache_key: str):
+        """
+        Record a successful build of a repository as its latest.
+
+        :param repo: repository (at the version that was built).
+        :param build_cache_key: rendered cache key of the built site.
+        """
+        record_path = self.get_record_path(repo)
+        record_path.parent.mkdir(parents=True, exist_ok=True)
+
+        data = {"build_cache_key": build_cache_key, "version": get_repo_version(repo)}
+        tmp_path = record_path.with_name(f".tmp-{secrets.token_hex(8)}")
+        tmp_path.write_text(json.dumps(data))
+        os.replace(tmp_path, record_path)
@@ -0,0 +1,160 @@
+"""
+Locks shared between processes, using flock(2) on files under the storage root.
+
+Locks are held for as long as their file is open, so they are released if the
+process holding them dies. Acquisition polls rather than blocking, so that it can
+be cancelled.
+"""
+
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import os
+from pathlib import Path
+
+# Name of the directory of lock files under the storage root
+LOCKS_NAME = "locks"
+
+# Number of lock files that keys are hashed into. Lock files are never removed, as
+# that would race with processes opening them, so there are a bounded number
+LOCK_BUCKETS = 4096
+
+
+def get_lock_path(locks_path: Path, key: str) -> Path:
+    """
+    Return the path to the lock file for a key.
+
+    Keys share a lock file with (rarely) a few others.
+
+    :param locks_path: directory of lock files.
+    :param key: key to lock.
+    """
+    bucket = int(hashlib.sha256(key.encode()).hexdigest(), 16) % LOCK_BUCKETS
+    return locks_path / f"{bucket:04}.lock"
+
+
+def try_lock(path: Path) -> int | None:
+    """
+    Try to lock a file without blocking, returning its descriptor if the lock was
+    acquired, or None if it is held by another (process or) descriptor.
+
+    :param path: path to lock file.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+@contextlib.contextmanager
+def try_file_lock(path: Path):
+    """
+    Hold an exclusive lock on a file if it is free, yielding whether it was
+    acquired.
+
+    :param path: path to lock file, which is created if needed.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = try_lock(path)
+    try:
+        yield fd is not None
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+@contextlib.asynccontextmanager
+async def file_lock(path: Path, poll_interval: float = 0.1):
+    """
+    Hold an exclusive lock on a file.
+
+    :param path: path to lock file, which is created if needed.
+    :param poll_interval: time (in seconds) between attempts to acquire the lock.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    while (fd := try_lock(path)) is None:
+        await asyncio.sleep(poll_interval)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+@contextlib.asynccontextmanager
+async def file_semaphore(path: Path, value: int, poll_interval: float = 0.1):
+    """
+    Hold one of a fixed number of slots, each of which is a lock file.
+
+    :param path: directory of slot lock files, which is created if needed.
+    :param value: number of slots.
+    :param poll_interval: time (in seconds) between attempts to acquire a slot.
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    fd = None
+    while fd is None:
+        for slot in range(value):
+            if (fd := try_lock(path / f"{slot}.lock")) is not None:
+                break
+        else:
+            await asyncio.sleep(poll_interval)
+
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+@contextlib.asynccontextmanager
+async def hold_in_use(path: Path, poll_interval: float = 0.1):
+    """
+    Mark a (temporary) directory as in use, so that it is not removed as an orphan
+    (see `try_lock_unused`).
+
+    Raise FileNotFoundError if the directory was removed before it was marked.
+
+    :param path: path to directory.
+    :param poll_interval: time (in seconds) between attempts to mark the directory.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(poll_interval)
+
+        # The directory may have been renamed to be removed whilst we waited
+        if not os.path.samestat(os.fstat(fd), os.stat(path)):
+            raise FileNotFoundError(f"{path} was removed")
+        yield
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def try_lock_unused(path: Path):
+    """
+    Hold an exclusive lock on a directory if it is not marked as in use (see
+    `hold_in_use`), yielding whether it was acquired.
+
+    :param path: path to directory.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            acquired = False
+        else:
+            acquired = True
+        yield acquired
+    finally:
+        os.close(fd)
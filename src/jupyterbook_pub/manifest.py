@@ -0,0 +1,135 @@
+"""
+Per-build file manifests.
+
+A built site is immutable once it has been moved into place, so everything that
+the server needs to know about its files (size, content hash, type) can be
+computed once at the end of the build and recorded alongside it.
+"""
+
+import dataclasses
+import hashlib
+import json
+import mimetypes
+import os
+from pathlib import Path
+from typing import Optional
+
+from .compression import ENCODING_SUFFIXES
+
+# Written into the root of each built site. This is never served.
+MANIFEST_NAME = ".jupyterbook-pub-manifest.json"
+MANIFEST_VERSION = 1
+
+
+@dataclasses.dataclass(frozen=True)
+class FileEntry:
+    size: int
+    hash: str
+    mime_type: str
+    # Content-Encodings for which a compressed sidecar exists
+    encodings: tuple[str, ...] = ()
+
+
+@dataclasses.dataclass(frozen=True)
+class Manifest:
+    files: dict[str, FileEntry]
+
+    def get(self, path: str) -> Optional[FileEntry]:
+        return self.files.get(path)
+
+
+def hash_file(path: Path) -> str:
+    """
+    Compute the SHA-256 hex digest of a file.
+
+    :param path: path to file.
+    """
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(64 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def build_manifest(site_path: Path) -> Manifest:
+    """
+    Build a manifest describing all files in a built site.
+
+    This is blocking, and should be run in a thread.
+
+    :param site_path: path to built site.
+    """
+    files = {}
+    for root, _, names in os.walk(site_path):
+        for name in names:
+            path = Path(root) / name
+            rel_path = path.relative_to(site_path).as_posix()
+            if rel_path == MANIFEST_NAME:
+                continue
+
+            mime_type, _ = mimetypes.guess_type(name)
+            files[rel_path] = FileEntry(
+                size=path.stat().st_size,
+                hash=hash_file(path),
+                mime_type=mime_type or "application/octet-stream",
+            )
+
+    # Record which sidecars exist for each file
+    for rel_path, entry in files.items():
+        encodings = tuple(
+            encoding
+            for encoding, suffix in ENCODING_SUFFIXES.items()
+            if rel_path + suffix in files
+        )
+        if encodings:
+            files[rel_path] = dataclasses.replace(entry, encodings=encodings)
+
+    return Manifest(files=files)
+
+
+def write_manifest(site_path: Path) -> Manifest:
+    """
+    Build and write the manifest for a built site.
+
+    :param site_path: path to built site.
+    """
+    manifest = build_manifest(site_path)
+    data = {
+        "version": MANIFEST_VERSION,
+        "files": {
+            path: dataclasses.asdict(entry) for path, entry in manifest.files.items()
+        },
+    }
+    with open(site_path / MANIFEST_NAME, "w") as f:
+        json.dump(data, f)
+    return manifest
+
+
+def read_manifest(site_path: Path) -> Optional[Manifest]:
+    """
+    Read the manifest for a built site.
+
+    Return None if the site has no (readable) manifest.
+
+    :param site_path: path to built site.
+    """
+    try:
+        with open(site_path / MANIFEST_NAME) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if data.get("version") != MANIFEST_VERSION:
+        return None
+
+    return Manifest(
+        files={
+            path: FileEntry(
+                size=entry["size"],
+                hash=entry["hash"],
+                mime_type=entry["mime_type"],
+                encodings=tuple(entry["encodings"]),
+            )
+            for path, entry in data["files"].items()
+        }
+    )
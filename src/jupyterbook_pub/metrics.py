@@ -0,0 +1,118 @@
+"""
+Prometheus metrics.
+
+Metrics are registered with the default registry, and exposed at `/metrics` by
+the application.
+
+When serving with multiple processes, each process only knows its own metrics.
+Setting PROMETHEUS_MULTIPROC_DIR to an empty directory before starting the
+application makes each process write its metrics there, so that `/metrics`
+reports those of all processes, whichever process serves it.
+"""
+
+import os
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+
+# Directory in which processes write their metrics. Read by prometheus_client
+# when it is imported, so this must be set before the application starts
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+# Builds take from seconds to many minutes
+BUILD_BUCKETS = (1, 2.5, 5, 10, 20, 30, 60, 120, 180, 300, 600, float("inf"))
+
+# Each process has its own queue, so add up those of live processes
+BUILD_QUEUE_DEPTH = Gauge(
+    "jupyterbook_pub_build_queue_depth",
+    "Number of builds waiting for a worker",
+    multiprocess_mode="livesum",
+)
+BUILDS_RUNNING = Gauge(
+    "jupyterbook_pub_builds_running",
+    "Number of builds being fetched or built",
+    multiprocess_mode="livesum",
+)
+BUILD_QUEUE_WAIT_DURATION = Histogram(
+    "jupyterbook_pub_build_queue_wait_duration_seconds",
+    "Time that builds spend waiting for a worker",
+    ["priority"],
+    buckets=BUILD_BUCKETS,
+)
+FETCH_DURATION = Histogram(
+    "jupyterbook_pub_fetch_duration_seconds",
+    "Time taken to fetch a repository",
+    ["status"],
+    buckets=BUILD_BUCKETS,
+)
+BUILD_DURATION = Histogram(
+    "jupyterbook_pub_build_duration_seconds",
+    "Time taken by the executor to build a site",
+    ["executor", "builder", "status"],
+    buckets=BUILD_BUCKETS,
+)
+
+RESOLVER_LOOKUPS = Counter(
+    "jupyterbook_pub_resolver_lookups_total",
+    "Resolutions of repository specs, by how they were answered",
+    ["result"],
+)
+RESOLVE_DURATION = Histogram(
+    "jupyterbook_pub_resolve_duration_seconds",
+    "Time taken to resolve a repository spec against upstream providers",
+)
+
+WEBHOOK_DELIVERIES = Counter(
+    "jupyterbook_pub_webhook_deliveries_total",
+    "Push webhook deliveries, by how they were handled",
+    ["result"],
+)
+
+SWEEP_DURATION = Histogram(
+    "jupyterbook_pub_storage_sweep_duration_seconds",
+    "Time taken to sweep a storage directory",
+    ["storage"],
+)
+SWEEP_REMOVED = Counter(
+    "jupyterbook_pub_storage_removed_total",
+    "Number of directories (including orphans) removed by sweeps",
+    ["storage"],
+)
+SWEEP_FREED_BYTES = Counter(
+    "jupyterbook_pub_storage_freed_bytes_total",
+    "Number of bytes freed by sweeps",
+    ["storage"],
+)
+
+SERVE_REQUEST_DURATION = Histogram(
+    "jupyterbook_pub_serve_request_duration_seconds",
+    "Time taken to respond to requests for built sites",
+    ["code"],
+)
+
+
+def is_multiprocess_metrics() -> bool:
+    """
+    Return True if metrics are shared between processes (see `MULTIPROC_DIR_ENV`).
+    """
+    return MULTIPROC_DIR_ENV in os.environ
+
+
+def collect_metrics() -> bytes:
+    """
+    Return the metrics of this process, or of all processes if they are shared, in
+    the Prometheus text format.
+    """
+    if not is_multiprocess_metrics():
+        return generate_latest(REGISTRY)
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
@@ -0,0 +1,82 @@
+"""
+Agent run by idle build pods in the Kubernetes warm pool.
+
+A pool pod is started before there is any work for it, so that scheduling, image
+pulls and volume mounts happen off the critical path. The agent waits for the
+executor to write a job file, and then replaces itself with the builder command
+described by that file. If no job is written before the idle timeout, the agent
+exits with an error.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+
+def wait_for_job(
+    job_path: Path, poll_interval: float, timeout: float
+) -> Optional[dict]:
+    """
+    Wait for a job file to appear, and return the job that it describes (the
+    command to run, and extra environment variables), or None if no job appeared
+    before the timeout.
+
+    The job file is written atomically by the executor, so it is never seen
+    partially written.
+
+    :param job_path: path to job file.
+    :param poll_interval: time (in seconds) between checks for the job file.
+    :param timeout: time (in seconds) to wait for the job file.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with open(job_path) as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(poll_interval)
+            continue
+
+        job_path.unlink(missing_ok=True)
+        return job
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("job_path", type=Path, help="Path to the job file")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=0.05,
+        help="Time (in seconds) between checks for the job file",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60 * 60,
+        help="Time (in seconds) to wait for a job before exiting",
+    )
+    args = parser.parse_args(argv)
+
+    job = wait_for_job(args.job_path, args.poll_interval, args.timeout)
+    if job is None:
+        # Fail, so that the pod is not mistaken for a completed build. The executor
+        # will replace this pod if it is still wanted
+        sys.exit("No job was submitted, exiting")
+
+    command = job["args"]
+    # e.g. the trace context of the build
+    os.environ.update(job.get("env", {}))
+
+    print(f"Running {command}", file=sys.stderr, flush=True)
+    os.execvp(command[0], command)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Caching of resolver answers.
+
+Resolution involves network requests to upstream providers (GitHub, Zenodo,
+DOI resolvers, etc), and happens on every request for a built site. Answers are
+cached in memory, and optionally in an SQLite database under the storage root so
+that they survive restarts and can be shared between processes on the same host.
+"""
+
+import dataclasses
+import functools
+import importlib
+import json
+import pkgutil
+import sqlite3
+import threading
+import time
+import types
+import typing
+from pathlib import Path
+from typing import Any, Optional
+
+import repoproviders.resolvers
+from repoproviders.resolvers.base import Exists, MaybeExists
+from repoproviders.resolvers.serialize import JSONEncoder, to_dict
+from traitlets import Integer, Unicode
+from traitlets.config import LoggingConfigurable
+from yarl import URL
+
+
+@dataclasses.dataclass
+class ResolverCacheEntry:
+    answer: Exists | MaybeExists
+    # Wall-clock time at which the answer was (last) resolved upstream
+    resolved_at: float
+    # Number of times the answer has been served from memory since it was resolved
+    hits: int = 0
+    # Number of times the answer has been refreshed ahead of expiry
+    refreshes: int = 0
+
+
+@functools.cache
+def get_repo_kinds() -> dict[str, type]:
+    """
+    Return a mapping of name → class for all of the repo kinds known to repoproviders.
+    """
+    kinds = {}
+    for module_info in pkgutil.iter_modules(repoproviders.resolvers.__path__):
+        module = importlib.import_module(
+            f"{repoproviders.resolvers.__name__}.{module_info.name}"
+        )
+        for value in vars(module).values():
+            if (
+                isinstance(value, type)
+                and dataclasses.is_dataclass(value)
+                and hasattr(value, "immutable")
+            ):
+                kinds[value.__name__] = value
+    return kinds
+
+
+def _from_data(tp: Any, value: Any) -> Any:
+    """
+    Convert a JSON value back into an instance of the given type.
+
+    :param tp: type annotation of the value.
+    :param value: JSON value.
+    """
+    if value is None:
+        return None
+
+    if isinstance(tp, types.UnionType) or typing.get_origin(tp) is typing.Union:
+        for arg in typing.get_args(tp):
+            if arg is not type(None):
+                return _from_data(arg, value)
+
+    if tp is URL:
+        return URL(value)
+
+    if dataclasses.is_dataclass(tp):
+        hints = typing.get_type_hints(tp)
+        return tp(
+            **{
+                field.name: _from_data(hints[field.name], value[field.name])
+                for field in dataclasses.fields(tp)
+            }
+        )
+
+    return value
+
+
+def answer_from_dict(data: dict) -> Exists | MaybeExists:
+    """
+    Convert the canonical dict representation of an answer back into an answer.
+
+    This is the inverse of `repoproviders.resolvers.serialize.to_dict`, for answers
+    that exist.
+
+    :param data: dict representation of answer.
+    """
+    certainty = {"Exists": Exists, "MaybeExists": MaybeExists}[data["certainity"]]
+    kind = get_repo_kinds()[data["kind"]]
+    return certainty(_from_data(kind, data["data"]))
+
+
+class PersistentResolverCache(LoggingConfigurable):
+    """
+    SQLite-backed resolver cache.
+
+    SQLite (in WAL mode) permits several processes on the same host to share the
+    same cache file.
+    """
+
+    path = Unicode(None, allow_none=False, help="Path to the SQLite database")
+    ttl_seconds = Integer(10 * 60, help="How long to cache answers (in seconds)")
+    max_size = Integer(128, help="Max number of answers to cache")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+        # Connection is shared between the worker threads that we use for I/O
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=10, check_same_thread=False, isolation_level=None
+        )
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS answers (
+                    question TEXT PRIMARY KEY,
+                    answer TEXT NOT NULL,
+                    resolved_at REAL NOT NULL
+                )
+                """
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS answers_resolved_at ON answers (resolved_at)"
+            )
+
+    def _to_entry(self, answer: str, resolved_at: float) -> ResolverCacheEntry | None:
+        try:
+            return ResolverCacheEntry(
+                answer=answer_from_dict(json.loads(answer)), resolved_at=resolved_at
+            )
+        except Exception:
+            # Probably written by a different version of repoproviders
+            self.log.debug("Ignoring unreadable cached answer", exc_info=True)
+            return None
+
+    def get(self, question: str) -> Optional[ResolverCacheEntry]:
+        """
+        Return the cached answer to a question, or None if it is not cached.
+
+        :param question: question to look up.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT answer, resolved_at FROM answers "
+                "WHERE question = ? AND resolved_at > ?",
+                (question, time.time() - self.ttl_seconds),
+            ).fetchone()
+        if row is None:
+            return None
+        return self._to_entry(*row)
+
+    def set(self, question: str, entry: ResolverCacheEntry):
+        """
+        Cache the answer to a question, evicting expired and excess answers.
+
+        :param question: question that was resolved.
+        :param entry: answer to cache.
+        """
+        answer = json.dumps(to_dict(entry.answer), cls=JSONEncoder)
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?)",
+                (question, answer, entry.resolved_at),
+            )
+            self._connection.execute(
+                "DELETE FROM answers WHERE resolved_at <= ?",
+                (time.time() - self.ttl_seconds,),
+            )
+            self._connection.execute(
+                "DELETE FROM answers WHERE question NOT IN "
+                "(SELECT question FROM answers ORDER BY resolved_at DESC LIMIT ?)",
+                (self.max_size,),
+            )
+
+    def delete(self, questions: list[str]):
+        """
+        Remove the cached answers to questions.
+
+        :param questions: questions whose answers should be removed.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM answers WHERE question = ?",
+                [(question,) for question in questions],
+            )
+
+    def load(self) -> dict[str, ResolverCacheEntry]:
+        """
+        Return all unexpired answers, most recently resolved last.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT question, answer, resolved_at FROM answers "
+                "WHERE resolved_at > ? ORDER BY resolved_at DESC LIMIT ?",
+                (time.time() - self.ttl_seconds, self.max_size),
+            ).fetchall()
+
+        entries = {}
+        for question, *row in reversed(rows):
+            entry = self._to_entry(*row)
+            if entry is not None:
+                entries[question] = entry
+        return entries
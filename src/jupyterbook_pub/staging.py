@@ -0,0 +1,116 @@
+"""
+Staging of source trees.
+
+Builds need a writable copy of the (read-only) repository checkout. Copying every
+byte of a large, data-heavy repository can dominate the build time, so where the
+filesystem permits we create the copy with reflinks (copy-on-write clones) instead,
+falling back to a plain copy. Hardlinks share files with the source, so they are
+only used when asked for, by builders that never write into their source.
+"""
+
+import collections
+import fcntl
+import os
+import shutil
+from pathlib import Path
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# Strategy → methods to try, in order. Hardlinks are never chosen automatically
+STAGING_STRATEGIES = {
+    "auto": ("reflink", "copy"),
+    "reflink": ("reflink", "copy"),
+    "hardlink": ("hardlink", "copy"),
+    "copy": ("copy",),
+}
+
+
+def reflink_file(source: Path, dest: Path):
+    """
+    Create dest as a copy-on-write clone of source.
+
+    Raise OSError if the filesystem does not support reflinks.
+
+    :param source: path to file to clone.
+    :param dest: path at which to create the clone.
+    """
+    try:
+        with open(source, "rb") as f_source, open(dest, "xb") as f_dest:
+            fcntl.ioctl(f_dest.fileno(), FICLONE, f_source.fileno())
+    except OSError:
+        dest.unlink(missing_ok=True)
+        raise
+    shutil.copystat(source, dest)
+
+
+def hardlink_file(source: Path, dest: Path):
+    os.link(source, dest)
+
+
+def copy_file(source: Path, dest: Path):
+    shutil.copy2(source, dest)
+
+
+STAGING_METHODS = {
+    "reflink": reflink_file,
+    "hardlink": hardlink_file,
+    "copy": copy_file,
+}
+
+
+def stage_tree(source: Path, dest: Path, strategy: str = "auto") -> dict[str, int]:
+    """
+    Populate dest with the contents of source, without copying file data where
+    the chosen strategy and filesystem permit.
+
+    Symlinks are reproduced as symlinks, rather than followed. Files that are
+    hardlinked are shared with the source, so they must be replaced (e.g. written
+    to a temporary file and renamed) rather than modified in place.
+
+    This is blocking, and should be run in a thread.
+    Return the number of files staged by each method.
+
+    :param source: path to directory to stage.
+    :param dest: path to new or empty directory to populate.
+    :param strategy: name of staging strategy (see `STAGING_STRATEGIES`).
+    """
+    methods = list(STAGING_STRATEGIES[strategy])
+    counts = collections.Counter()
+
+    dest.mkdir(parents=True, exist_ok=True)
+    for root, dirnames, filenames in os.walk(source):
+        root_path = Path(root)
+        dest_root_path = dest / root_path.relative_to(source)
+
+        for name in dirnames:
+            source_path = root_path / name
+            dest_path = dest_root_path / name
+            if source_path.is_symlink():
+                # os.walk does not descend into symlinked directories
+                dest_path.symlink_to(os.readlink(source_path))
+            else:
+                dest_path.mkdir(exist_ok=True)
+
+        for name in filenames:
+            source_path = root_path / name
+            dest_path = dest_root_path / name
+            if source_path.is_symlink():
+                dest_path.symlink_to(os.readlink(source_path))
+                continue
+
+            # If a method fails (e.g. unsupported filesystem, or a different
+            # device), don't try it again for the rest of the tree
+            while True:
+                method = methods[0]
+                try:
+                    STAGING_METHODS[method](source_path, dest_path)
+                except OSError:
+                    if len(methods) == 1:
+                        raise
+                    methods.pop(0)
+                else:
+                    counts[method] += 1
+                    break
+
+    return dict(counts)
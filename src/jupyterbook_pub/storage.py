@@ -1,28 +1,261 @@
 import asyncio
+import contextlib
+import dataclasses
+import os
+import sqlite3
+import threading
 import time
 import shutil
 
 from traitlets.config import LoggingConfigurable
-from traitlets import default, Integer, TraitError, validate, Set, Unicode, Instance
+from traitlets import (
+    default,
+    Dict,
+    Integer,
+    TraitError,
+    validate,
+    Set,
+    Unicode,
+    Instance,
+)
 
 from pathlib import Path
+from typing import Optional
+
+from .blobs import collect_garbage
+from .locks import try_file_lock, try_lock_unused
+from .metrics import SWEEP_DURATION, SWEEP_FREED_BYTES, SWEEP_REMOVED
+
+# Written into the storage root of a StorageManager with a byte budget
+ACCESS_INDEX_NAME = ".access-index.sqlite"
+
+
+@dataclasses.dataclass
+class IndexEntry:
+    name: str
+    size: int
+    # Modification time of the directory when it was indexed
+    created_at: float
+    last_access: Optional[float]
+    hits: int
+
+    @property
+    def last_used(self) -> float:
+        return self.last_access or self.created_at
+
+
+def get_tree_size(path: Path, shared: bool = False) -> int:
+    """
+    Return the total size (in bytes) of the files under a directory.
+
+    :param path: path to directory.
+    :param shared: whether files may be hardlinked into a blob store, in which
+    case the size of each file is divided between the directories that link it.
+    """
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if shared:
+                # One of the links is held by the blob store
+                size += stat.st_size // max(stat.st_nlink - 1, 1)
+            else:
+                size += stat.st_size
+    return size
+
+
+class AccessIndex(LoggingConfigurable):
+    """
+    SQLite index of the directories under a storage root, recording their size,
+    creation time, last access and number of hits.
+    """
+
+    path = Unicode(None, allow_none=False, help="Path to the SQLite database")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Connection is shared between the worker threads that we use for I/O
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=10, check_same_thread=False, isolation_level=None
+        )
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    name TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+
+    def entries(self) -> list[IndexEntry]:
+        """
+        Return all entries, least recently used first.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT name, size, created_at, last_access, hits FROM entries "
+                "ORDER BY COALESCE(last_access, created_at)"
+            ).fetchall()
+        return [IndexEntry(*row) for row in rows]
+
+    def record_accesses(self, accesses: dict[str, tuple[float, int]]):
+        """
+        Record accesses of directories.
+
+        Directories that have not yet been indexed are added with a placeholder
+        size, which is computed by the next `sync`.
+
+        :param accesses: mapping of name → (time of last access, number of hits).
+        """
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.executemany(
+                "INSERT INTO entries (name, size, created_at, last_access, hits) "
+                "VALUES (?, 0, 0, ?, ?) ON CONFLICT (name) DO UPDATE SET "
+                "last_access = MAX(COALESCE(last_access, 0), excluded.last_access), "
+                "hits = hits + excluded.hits",
+                [
+                    (name, last_access, hits)
+                    for name, (last_access, hits) in accesses.items()
+                ],
+            )
+
+    def sync(self, storage_path: Path, shared: bool = False):
+        """
+        Bring the index up to date with the directories under storage_path, adding
+        new (or replaced) directories and removing deleted ones.
+
+        This is blocking, and should be run in a thread.
+
+        :param storage_path: storage root.
+        :param shared: whether files may be hardlinked into a blob store.
+        """
+        indexed = {entry.name: entry for entry in self.entries()}
+
+        current = {}
+        for path in storage_path.iterdir():
+            # Skip temporary directories, and the index itself
+            if path.name.startswith(".") or not path.is_dir():
+                continue
+            current[path.name] = path.stat().st_mtime
+
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.executemany(
+                "DELETE FROM entries WHERE name = ?",
+                [(name,) for name in indexed.keys() - current.keys()],
+            )
+
+        for name, mtime in current.items():
+            entry = indexed.get(name)
+            if entry is not None and entry.created_at == mtime:
+                continue
+
+            size = get_tree_size(storage_path / name, shared)
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "INSERT INTO entries (name, size, created_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (name) DO UPDATE SET size = excluded.size, "
+                    "created_at = excluded.created_at",
+                    (name, size, mtime),
+                )
+
+    def remove(self, name: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM entries WHERE name = ?", (name,))
 
 
 class StorageManager(LoggingConfigurable):
     max_age_hours = Integer(12, help="Maximum age of directory in hours")
+    max_bytes = Integer(
+        0,
+        config=True,
+        help="""
+        Maximum total size of the directories in bytes (0 for no limit).
+
+        When set, the access of each directory is tracked, and the least recently
+        used directories are removed first once the limit is exceeded. Directories
+        are also removed once they have not been used for `max_age_hours`.
+        """,
+    )
+    access_flush_interval_seconds = Integer(
+        10, config=True, help="How often to write recorded accesses to the index"
+    )
     build_interval = Integer(
         10, help="Number of builds after which a check is performed"
     )
     builds_since_sweep = Integer(0, help="Number of builds since last sweep")
+    sweep_interval_seconds = Integer(
+        60 * 60,
+        config=True,
+        help="How often to sweep, regardless of builds (0 to only sweep after builds)",
+    )
+    orphan_max_age_seconds = Integer(
+        60 * 60,
+        config=True,
+        help="""
+        Age after which a temporary (hidden) directory is considered to have been
+        left behind by a failed build or fetch, and is removed.
+        """,
+    )
     storage_root = Unicode(None, allow_none=False, help="Storage root path")
+    blobs_path = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Path to the blob store that files under the storage root may be hardlinked
+        into. Sizes are divided between the directories sharing a blob, and blobs
+        that are no longer linked from any directory are removed by each sweep.
+        """,
+    )
+
+    lock_path = Unicode(
+        None,
+        allow_none=True,
+        help="""
+        Path to a lock file that is held whilst sweeping, so that processes sharing
+        the storage root take turns to sweep it, or None if this is the only process.
+        """,
+    )
+
+    access_index = Instance(klass=AccessIndex, allow_none=True)
 
     _sweeps = Set(trait=Instance(asyncio.Task))
+    _sweeper = Instance(klass=asyncio.Task, allow_none=True)
+    # Accesses not yet written to the index: name → (time of last access, hits)
+    _pending_accesses = Dict()
+    _flush_handle = Instance(klass=asyncio.TimerHandle, allow_none=True)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._sweep_lock = asyncio.Lock()
+        if self.max_bytes:
+            self.access_index = AccessIndex(
+                parent=self, path=str(Path(self.storage_root) / ACCESS_INDEX_NAME)
+            )
 
     @default("_event")
     def _default_event(self):
         return asyncio.Event()
 
-    @validate("max_age_hours", "build_interval")
+    @validate(
+        "max_age_hours",
+        "max_bytes",
+        "build_interval",
+        "sweep_interval_seconds",
+        "orphan_max_age_seconds",
+    )
     def _validate_ages(self, proposal):
         value = proposal["value"]
         name = proposal["trait"].name
@@ -30,10 +263,47 @@ class StorageManager(LoggingConfigurable):
             raise TraitError(f"{name} value must be positive integer, not {value}")
         return value
 
+    def record_access(self, name: str):
+        """
+        Record an access of a directory. Accesses are batched in memory, and
+        periodically written to the index.
+
+        :param name: name of directory under the storage root.
+        """
+        if self.access_index is None:
+            return
+
+        _, hits = self._pending_accesses.get(name, (None, 0))
+        self._pending_accesses[name] = (time.time(), hits + 1)
+
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.access_flush_interval_seconds, self._schedule_flush
+            )
+
+    def _schedule_flush(self):
+        self._flush_handle = None
+        task = asyncio.create_task(self.flush_accesses())
+        self._sweeps.add(task)
+        task.add_done_callback(self._sweeps.discard)
+
+    async def flush_accesses(self):
+        """
+        Write recorded accesses to the index.
+        """
+        accesses, self._pending_accesses = self._pending_accesses, {}
+        if not accesses:
+            return
+        try:
+            await asyncio.to_thread(self.access_index.record_accesses, accesses)
+        except Exception:
+            self.log.exception("An error occurred whilst recording accesses")
+
     def notify_of_build(self):
         self.builds_since_sweep += 1
 
-        if self.builds_since_sweep <= self.build_interval:
+        # A burst of builds may exceed the byte budget, so check after every build
+        if self.builds_since_sweep <= self.build_interval and not self.max_bytes:
             return
 
         self.builds_since_sweep = 0
@@ -47,13 +317,84 @@ class StorageManager(LoggingConfigurable):
         new_path = path.rename(path.with_name(f".delete-{path.name}"))
         shutil.rmtree(new_path)
 
-    async def perform_sweep(self):
+    def remove_directory(self, path: Path, size: Optional[int] = None) -> int:
+        """
+        Atomically remove a directory, returning the number of bytes freed.
+
+        This is blocking, and should be run in a thread.
+
+        :param path: path to directory.
+        :param size: size of directory, if known.
+        """
+        if size is None:
+            size = get_tree_size(path, self.blobs_path is not None)
+        self.atomic_remove(path)
+        return size
+
+    def reclaim_orphans(self) -> tuple[int, int]:
+        """
+        Remove temporary directories that were left behind by failed builds,
+        fetches, or removals, returning the number of directories removed and the
+        number of bytes freed.
+
+        Temporary directories are hidden. Those that are still in use are either
+        younger than `orphan_max_age_seconds`, or marked as in use (see
+        `hold_in_use`), e.g. by a long build.
+
+        This is blocking, and should be run in a thread.
+        """
         now = time.time()
-        storage_path = Path(self.storage_root)
+        n_removed = n_bytes = 0
+        for path in Path(self.storage_root).iterdir():
+            try:
+                if (
+                    not path.name.startswith(".")
+                    or path.is_symlink()
+                    or not path.is_dir()
+                ):
+                    continue
 
-        for path in storage_path.iterdir():
+                # Directories are only renamed to .delete-* in order to be removed
+                if not path.name.startswith(".delete-"):
+                    age_s = now - path.stat().st_mtime
+                    if age_s < self.orphan_max_age_seconds:
+                        continue
+
+                    # Move the directory aside whilst it is locked, so that nobody
+                    # can start using it as we remove it
+                    with try_lock_unused(path) as unused:
+                        if not unused:
+                            continue
+                        remove_path = path.rename(
+                            path.with_name(f".delete-{path.name}")
+                        )
+                else:
+                    remove_path = path
+
+                size = get_tree_size(remove_path, self.blobs_path is not None)
+                shutil.rmtree(remove_path)
+                n_removed += 1
+                n_bytes += size
+                self.log.info(f"Removed orphaned {path}")
+            except FileNotFoundError:
+                # Removed by somebody else
+                pass
+            except Exception:
+                self.log.exception(f"An error occurred whilst handling path {path}")
+        return n_removed, n_bytes
+
+    def sweep_by_age(self) -> tuple[int, int]:
+        """
+        Remove directories older than `max_age_hours`, returning the number of
+        directories removed and the number of bytes freed.
+
+        This is blocking, and should be run in a thread.
+        """
+        now = time.time()
+        n_removed = n_bytes = 0
+        for path in Path(self.storage_root).iterdir():
             try:
-                if not path.is_dir():
+                if path.name.startswith(".") or not path.is_dir():
                     continue
 
                 stat = path.stat()
@@ -63,7 +404,123 @@ class StorageManager(LoggingConfigurable):
                 if age_h < self.max_age_hours:
                     continue
 
-                self.atomic_remove(path)
+                n_bytes += self.remove_directory(path)
+                n_removed += 1
                 self.log.info(f"Removed {path} with age {age_h} hours")
             except Exception:
                 self.log.exception(f"An error occurred whilst handling path {path}")
+        return n_removed, n_bytes
+
+    def start(self):
+        """
+        Start sweeping periodically. Called once the event loop is running.
+        """
+        if self.sweep_interval_seconds:
+            self._sweeper = asyncio.create_task(self.sweep_periodically())
+
+    async def sweep_periodically(self):
+        while True:
+            try:
+                await self.perform_sweep()
+            except Exception:
+                self.log.exception(
+                    f"An error occurred whilst sweeping {self.storage_root}"
+                )
+            await asyncio.sleep(self.sweep_interval_seconds)
+
+    def hold_sweep_lock(self):
+        """
+        Return a context manager that holds the lock shared with other processes
+        whilst sweeping, if it is free, yielding whether it was acquired.
+        """
+        if self.lock_path is None:
+            return contextlib.nullcontext(True)
+        return try_file_lock(Path(self.lock_path))
+
+    async def perform_sweep(self):
+        # Sweeps may be requested faster than they complete
+        if self._sweep_lock.locked():
+            return
+
+        async with self._sweep_lock:
+            with self.hold_sweep_lock() as acquired:
+                if not acquired:
+                    # Another process is sweeping
+                    return
+
+                start = time.monotonic()
+
+                n_orphans, n_orphan_bytes = await asyncio.to_thread(
+                    self.reclaim_orphans
+                )
+                if self.access_index is not None:
+                    n_removed, n_bytes = await self.perform_indexed_sweep()
+                else:
+                    n_removed, n_bytes = await asyncio.to_thread(self.sweep_by_age)
+
+                n_blobs = n_blob_bytes = 0
+                if self.blobs_path is not None:
+                    # Blobs of removed directories are freed once no longer linked
+                    n_blobs, n_blob_bytes = await asyncio.to_thread(
+                        collect_garbage,
+                        Path(self.blobs_path),
+                        self.orphan_max_age_seconds,
+                    )
+
+                duration = time.monotonic() - start
+                storage = Path(self.storage_root).name
+                SWEEP_DURATION.labels(storage=storage).observe(duration)
+                SWEEP_REMOVED.labels(storage=storage).inc(n_removed + n_orphans)
+                SWEEP_FREED_BYTES.labels(storage=storage).inc(
+                    n_bytes + n_orphan_bytes + n_blob_bytes
+                )
+                self.log.info(
+                    f"Swept {self.storage_root} in {duration:.2f}s: removed {n_removed} "
+                    f"directories, {n_orphans} orphans and {n_blobs} unused blobs, "
+                    f"freeing {n_bytes + n_orphan_bytes} bytes of directories and "
+                    f"{n_blob_bytes} bytes of blobs"
+                )
+
+    async def perform_indexed_sweep(self) -> tuple[int, int]:
+        """
+        Remove directories that have not been used for `max_age_hours`, and then
+        the least recently used directories until the total size is within
+        `max_bytes`. Return the number of directories removed and the number of
+        bytes freed.
+        """
+        storage_path = Path(self.storage_root)
+
+        await self.flush_accesses()
+        await asyncio.to_thread(
+            self.access_index.sync, storage_path, self.blobs_path is not None
+        )
+        entries = await asyncio.to_thread(self.access_index.entries)
+
+        now = time.time()
+        total_size = sum(entry.size for entry in entries)
+        n_removed = n_bytes = 0
+        for entry in entries:
+            age_h = (now - entry.last_used) // (60 * 60)
+            if age_h < self.max_age_hours and total_size <= self.max_bytes:
+                # Entries are ordered least recently used first
+                break
+
+            path = storage_path / entry.name
+            try:
+                await asyncio.to_thread(self.remove_directory, path, entry.size)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                self.log.exception(f"An error occurred whilst handling path {path}")
+                continue
+            else:
+                n_removed += 1
+                n_bytes += entry.size
+
+            await asyncio.to_thread(self.access_index.remove, entry.name)
+            total_size -= entry.size
+            self.log.info(
+                f"Removed {path} of size {entry.size} bytes, "
+                f"unused for {age_h} hours with {entry.hits} hits"
+            )
+        return n_removed, n_bytes
@@ -0,0 +1,75 @@
+"""
+Tracing of the resolve → fetch → build → serve pipeline.
+
+Spans are created with the OpenTelemetry API, and are only recorded once
+`setup_tracing` has installed a tracer provider. The trace context is passed to
+builder processes (and pods) in the TRACEPARENT environment variable, so that the
+spans of a builder join the trace of the build that started it.
+"""
+
+import os
+import sys
+from typing import Mapping
+
+from opentelemetry import context, propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+# Path of the file to export spans to ("-" for stdout). Local builders inherit it
+# from the app if it is a file
+TRACE_OUTPUT_ENV = "JUPYTERBOOK_PUB_TRACE_OUTPUT"
+
+# Trace context propagation headers, by environment variable
+TRACE_CONTEXT_ENV = {
+    "TRACEPARENT": "traceparent",
+    "TRACESTATE": "tracestate",
+}
+
+tracer = trace.get_tracer("jupyterbook_pub")
+
+
+def setup_tracing(output: str, service_name: str) -> TracerProvider:
+    """
+    Record spans, and export them as JSON lines.
+
+    :param output: path of file to append spans to, or "-" for stdout.
+    :param service_name: name of the service emitting spans.
+    """
+    out = sys.stdout if output == "-" else open(output, "a")
+    exporter = ConsoleSpanExporter(
+        out=out, formatter=lambda span: span.to_json(indent=None) + os.linesep
+    )
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    return provider
+
+
+def get_trace_environment() -> dict[str, str]:
+    """
+    Return the environment variables that carry the current trace context.
+    """
+    carrier = {}
+    propagate.inject(carrier)
+    return {
+        name: carrier[header]
+        for name, header in TRACE_CONTEXT_ENV.items()
+        if header in carrier
+    }
+
+
+def extract_trace_environment(
+    environ: Mapping[str, str] = os.environ,
+) -> context.Context:
+    """
+    Return the trace context carried by environment variables.
+
+    :param environ: environment variables.
+    """
+    carrier = {
+        header: environ[name]
+        for name, header in TRACE_CONTEXT_ENV.items()
+        if name in environ
+    }
+    return propagate.extract(carrier)
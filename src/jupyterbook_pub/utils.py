@@ -1,3 +1,4 @@
+import asyncio
 import socket
 
 
@@ -10,3 +11,27 @@ def random_port():
     port = sock.getsockname()[1]
     sock.close()
     return port
+
+
+async def read_lines(stream: asyncio.StreamReader, max_line_length: int = 4096):
+    """
+    Yield decoded lines from a stream as they arrive, without buffering the stream.
+
+    Lines longer than the stream's buffer limit are yielded in pieces, and each
+    line is truncated to max_line_length characters.
+
+    :param stream: stream to read from.
+    :param max_line_length: maximum number of characters to yield per line.
+    """
+    while True:
+        try:
+            line = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as err:
+            # EOF
+            line = err.partial
+            if not line:
+                return
+        except asyncio.LimitOverrunError as err:
+            line = await stream.readexactly(err.consumed)
+
+        yield line.decode(errors="replace").rstrip("\r\n")[:max_line_length]
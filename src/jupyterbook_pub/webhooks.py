@@ -0,0 +1,128 @@
+"""
+Push webhooks from git forges (GitHub, GitLab and Gitea/Forgejo).
+
+Builds otherwise start when the first reader requests a site, so every push makes
+its first reader wait for a build. Forges can instead notify us of pushes, so that
+the pushed ref is built before anyone asks for it.
+"""
+
+import dataclasses
+import hashlib
+import hmac
+import urllib.parse
+from typing import Mapping, Optional
+
+# Prefixes of the refs that we build, and the ref that they are stripped to
+REF_PREFIXES = ("refs/heads/", "refs/tags/")
+
+# Hosts whose web URLs are understood by repoproviders, and the path under a
+# project to its tree at a given ref
+WEB_TREE_PATHS = {
+    "github.com": "tree",
+    "gitlab.com": "-/tree",
+}
+
+DELETED_SHA = "0" * 40
+
+
+@dataclasses.dataclass(frozen=True)
+class PushEvent:
+    # Web URL of the project that was pushed to
+    web_url: str
+    # URL to clone the project from
+    clone_url: str
+    # Name of the branch or tag that was pushed
+    ref: str
+
+
+def compare_secrets(a: str, b: str) -> bool:
+    """
+    Compare two strings in constant time.
+
+    hmac.compare_digest only accepts ASCII strings, so compare their encodings,
+    which (with surrogatepass) any string has.
+    """
+    return hmac.compare_digest(
+        a.encode("utf-8", "surrogatepass"), b.encode("utf-8", "surrogatepass")
+    )
+
+
+def verify_signature(headers: Mapping[str, str], body: bytes, secret: str) -> bool:
+    """
+    Return True if a webhook delivery was sent by a forge that shares our secret.
+
+    GitHub and Gitea sign the body with an HMAC, while GitLab sends the secret
+    itself as a token.
+
+    :param headers: request headers.
+    :param body: request body.
+    :param secret: shared webhook secret.
+    """
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+    signature = headers.get("X-Hub-Signature-256")
+    if signature is not None:
+        return compare_secrets(signature, f"sha256={digest}")
+
+    signature = headers.get("X-Gitea-Signature")
+    if signature is not None:
+        return compare_secrets(signature, digest)
+
+    token = headers.get("X-Gitlab-Token")
+    if token is not None:
+        return compare_secrets(token, secret)
+    return False
+
+
+def parse_push(payload: dict) -> Optional[PushEvent]:
+    """
+    Return the push described by a webhook payload, or None if it is not a push of
+    a branch or tag (e.g. a ping, or the deletion of a branch).
+
+    :param payload: decoded JSON body of the webhook delivery.
+    """
+    if not isinstance(payload, dict):
+        return None
+
+    ref = payload.get("ref")
+    if not isinstance(ref, str) or payload.get("deleted"):
+        return None
+    if payload.get("after") == DELETED_SHA:
+        return None
+    for prefix in REF_PREFIXES:
+        if ref.startswith(prefix):
+            ref = ref.removeprefix(prefix)
+            break
+    else:
+        return None
+
+    # GitLab describes the project, while GitHub and Gitea describe the repository
+    project = payload.get("project")
+    repository = payload.get("repository")
+    if isinstance(project, dict) and "web_url" in project:
+        web_url, clone_url = project.get("web_url"), project.get("git_http_url")
+    elif isinstance(repository, dict) and "html_url" in repository:
+        web_url, clone_url = repository.get("html_url"), repository.get("clone_url")
+    else:
+        return None
+
+    if not isinstance(web_url, str) or not isinstance(clone_url, str):
+        return None
+    return PushEvent(web_url=web_url, clone_url=clone_url, ref=ref)
+
+
+def get_push_question(event: PushEvent) -> str:
+    """
+    Return the question that resolves to the pushed ref of a project.
+
+    Web URLs are used where possible, as those are what readers share, and so
+    their built sites are the ones that will be requested.
+
+    :param event: push event.
+    """
+    host = urllib.parse.urlsplit(event.web_url).hostname
+    tree_path = WEB_TREE_PATHS.get(host)
+    # Refs containing slashes are ambiguous in web URLs
+    if tree_path is not None and "/" not in event.ref:
+        return f"{event.web_url.rstrip('/')}/{tree_path}/{event.ref}"
+    return f"git+{event.clone_url}@{event.ref}"